@@ -7,26 +7,42 @@
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import csv
+import hashlib
 import logging
+import multiprocessing
 import operator
+import os
 import random
 import sys
+import tempfile
 from time import time
 
 import click
 import dendropy
+import numpy as np
 
+from . import compact
 from . import fastmrca
+from .compact import CompactTree
+from .compact import NO_NODE
+from .lib import AgeIndex
+from .lib import copy_tree
+from .lib import count_bits
 from .lib import crown_capture_probability
-from .lib import edge_iter
 from .lib import ensure_tree_node_depths
-from .lib import get_ages
+from .lib import get_backend
 from .lib import get_birth_death_rates
+from .lib import get_birth_death_rates_batch
 from .lib import get_new_times
-from .lib import get_short_branches
 from .lib import get_tip_labels
 from .lib import is_binary
+from .lib import optim_stats
+from .lib import RateCache
+from .lib import rates_key
+from .newick import read_chunks
+from .newick import read_tree
 
 logger = logging.getLogger(__name__)
 # Speed up logging for PyPy
@@ -41,6 +57,22 @@ invalid_map = {}
 global mrca_rates
 mrca_rates = {}
 
+global age_index
+age_index = None
+
+global worker_replicate
+worker_replicate = None
+
+global worker_units
+worker_units = None
+
+# Work units missing more than this share of all the missing species are
+# split into the units below them
+MAX_UNIT_SHARE = 0.05
+
+# Bump whenever a change to rate estimation invalidates cached rates
+RATES_CACHE_VERSION = 2
+
 
 def search_ancestors_for_valid_backbone_node(taxonomy_node, backbone_tips, ccp):
     global invalid_map
@@ -84,33 +116,34 @@ def get_new_branching_times(
     backbone_node, taxonomy_node, backbone_tree, told=None, tyoung=0, min_ccp=0.8, num_new_times=None
 ):
     """
-    Get `n_total` new branching times for a `node`.
+    Get `n_total` new branching times for node `backbone_node` of the
+    `CompactTree` `backbone_tree`.
     """
     global mrca_rates
     taxon = taxonomy_node.label
     birth, death, ccp, source = mrca_rates[taxon]
     if ccp < min_ccp:
-        if backbone_node.parent_node:
-            new_told = backbone_node.parent_node.age
+        if backbone_tree.parent[backbone_node] != NO_NODE:
+            new_told = backbone_tree.age[backbone_tree.parent[backbone_node]]
             if told is not None:
                 logger.debug(f"    {taxon}: tmax {told:.2f} => {new_told:.2f} because ccp {new_told:.2f} < {min_ccp}")
             else:
                 logger.debug(f"    {taxon}: tmax set to {new_told:.2f} because ccp {ccp:.2f} < {min_ccp}")
         else:
             # TODO: check for a root edge and graft a fake node above that
-            new_told = backbone_node.age
+            new_told = backbone_tree.age[backbone_node]
             logger.debug(
                 f"    {taxon}: tmax set to {new_told} because even though ccp {ccp:.2f} < {min_ccp} clade is tree root"
             )
         told = new_told
-    n_extant = len(backbone_node.leaf_nodes())
+    n_extant = backbone_tree.leaves[backbone_node]
     n_total = len(taxonomy_node.leaf_nodes())
     if num_new_times is None:
         num_new_times = n_total - n_extant
-    ages = get_ages(backbone_node)
-    if len(backbone_node.leaf_nodes()) == 1 and told is None:
+    ages = compact.get_ages(backbone_tree, backbone_node)
+    if n_extant == 1 and told is None:
         # attach to stem in the case of a singleton
-        told = backbone_node.parent_node.age
+        told = backbone_tree.age[backbone_tree.parent[backbone_node]]
         logger.debug(f"    {taxon}: tmax set to {told:.2f} because taxon is singleton")
     if told is None:
         told = max(ages)
@@ -126,147 +159,6 @@ def get_new_branching_times(
     return times
 
 
-def fill_new_taxa(namespace, node, new_taxa, times, stem=False, excluded_nodes=None):
-    for new_species, new_age in zip(new_taxa, times):
-        new_node = dendropy.Node()
-        new_node.annotations.add_new("creation_method", "fill_new_taxa")
-        new_node.age = new_age
-        new_leaf = new_node.new_child(taxon=namespace.require_taxon(new_species), edge_length=new_age)
-        new_leaf.annotations.add_new("creation_method", "fill_new_taxa")
-        new_leaf.age = 0
-        node = graft_node(node, new_node, stem)
-
-    count_short_branches = len(list(get_short_branches(node)))
-    if count_short_branches:
-        logger.info(f"{count_short_branches} short branches detected")
-
-    return node
-
-
-def graft_node(graft_recipient, graft, stem=False):
-    """
-    Grafts a node `graft` randomly in the subtree below node
-    `graft_recipient`. The attribute `graft.age` must be set so
-    we know where is the best place to graft the node. The node
-    `graft` can optionally have child nodes, in this case the
-    `edge.length` attribute should be set on all child nodes if
-    the tree is to remain ultrametric.
-    """
-
-    # We graft things "below" a node by picking one of the children
-    # of that node and forcing it to be sister to the grafted node
-    # and adjusting the edge lengths accordingly. Therefore, the node
-    # *above* which the graft lives (i.e., the one that will be the child
-    # of the new graft) must fulfill the following requirements:
-    #
-    # 1. Must not be the crown node (cannot graft things above crown node)
-    # 2. Must be younger than the graft node (no negative branches)
-    # 3. Seed node must be older than graft node (no negative branches)
-    # 4. Must not be locked (intruding on monophyly)
-    def filter_fn(x):
-        return x.head_node.age <= graft.age and x.head_node.parent_node.age >= graft.age and x.label != "locked"
-
-    all_edges = list(edge_iter(graft_recipient))
-    if stem:
-        # also include the crown node's subtending edge
-        all_edges.append(graft_recipient.edge)
-    eligible_edges = [x for x in all_edges if filter_fn(x)]
-
-    if not eligible_edges:
-        raise Exception(f"could not place node {graft} in clade {graft_recipient}")
-    focal_node = random.choice([x.head_node for x in eligible_edges])
-    seed_node = focal_node.parent_node
-    sisters = focal_node.sibling_nodes()
-
-    # pick a child edge and detach its corresponding node
-    #
-    # DendroPy's Node.remove_child() messes with the edge lengths.
-    # But, Node.clear_child_nodes() simply cuts that bit of the tree out.
-    seed_node.clear_child_nodes()
-
-    # set the correct edge length on the grafted node and make the grafted
-    # node a child of the seed node
-    graft.edge.length = seed_node.age - graft.age
-    if graft.edge.length < 0:
-        raise Exception("negative branch length")
-    sisters.append(graft)
-    seed_node.set_child_nodes(sisters)
-
-    # make the focal node a child of the grafted node and set edge length
-    focal_node.edge.length = graft.age - focal_node.age
-    if focal_node.edge.length < 0:
-        raise Exception("negative branch length")
-    graft.add_child(focal_node)
-
-    # return the (potentially new) crown of the clade
-    if graft_recipient.parent_node == graft:
-        return graft
-    return graft_recipient
-
-
-def create_clade(namespace, species, ages):
-    tree = dendropy.Tree(taxon_namespace=namespace)
-    species = list(species)
-    ages.sort(reverse=True)
-    # need to generate the "stem node"
-    tree.seed_node.age = ages.pop(0)
-    # clade of size 1?
-    if not ages:
-        node = tree.seed_node.new_child(edge_length=tree.seed_node.age, taxon=namespace.require_taxon(species[0]))
-        node.age = 0.0
-        [x.annotations.add_new("creation_method", "create_clade") for x in tree.preorder_node_iter()]
-        return tree
-    node = tree.seed_node.new_child()
-    node.age = ages.pop(0)
-    for age in ages:
-        valid_nodes = [x for x in tree.nodes() if len(x.child_nodes()) < 2 and age < x.age and x != tree.seed_node]
-        assert len(valid_nodes) > 0
-        node = random.sample(valid_nodes, 1).pop()
-        child = node.new_child()
-        child.age = age
-    n_species = len(species)
-    random.shuffle(species)
-    for node in tree.preorder_node_iter(filter_fn=lambda x: x.age > 0 and x != tree.seed_node):
-        while len(node.child_nodes()) < 2 and len(species) > 0:
-            new_species = species.pop()
-            new_leaf = node.new_child(taxon=namespace.require_taxon(new_species))
-            new_leaf.age = 0.0
-    assert n_species == len(tree.leaf_nodes())
-    assert len(tree.seed_node.child_nodes()) == 1
-    [x.annotations.add_new("creation_method", "create_clade") for x in tree.preorder_node_iter()]
-    assert is_binary(tree.seed_node.child_nodes()[0])
-    tree.set_edge_lengths_from_node_ages(error_on_negative_edge_lengths=True)
-    # Lock the child of the seed node so that things can still attach to the stem of this new clade
-    lock_clade(tree.seed_node.child_nodes()[0])
-    if list(get_short_branches(tree.seed_node)):
-        logger.info("{} short branches detected".format(len(list(get_short_branches(tree.seed_node)))))
-    return tree
-
-
-def lock_clade(node):
-    pre = count_locked(node)
-    for edge in edge_iter(node):
-        edge.label = "locked"
-    post = count_locked(node)
-    if pre != post:
-        logger.debug(f"locking clade: {pre} => {post}")
-
-
-def count_locked(node):
-    sum([x.label == "locked" for x in edge_iter(node)])
-
-
-def is_fully_locked(node):
-    return all([x.label == "locked" for x in edge_iter(node)])
-
-
-def get_min_age(node):
-    try:
-        return min([x.head_node.age for x in edge_iter(node) if x.label != "locked"])
-    except ValueError:
-        return 0.0
-
-
 def fmt_species_list(spp):
     spp = list(spp)
     if len(spp) > 2:
@@ -274,62 +166,164 @@ def fmt_species_list(spp):
     return " and ".join(spp)
 
 
-def process_node(
-    backbone_tree, backbone_bitmask, all_possible_tips, taxon_node, min_ccp, default_birth, default_death, yule=False
-):
-    # TODO: Fix all the returns and refactor this into something sane
-    global mrca_rates
+def plan_node(backbone_tree, backbone_bitmask, taxon_node, min_ccp):
+    """
+    Decides how rates are estimated for `taxon_node`. Returns None for unlabeled
+    ranks, or a tuple of its backbone MRCA, sampling fraction, crown capture
+    probability and the reason its rates are inherited from its parent (None if
+    they are computed from the MRCA).
+    """
     taxon = taxon_node.label
-    parent = taxon_node.parent_node.label
-    try:
-        birth, death, ccp, _ = mrca_rates[parent]
-    except KeyError:
-        birth = default_birth
-        death = default_death
-        parent = "ROOT"
     species = get_tip_labels(taxon_node)
     if not taxon:
         logger.debug(f"MRCA: skipping unlabeled rank with {len(species)} species")
-        return
+        return None
     all_bitmask = backbone_tree.taxon_namespace.taxa_bitmask(labels=species)
     extant_bitmask = all_bitmask & backbone_bitmask
     if extant_bitmask is None or extant_bitmask == 0:
         logger.debug(f"MRCA: {taxon} not present in backbone")
-        mrca_rates[taxon] = (birth, death, 0.0, f"from {parent} (unsampled)")
-        return
+        return (None, None, 0.0, "unsampled")
     mrca = backbone_tree.mrca(leafset_bitmask=extant_bitmask)
     if not species.issuperset(get_tip_labels(mrca)):
         logger.debug(f"MRCA: {taxon} not monophyletic in backbone (from {fmt_species_list(get_tip_labels(mrca) - species)})")
-        mrca_rates[taxon] = (birth, death, 0.0, f"from {parent} (not monophyletic)")
-        return
+        return (mrca, None, 0.0, "not monophyletic")
     extant = len(mrca.leaf_nodes())
     total = len(taxon_node.leaf_nodes())
     if extant > total:
         logger.warning(f"MRCA: {taxon} has {extant} extant species but should have {total} total species")
-        mrca_rates[taxon] = (birth, death, 0, f"from {parent} (extant exceeds total)")
-        return
+        return (mrca, None, 0, "extant exceeds total")
     ccp = crown_capture_probability(total, extant)
+    sf = extant / total
     if total == 1:
         logger.debug(f"MRCA: {taxon} is a singleton")
-        mrca_rates[taxon] = (birth, death, ccp, f"from {parent} (singleton)")
-        return
+        return (mrca, sf, ccp, "singleton")
     if total == 2:
         logger.debug(f"MRCA: {taxon} is a cherry")
-        mrca_rates[taxon] = (birth, death, ccp, f"from {parent} (cherry)")
-        return
+        return (mrca, sf, ccp, "cherry")
     if ccp < min_ccp:
         logger.debug(
             f"MRCA: {taxon} has crown capture probability {ccp:.2f} < {min_ccp:.2f} ({extant}/{total} species)"
         )
-        mrca_rates[taxon] = (birth, death, ccp, f"from {parent} (crown capture probability)")
+        return (mrca, sf, ccp, "crown capture probability")
+    return (mrca, sf, ccp, None)
+
+
+def process_node(
+    backbone_tree,
+    backbone_bitmask,
+    all_possible_tips,
+    taxon_node,
+    min_ccp,
+    default_birth,
+    default_death,
+    yule=False,
+    fallback="grid",
+    cache=None,
+    warm_start=False,
+    plan=None,
+):
+    taxon = taxon_node.label
+    parent = taxon_node.parent_node.label
+    try:
+        birth, death, ccp, _ = mrca_rates[parent]
+    except KeyError:
+        birth = default_birth
+        death = default_death
+        parent = "ROOT"
+    if plan is None:
+        plan = plan_node(backbone_tree, backbone_bitmask, taxon_node, min_ccp)
+    if plan is None:
         return
-    sf = extant / total
-    birth, death = get_birth_death_rates(mrca, sf, yule)
+    mrca, sf, ccp, reason = plan
+    if reason is not None:
+        mrca_rates[taxon] = (birth, death, ccp, f"from {parent} ({reason})")
+        return
+    # Nested ranks tend to have similar rates, so the parent's estimate is a good place to start
+    starts = [(birth, death)] if warm_start else None
+    birth, death = get_birth_death_rates(
+        mrca, sf, yule, fallback=fallback, cache=cache, starts=starts, index=age_index
+    )
+    extant = len(mrca.leaf_nodes())
+    total = len(taxon_node.leaf_nodes())
     logger.debug(f"MRCA: {taxon} b={birth:.2f}, d={death:.2f}, sf={sf:.2f} ({extant}/{total}), ccp={ccp:.2f}")
     mrca_rates[taxon] = (birth, death, ccp, "computed")
 
 
-def run_precalcs(taxonomy_tree, backbone_tree, min_ccp=0.8, min_extant=3, yule=False):
+def init_rate_worker(backbone_tree):
+    """
+    Pool initializer for parallel rate estimation. Each worker receives the
+    backbone once and indexes its nodes by leafset bitmask, so tasks only need
+    to name a clade by its bitmask.
+    """
+    global worker_nodes
+    global worker_index
+    worker_nodes = {x.edge.bipartition.leafset_bitmask: x for x in backbone_tree.postorder_node_iter()}
+    worker_index = AgeIndex(backbone_tree)
+
+
+def fit_clade(task):
+    """Estimates rates for one clade in a pool worker, returning them with the optimizer statistics."""
+    (bitmask, sampfrac, yule, _, fallback), starts = task
+    before = optim_stats.copy()
+    rates = get_birth_death_rates(
+        worker_nodes[bitmask], sampfrac, yule, fallback=fallback, starts=starts, index=worker_index
+    )
+    return rates, optim_stats - before
+
+
+def prefit_in_parallel(plans, backbone_tree, cores, default_rates, yule, fallback, cache, warm_start, process):
+    """
+    Fits every clade that `plans` marks as computed across a pool of `cores`
+    processes and stores the estimates in `cache`. Without warm starts all
+    clades are independent and are fitted together; with them, each taxonomic
+    level is fitted once the levels above it have been processed by `process`,
+    so every fit starts from the same parent estimate as in a serial run.
+    """
+    waves = collections.defaultdict(list)
+    for node in plans:
+        waves[node.level() if warm_start else 0].append(node)
+
+    logger.info(f"Estimating rates on {cores} cores")
+    with multiprocessing.Pool(processes=cores, initializer=init_rate_worker, initargs=(backbone_tree,)) as pool:
+        for level in sorted(waves):
+            tasks = {}
+            for node in waves[level]:
+                plan = plans[node]
+                if plan is None or plan[3] is not None:
+                    continue
+                key = rates_key(plan[0], plan[1], yule, fallback=fallback)
+                # Like the cache in a serial run, the first clade in preorder wins
+                if key in tasks or key in cache:
+                    continue
+                parent = mrca_rates.get(node.parent_node.label, default_rates)
+                tasks[key] = [parent[:2]] if warm_start else None
+            for key, (rates, stats) in zip(tasks, pool.map(fit_clade, tasks.items())):
+                cache.put(key, rates)
+                optim_stats.update(stats)
+            if warm_start:
+                for node in waves[level]:
+                    process(node)
+
+
+def get_root_clade(backbone_tree, backbone_bitmask, all_possible_tips):
+    """Returns the backbone MRCA of the whole taxonomy and its sampling fraction."""
+    logger.debug("Computing root birth and death rates.")
+    extant_bitmask = backbone_bitmask & backbone_tree.taxon_namespace.taxa_bitmask(labels=all_possible_tips)
+    root_mrca = backbone_tree.mrca(leafset_bitmask=extant_bitmask)
+    return root_mrca, len(root_mrca.leaf_nodes()) / len(all_possible_tips)
+
+
+def run_precalcs(
+    taxonomy_tree,
+    backbone_tree,
+    min_ccp=0.8,
+    min_extant=3,
+    yule=False,
+    fallback="grid",
+    warm_start=False,
+    engine="serial",
+    cores=1,
+):
     global mrca_rates
     tree_tips = get_tip_labels(backbone_tree)
     backbone_bitmask = fastmrca.bitmask(tree_tips)
@@ -337,15 +331,59 @@ def run_precalcs(taxonomy_tree, backbone_tree, min_ccp=0.8, min_extant=3, yule=F
     nnodes = len(taxonomy_tree.internal_nodes(exclude_seed_node=True))
 
     start_time = time()
+    cache = RateCache()
+    stats_before = optim_stats.copy()
 
     # Compute the rate of the root taxonomic node to use as a default value...
-    logger.debug("Computing root birth and death rates.")
-    extant_bitmask = backbone_bitmask & backbone_tree.taxon_namespace.taxa_bitmask(labels=all_possible_tips)
-    root_mrca = backbone_tree.mrca(leafset_bitmask=extant_bitmask)
+    root_mrca, root_sf = get_root_clade(backbone_tree, backbone_bitmask, all_possible_tips)
+
+    plans = {}
+    if engine == "batch":
+        # Fit every clade that needs its own rates in one go, then fill in
+        # the table from the cache as usual
+        if warm_start:
+            logger.info("Ignoring --warm-start with the batch rate engine")
+            warm_start = False
+        for node in taxonomy_tree.preorder_internal_node_iter(exclude_seed_node=True):
+            plans[node] = plan_node(backbone_tree, backbone_bitmask, node, min_ccp)
+        fit = [(root_mrca, root_sf)]
+        fit.extend((plan[0], plan[1]) for plan in plans.values() if plan is not None and plan[3] is None)
+        cache = RateCache(maxsize=max(cache.maxsize, len(fit)))
+        logger.debug(f"Fitting rates for {len(fit)} clades together")
+        get_birth_death_rates_batch(*zip(*fit), yule, fallback=fallback, cache=cache, index=age_index)
+    elif cores > 1:
+        for node in taxonomy_tree.preorder_internal_node_iter(exclude_seed_node=True):
+            plans[node] = plan_node(backbone_tree, backbone_bitmask, node, min_ccp)
+        cache = RateCache(maxsize=max(cache.maxsize, len(plans) + 1))
+
     root_birth, root_death = get_birth_death_rates(
-        root_mrca, len(root_mrca.leaf_nodes()) / len(all_possible_tips), yule
+        root_mrca, root_sf, yule, fallback=fallback, cache=cache, index=age_index
     )
 
+    def process(node):
+        # updates global mrca_rates as a side effect
+        process_node(
+            backbone_tree,
+            backbone_bitmask,
+            all_possible_tips,
+            node,
+            min_ccp,
+            root_birth,
+            root_death,
+            yule,
+            fallback,
+            cache,
+            warm_start,
+            plans.get(node),
+        )
+
+    if engine != "batch" and cores > 1:
+        prefit_in_parallel(
+            plans, backbone_tree, cores, (root_birth, root_death), yule, fallback, cache, warm_start, process
+        )
+        # Every fit is now cached, so rebuild the table in the same order as a serial run
+        mrca_rates.clear()
+
     with click.progressbar(
         taxonomy_tree.preorder_internal_node_iter(exclude_seed_node=True),
         width=12,
@@ -355,111 +393,210 @@ def run_precalcs(taxonomy_tree, backbone_tree, min_ccp=0.8, min_extant=3, yule=F
         item_show_func=lambda x: x.label if x else None,
     ) as progress:
         for node in progress:
-            # updates global mrca_rates as a side effect
-            process_node(
-                backbone_tree, backbone_bitmask, all_possible_tips, node, min_ccp, root_birth, root_death, yule
-            )
+            process(node)
 
+    logger.debug(f"Rate cache: {cache}")
+    stats = optim_stats - stats_before
+    logger.debug(
+        f"Rate optimization: {stats['batch fits']} batched fits, {stats['fits']} fits, "
+        f"{stats['iterations']} L-BFGS-B iterations, "
+        f"{stats['grid fallbacks']} grid and {stats['annealing fallbacks']} annealing fallbacks"
+    )
     diff = time() - start_time
     if diff > 1:
         logger.debug(f"FastMRCA calculation time: {diff:.1f} seconds")
     return mrca_rates
 
 
-def update_tree_view(tree):
-    # Stuff that DendroPy needs to keep a consistent view of the phylgoeny
-    tree.calc_node_ages()
-    tree.update_bipartitions()
-    return get_tip_labels(tree)
-
-
-@click.command()
-@click.option("--taxonomy", help="a taxonomy tree", type=click.File("r"), required=True)
-@click.option(
-    "--backbone", help="the backbone tree to attach the taxonomy tree to", type=click.File("r"), required=True
-)
-@click.option("--outgroups", help="comma separated list of outgroup taxa to ignore")
-@click.option("--output", required=True, help="output base name to write out")
-@click.option(
-    "--min-ccp", help="minimum probability to use to say that we've sampled the crown of a clade", default=0.8
-)
-@click.option("--yule", help="assume a Yule pure-birth model (force extinction to be 0)", default=False, is_flag=True)
-@click.option("-v", "--verbose", help="emit extra information (can be repeated)", count=True)
-def main(taxonomy, backbone, outgroups, output, min_ccp, verbose, yule):
+class LazyRates(dict):
     """
-    Add tips onto a BACKBONE phylogeny using a TAXONOMY phylogeny.
+    Rates table for the lazy rate engine. Looking up a taxon that has not been
+    estimated yet runs `process` on its taxonomy node, which estimates and
+    stores its rates (and those of any ancestors it looks up in turn).
     """
-    logger.addHandler(logging.FileHandler(output + ".log.txt"))
-    if verbose >= 2:
-        logger.setLevel(logging.DEBUG)
-    elif verbose == 1:
-        logger.setLevel(logging.INFO)
-    else:
-        logger.setLevel(logging.WARNING)
-        logger.addHandler(logging.StreamHandler())
 
-    logger.info("Reading taxonomy")
-    taxonomy = dendropy.Tree.get_from_stream(taxonomy, schema="newick", rooting="default-rooted")
-    tn = taxonomy.taxon_namespace
-    tn.is_mutable = True
-    if outgroups:
-        outgroups = [x.replace("_", " ") for x in outgroups.split(",")]
-        tn.new_taxa(outgroups)
-    tn.is_mutable = False
+    def __init__(self, taxonomy_tree, process, cache=None):
+        super().__init__()
+        self.nodes = {x.label: x for x in taxonomy_tree.preorder_internal_node_iter(exclude_seed_node=True) if x.label}
+        self.process = process
+        self.cache = cache
 
-    # Check for equal depth of all nodes
-    msg = ensure_tree_node_depths(taxonomy)
-    if msg:
-        logger.warning(msg)
+    def __missing__(self, taxon):
+        if taxon not in self.nodes:
+            raise KeyError(taxon)
+        self.process(self.nodes[taxon])
+        return dict.__getitem__(self, taxon)
 
-    logger.info("Reading backbone")
-
-    try:
-        tree = dendropy.Tree.get_from_stream(backbone, schema="newick", rooting="default-rooted", taxon_namespace=tn)
-    except dendropy.utility.error.ImmutableTaxonNamespaceError as e:
-        logger.error(f"DendroPy error: {e}")
-        print(
-            """
-This usually indicates your backbone has species that are not present in your
-taxonomy. Outgroups not in the taxonomy can be excluded with the argument:
 
-    tact_add_taxa --outgroups outgroup_speciesA,outgroup_speciesB
-
-For more details, run:
+def lazy_precalcs(taxonomy_tree, backbone_tree, min_ccp=0.8, yule=False, fallback="grid", warm_start=False):
+    """
+    Like `run_precalcs`, but only estimates the rates of the root clade up
+    front. Returns a `LazyRates` table that estimates everything else the
+    first time it is needed.
+    """
+    tree_tips = get_tip_labels(backbone_tree)
+    backbone_bitmask = fastmrca.bitmask(tree_tips)
+    all_possible_tips = get_tip_labels(taxonomy_tree)
+    cache = RateCache()
+    root_mrca, root_sf = get_root_clade(backbone_tree, backbone_bitmask, all_possible_tips)
+    root_birth, root_death = get_birth_death_rates(
+        root_mrca, root_sf, yule, fallback=fallback, cache=cache, index=age_index
+    )
 
-    tact_add_taxa --help
-"""
+    def process(node):
+        process_node(
+            backbone_tree,
+            backbone_bitmask,
+            all_possible_tips,
+            node,
+            min_ccp,
+            root_birth,
+            root_death,
+            yule,
+            fallback,
+            cache,
+            warm_start,
         )
-        sys.exit(1)
 
-    if not is_binary(tree):
-        logger.error("Backbone tree is not binary!")
-        sys.exit(1)
+    return LazyRates(taxonomy_tree, process, cache)
 
-    tree.encode_bipartitions()
-    tree.calc_node_ages()
 
-    tree_tips = get_tip_labels(tree)
-    all_possible_tips = get_tip_labels(taxonomy)
-
-    logger.info(f"Backbone needs to add {len(tree_tips.symmetric_difference(all_possible_tips))} tips")
-
-    full_clades = set()
+def rates_digest(taxonomy_digest, backbone_digest, min_ccp, yule, fallback, warm_start, engine="serial", backend=None):
+    """
+    Hashes everything that rate estimation depends on: the taxonomy and backbone
+    Newick text, given as hex digests of what was read (and so the backbone
+    topology and branch lengths), and the estimation settings. The numerical
+    backends can differ in the last bits, so the backend (by default the
+    active one) is part of the settings too.
+    """
+    if backend is None:
+        backend = get_backend()
+    digest = hashlib.sha256()
+    settings = (
+        f"tact rates v{RATES_CACHE_VERSION}; min_ccp={min_ccp!r}; yule={yule!r}; "
+        f"fallback={fallback}; warm_start={warm_start!r}; engine={engine}; backend={backend}"
+    )
+    for part in (settings, taxonomy_digest, backbone_digest):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
 
-    fastmrca.initialize(tree)
 
-    with open(output + ".rates.csv", "w") as wfile:
+def write_rates(path, rates):
+    """Writes `rates` as CSV to `path`, atomically replacing any existing file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False, newline="") as wfile:
         writer = csv.writer(wfile)
         writer.writerow(("taxon", "birth", "death", "ccp", "source"))
-        for key, value in run_precalcs(taxonomy, tree, min_ccp, yule=yule).items():
+        for key, value in rates.items():
             row = [key]
             row.extend(value)
             writer.writerow(row)
+    os.replace(wfile.name, path)
+
 
-    initial_length = len(tree_tips)
+def read_rates(path):
+    """Reads rates written by `write_rates`."""
+    rates = {}
+    with open(path, newline="") as rfile:
+        reader = csv.reader(rfile)
+        next(reader)
+        for taxon, birth, death, ccp, source in reader:
+            rates[taxon] = (float(birth), float(death), float(ccp), source)
+    return rates
+
+
+def read_rates_cache(directory, digest, taxonomy_tree):
+    """
+    Loads cached rates for `digest` from `directory`, or returns None if there
+    are none or they do not cover every ranked node in `taxonomy_tree`.
+    """
+    path = os.path.join(directory, f"{digest}.rates.csv")
+    try:
+        rates = read_rates(path)
+    except FileNotFoundError:
+        logger.info(f"No cached rates found at {path}")
+        return None
+    except (ValueError, StopIteration) as e:
+        logger.warning(f"Ignoring unreadable cached rates at {path}: {e}")
+        return None
+    taxa = set(x.label for x in taxonomy_tree.preorder_internal_node_iter(exclude_seed_node=True) if x.label)
+    if taxa != set(rates):
+        logger.warning(f"Ignoring cached rates at {path} as they do not match the taxonomy")
+        return None
+    logger.info(f"Using cached rates from {path}")
+    return rates
+
+
+def write_rates_cache(directory, digest, rates):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{digest}.rates.csv")
+    write_rates(path, rates)
+    logger.info(f"Cached rates to {path}")
+
+
+def lock_compact_clade(tree, node):
+    """Locks the clade below `node` in the `CompactTree` `tree`, logging any change."""
+    pre = tree.locked_edges[node]
+    tree.lock_clade(node)
+    post = tree.locked_edges[node]
+    if pre != post:
+        logger.debug(f"locking clade: {pre} => {post}")
+
+
+def log_short_branches(tree, node):
+    count_short_branches = tree.count_short_branches(node)
+    if count_short_branches:
+        logger.info(f"{count_short_branches} short branches detected")
+
+
+def get_species_masks(root, tree):
+    """
+    Returns the bitmask of the species below each node of the taxonomy from
+    `root` down, in the same encoding as `tree.mask` for the `CompactTree`
+    `tree`. Taxon ids follow the namespace, so the masks also hold for the
+    clades copied out of `tree`.
+    """
+    species_masks = {}
+    for x in root.postorder_iter():
+        if x.is_leaf():
+            species_masks[x] = 1 << tree.taxon_id(x.taxon)
+        else:
+            species_masks[x] = 0
+            for child in x.child_node_iter():
+                species_masks[x] |= species_masks[child]
+    return species_masks
+
+
+def graft_taxa(taxonomy, tree, min_ccp=0.8, label="TACT", progress_file=None, taxon_root=None, species_masks=None):
+    """
+    Grafts every species in `taxonomy` that is missing from the `CompactTree`
+    `tree` onto it, using the rates in the global `mrca_rates`. Modifies
+    `tree` in place. Progress is shown on `progress_file` (default: standard
+    output).
+
+    If `taxon_root` is given, only that taxonomy node and the taxa below it
+    are processed, so only its species are grafted. `species_masks` can be
+    passed in if already known (see `get_species_masks`).
+    """
+    if taxon_root is None:
+        root = taxonomy.seed_node
+        taxon_nodes = taxonomy.postorder_internal_node_iter(exclude_seed_node=True)
+    else:
+        root = taxon_root
+        taxon_nodes = taxon_root.postorder_internal_node_iter()
+    if species_masks is None:
+        species_masks = get_species_masks(root, tree)
+    taxonomy_nodes = {x.label: x for x in root.preorder_internal_node_iter() if x.label}
+    all_possible_tips = get_tip_labels(root)
+    full_clades = set()
+    invalid_map.clear()
+
+    initial_length = tree.tips
 
     bar = click.progressbar(
-        label="TACT",
+        label=label,
+        file=progress_file,
         length=len(all_possible_tips) - initial_length,
         show_pos=True,
         width=12,
@@ -467,18 +604,17 @@ For more details, run:
     )
 
     def bar_update():
-        bar.pos = len(tree_tips) - initial_length
+        bar.pos = tree.tips - initial_length
         bar.current_item = taxon if taxon else ""
         bar.update(0)
 
-    for taxon_node in taxonomy.postorder_internal_node_iter(exclude_seed_node=True):
+    for taxon_node in taxon_nodes:
         taxon = taxon_node.label
         if not taxon:
             continue
-        species = get_tip_labels(taxon_node)
-        extant_species = tree_tips.intersection(species)
-        logger.info(f"**  {taxon} ({len(extant_species)}/{len(species)})  **")
-        ccp = mrca_rates[taxon][2]
+        species = species_masks[taxon_node]
+        extant_species = species & tree.mask
+        logger.info(f"**  {taxon} ({count_bits(extant_species)}/{count_bits(species)})  **")
 
         clades_to_generate = full_clades.intersection(
             [x.label for x in taxon_node.postorder_internal_node_iter(exclude_seed_node=True)]
@@ -492,43 +628,44 @@ For more details, run:
             continue
 
         # Check for monophyly for this node
-        node = fastmrca.get(extant_species)
-        if not node:
+        node = tree.get_monophyletic(extant_species)
+        if node is None:
             logger.info(f"    {taxon}: is not monophyletic")
             continue
 
         if extant_species == species:
             # Everything sampled and monophyletic, so skip this
-            lock_clade(node)
+            lock_compact_clade(tree, node)
             logger.debug(f"    {taxon}: all species accounted for")
             continue
 
-        if tree_tips.issuperset(species):
+        if species & ~tree.mask == 0:
             # XXX: Does this check ever get triggered?
-            lock_clade(node)
+            lock_compact_clade(tree, node)
             logger.info(f"    {taxon}: all species already present in tree")
             continue
 
-        clade_ranks = [(clade, taxonomy.find_node_with_label(clade).level()) for clade in clades_to_generate]
+        ccp = mrca_rates[taxon][2]
+        clade_ranks = [(clade, taxonomy_nodes[clade].level()) for clade in sorted(clades_to_generate)]
 
         # Now add clades of unsampled species. Go from the lowest rank to
         # the highest (deepest level to lowest level). Shuffling before
         # sorting will randomize the order since Python uses stable sorting
         random.shuffle(clade_ranks)
         for clade, _ in sorted(clade_ranks, key=operator.itemgetter(1), reverse=True):
-            full_node = taxonomy.find_node_with_label(clade)
-            full_node_species = get_tip_labels(full_node)
-            if tree_tips.issuperset(full_node_species):
+            full_node = taxonomy_nodes[clade]
+            if species_masks[full_node] & ~tree.mask == 0:
                 logger.info(f"    {taxon}: skipping clade {clade} as all species already present in tree")
                 full_clades.remove(clade)
                 continue
-            logger.info(f"    {taxon}: adding clade {clade} (n={len(full_node.leaf_nodes())})")
+            full_node_species = tree.labels_of(species_masks[full_node])
+            logger.info(f"    {taxon}: adding clade {clade} (n={len(full_node_species)})")
             # Generate all times needed to attach to the main clade
             times = get_new_branching_times(
                 node, taxon_node, tree, tyoung=0, min_ccp=min_ccp, num_new_times=len(full_node_species)
             )
 
-            if is_fully_locked(node):
+            if tree.is_fully_locked(node):
                 logger.info(f"    {taxon}: is fully locked, so attaching to stem")
                 # Must attach to stem for this clade, so generate a time on the stem lineage
                 times2 = get_new_branching_times(
@@ -536,8 +673,8 @@ For more details, run:
                     taxon_node,
                     tree,
                     min_ccp=min_ccp,
-                    told=node.parent_node.age,
-                    tyoung=node.age,
+                    told=tree.age[tree.parent[node]],
+                    tyoung=tree.age[node],
                     num_new_times=1,
                 )
                 # Drop the oldest time and add on our new time on the stem lineage
@@ -546,7 +683,7 @@ For more details, run:
                 times.append(times2.pop())
             else:
                 # Even if the main clade isn't fully locked, it might have a constraint on a valid attachment point
-                min_age = get_min_age(node)
+                min_age = tree.get_min_age(node)
                 if min_age > 0 and max(times) < min_age:
                     logger.info(
                         f"    {taxon}: has a minimum age constraint {min_age:.2f} but oldest generated time was {max(times):.2f}"
@@ -559,51 +696,447 @@ For more details, run:
                     times.pop()
                     times.append(times2.pop())
 
-            # Generate a new tree
-            new_tree = create_clade(tn, full_node_species, times)
+            # Generate a new clade
+            new_clade = compact.create_clade(tree, full_node_species, times)
+            locked = tree.locked_edges[tree.first_child[new_clade]]
+            if locked:
+                logger.debug(f"locking clade: 0 => {locked}")
+            log_short_branches(tree, new_clade)
             # Update our current MRCA node (because we might have attached to stem)
-            node = graft_node(node, new_tree.seed_node, is_fully_locked(node) or ccp < min_ccp)
-            # Stuff that DendroPy needs to keep a consistent view of the phylgoeny
-            tree.calc_node_ages()
-            tree.update_bipartitions()
-            tree_tips = get_tip_labels(tree)
+            node = compact.graft_node(tree, node, new_clade, tree.is_fully_locked(node) or ccp < min_ccp)
             # Update our view of what's in the tree
-            extant_species = tree_tips.intersection(species)
+            extant_species = species & tree.mask
             # We've added this clade so pop it off our stack
             full_clades.remove(clade)
-            if not is_binary(node):
+            if not tree.is_binary(node):
                 raise ValueError("Tree is not binary!")
             bar_update()
 
         # Check to see if we need to continue adding species
         if extant_species == species:
             # Lock clade since it is monophyletic and filled
-            lock_clade(node)
+            lock_compact_clade(tree, node)
             # Skip taxon spray check
             continue
-        if len(extant_species) == len(species):
+        if count_bits(extant_species) == count_bits(species):
             raise ValueError("Enough species are present but mismatched?")
 
         # Taxon spray
-        logger.info(f"    {taxon}: adding {len(species.difference(extant_species))} new species")
-        node = fastmrca.get(extant_species)
-        times = get_new_branching_times(node, taxon_node, tree, tyoung=get_min_age(node), min_ccp=min_ccp)
-        node = fill_new_taxa(tn, node, species.difference(tree_tips), times, ccp < min_ccp)
-        # Update stuff
-        tree_tips = update_tree_view(tree)
+        logger.info(f"    {taxon}: adding {count_bits(species & ~extant_species)} new species")
+        node = tree.get_monophyletic(extant_species)
+        times = get_new_branching_times(node, taxon_node, tree, tyoung=tree.get_min_age(node), min_ccp=min_ccp)
+        node = compact.fill_new_taxa(tree, node, sorted(tree.labels_of(species & ~tree.mask)), times, ccp < min_ccp)
+        log_short_branches(tree, node)
         # Since only monophyletic nodes get to here, lock this clade
-        lock_clade(node)
-        if not is_binary(node):
+        lock_compact_clade(tree, node)
+        if not tree.is_binary(node):
             # Shouldn't happen
             raise ValueError("Tree is not binary!")
         bar_update()
 
-    assert is_binary(tree.seed_node)
+    # The root of a tree of just one clade is the parent of its stem
+    if taxon_root:
+        assert all(tree.is_binary(x) for x in tree.children(tree.root))
+    else:
+        assert tree.is_binary(tree.root)
     # Reset terminal because we aren't using the context manager
     bar.render_finish()
+    return tree
+
+
+def plan_units(taxonomy, tree, species_masks=None):
+    """
+    Splits the taxonomy into work units that can be simulated independently
+    of each other: labelled taxa with missing species whose sampled species
+    form a clade of the `CompactTree` `tree` (other than the whole tree).
+    Everything grafted for such a taxon lands in its clade or on its stem, and
+    the clade is locked once it is filled, so no other graft can touch it.
+
+    Units are the highest such taxa, except that a unit missing more than
+    `MAX_UNIT_SHARE` of all the missing species is replaced by the units below
+    it, if there are any, to spread the work out. The plan depends only on the
+    inputs. Returns a list of (taxonomy node, tree node) pairs.
+    """
+    if species_masks is None:
+        species_masks = get_species_masks(taxonomy.seed_node, tree)
+    total_missing = count_bits(species_masks[taxonomy.seed_node] & ~tree.mask)
+
+    def units_in(taxon_node):
+        unit = None
+        species = species_masks[taxon_node]
+        extant = species & tree.mask
+        missing = count_bits(species & ~tree.mask)
+        if taxon_node.label and extant and missing and taxon_node is not taxonomy.seed_node:
+            backbone_node = tree.get_monophyletic(extant)
+            if backbone_node is not None and tree.parent[backbone_node] != NO_NODE:
+                unit = (taxon_node, backbone_node)
+                if missing <= MAX_UNIT_SHARE * total_missing:
+                    return [unit]
+        below = []
+        for child in taxon_node.child_node_iter():
+            if child.is_internal():
+                below.extend(units_in(child))
+        if unit is not None and not below:
+            return [unit]
+        return below
+
+    return units_in(taxonomy.seed_node)
+
+
+def init_unit_worker(taxonomy, tree, units, min_ccp, species_masks):
+    """
+    Pool initializer for simulating work units in parallel. Workers are
+    forked, so the inputs and the global `mrca_rates` are shared with the
+    parent rather than pickled.
+    """
+    global worker_units
+    worker_units = (taxonomy, tree, units, min_ccp, species_masks, open(os.devnull, "w"))
+
+
+def simulate_unit(task):
+    """
+    Grafts the species of one work unit onto a copy of its clade, in a pool
+    worker or in the main process. Returns the packed clade (see
+    `CompactTree.pack`) and, for the lazy rate engine, the rates estimated so
+    far.
+    """
+    i, seed = task
+    taxonomy, tree, units, min_ccp, species_masks, progress_file = worker_units
+    taxon_node, backbone_node = units[i]
+    logger.info(f"Simulating {taxon_node.label} separately")
+    random.seed(seed)
+    clade = tree.clade(backbone_node)
+    graft_taxa(
+        taxonomy,
+        clade,
+        min_ccp,
+        label=taxon_node.label,
+        progress_file=progress_file,
+        taxon_root=taxon_node,
+        species_masks=species_masks,
+    )
+    rates = dict(mrca_rates) if isinstance(mrca_rates, LazyRates) else None
+    return clade.pack(clade.root), rates
+
+
+def add_taxa_in_units(taxonomy, tree, min_ccp=0.8, cores=1, label="TACT", progress_file=None):
+    """
+    Grafts every species in `taxonomy` that is missing from the DendroPy
+    `tree` onto it, on a `CompactTree` copy that is written back to `tree`.
+    The independent work units found by `plan_units` are simulated first,
+    using a pool of `cores` forked processes if there is more than one, and
+    each is stitched back in place of its clade. The rest of the taxonomy is
+    then grafted with `graft_taxa`.
+
+    Each unit gets its own random seed, drawn in a fixed order from the
+    `random` module, so the tree does not depend on `cores` or on the order
+    in which the units finish.
+    """
+    global worker_units
+    ctree = CompactTree.from_dendropy(tree)
+    species_masks = get_species_masks(taxonomy.seed_node, ctree)
+    units = plan_units(taxonomy, ctree, species_masks)
+    if units:
+        tasks = [(i, random.getrandbits(64)) for i in range(len(units))]
+        resume = random.getrandbits(64)
+        if cores > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            logger.warning("Simulating taxa on one core, as this platform cannot fork processes")
+            cores = 1
+        logger.info(f"Simulating {len(units)} independent taxa on {cores} cores")
+        if cores == 1:
+            worker_units = (taxonomy, ctree, units, min_ccp, species_masks, progress_file)
+            results = map(simulate_unit, tasks)
+            pool = None
+        else:
+            context = multiprocessing.get_context("fork")
+            pool = context.Pool(
+                processes=cores, initializer=init_unit_worker, initargs=(taxonomy, ctree, units, min_ccp, species_masks)
+            )
+            results = pool.imap(simulate_unit, tasks)
+        try:
+            # The clades are disjoint, so the order they are stitched in does not matter
+            for (taxon_node, backbone_node), (packed, rates) in zip(units, results):
+                ctree.replace(backbone_node, ctree.unpack(packed)[0])
+                if rates is not None:
+                    # Rates estimated lazily in a worker process
+                    mrca_rates.update(rates)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        random.seed(resume)
+    graft_taxa(taxonomy, ctree, min_ccp, label=label, progress_file=progress_file, species_masks=species_masks)
+    return ctree.to_dendropy(tree)
+
+
+def replicate_seeds(seed, replicates):
+    """
+    Derives an independent seed for each replicate from a master `seed`, or
+    from fresh entropy if it is None, so that each replicate's tree depends
+    only on its own seed and not on which process simulated it. Passing the
+    logged entropy back as `seed` reproduces the run.
+    """
+    sequence = np.random.SeedSequence(seed)
+    if seed is None:
+        logger.info(f"Using random seed {sequence.entropy}")
+    return [child.generate_state(4).tobytes() for child in sequence.spawn(replicates)]
+
+
+def init_replicate_worker(taxonomy, backbone_tree, min_ccp):
+    """
+    Pool initializer for parallel replicates. Workers are forked, so the
+    inputs and the global `mrca_rates` are shared with the parent rather than
+    pickled.
+    """
+    global worker_replicate
+    worker_replicate = (taxonomy, backbone_tree, min_ccp, open(os.devnull, "w"))
+
+
+def simulate_replicate(task):
+    """
+    Grafts the taxonomy onto a copy of the backbone for one replicate, in a pool
+    worker or in the main process. Returns the Newick string of the tree and,
+    for the lazy rate engine, the rates estimated so far.
+    """
+    replicate, replicates, seed = task
+    taxonomy, backbone_tree, min_ccp, progress_file = worker_replicate
+    logger.info(f"Replicate {replicate} of {replicates}")
+    random.seed(seed)
+    tree = add_taxa_in_units(
+        taxonomy, copy_tree(backbone_tree), min_ccp, label=f"TACT {replicate}/{replicates}", progress_file=progress_file
+    )
     tree.ladderize()
-    tree.write(path=output + ".newick.tre", schema="newick", suppress_rooting=True)
-    tree.write(path=output + ".nexus.tre", schema="nexus")
+    rates = dict(mrca_rates) if isinstance(mrca_rates, LazyRates) else None
+    return tree.as_string(schema="newick", suppress_rooting=True), rates
+
+
+def generate_replicates(taxonomy, backbone_tree, min_ccp, seeds, cores=1):
+    """
+    Yields the results of `simulate_replicate` for each of `seeds` in order,
+    using a pool of `cores` forked processes if there is more than one.
+    """
+    global worker_replicate
+    tasks = [(i, len(seeds), seed) for i, seed in enumerate(seeds, 1)]
+    if cores > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning("Generating replicates on one core, as this platform cannot fork processes")
+        cores = 1
+    if cores == 1:
+        worker_replicate = (taxonomy, backbone_tree, min_ccp, None)
+        for task in tasks:
+            yield simulate_replicate(task)
+        return
+    logger.info(f"Generating replicates on {cores} cores")
+    context = multiprocessing.get_context("fork")
+    with context.Pool(
+        processes=cores, initializer=init_replicate_worker, initargs=(taxonomy, backbone_tree, min_ccp)
+    ) as pool:
+        yield from pool.imap(simulate_replicate, tasks)
+
+
+@click.command()
+@click.option("--taxonomy", help="a taxonomy tree", type=click.File("r"), required=True)
+@click.option(
+    "--backbone", help="the backbone tree to attach the taxonomy tree to", type=click.File("r"), required=True
+)
+@click.option("--outgroups", help="comma separated list of outgroup taxa to ignore")
+@click.option("--output", required=True, help="output base name to write out")
+@click.option(
+    "--min-ccp", help="minimum probability to use to say that we've sampled the crown of a clade", default=0.8
+)
+@click.option("--yule", help="assume a Yule pure-birth model (force extinction to be 0)", default=False, is_flag=True)
+@click.option(
+    "--fallback",
+    help="optimizer to use for rate estimates when L-BFGS-B fails to converge",
+    type=click.Choice(["grid", "annealing"]),
+    default="grid",
+    show_default=True,
+)
+@click.option(
+    "--warm-start",
+    help="start each rate estimate from the estimate of its parent taxon",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--rates-cache",
+    help="directory of cached rate estimates, reused when the inputs and settings match those of a previous run",
+    type=click.Path(file_okay=False),
+)
+@click.option(
+    "--rate-engine",
+    help="estimate rates one clade at a time (serial), for all clades together in a vectorized solver (batch), "
+    "or only for the clades that need new tips, as they are reached (lazy). The batch solver can settle on "
+    "different rates with an equally good likelihood",
+    type=click.Choice(["serial", "batch", "lazy"]),
+    default="serial",
+    show_default=True,
+)
+@click.option(
+    "--cores",
+    help="number of processes to use for rate estimation with the serial rate engine, and for generating "
+    "replicates or, for a single tree, independent taxa",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--replicates",
+    help="number of trees to generate from a single set of rate estimates, written together to the outputs",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--seed",
+    help="seed for the random number generator, to make runs reproducible; each replicate gets its own stream derived from it",
+    type=click.IntRange(min=0),
+)
+@click.option("-v", "--verbose", help="emit extra information (can be repeated)", count=True)
+def main(
+    taxonomy,
+    backbone,
+    outgroups,
+    output,
+    min_ccp,
+    verbose,
+    yule,
+    fallback,
+    warm_start,
+    rates_cache,
+    rate_engine,
+    cores,
+    replicates,
+    seed,
+):
+    """
+    Add tips onto a BACKBONE phylogeny using a TAXONOMY phylogeny.
+    """
+    logger.addHandler(logging.FileHandler(output + ".log.txt"))
+    if verbose >= 2:
+        logger.setLevel(logging.DEBUG)
+    elif verbose == 1:
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.WARNING)
+        logger.addHandler(logging.StreamHandler())
+
+    logger.info(f"Using the {get_backend()} numerical backend (set TACT_BACKEND to override)")
+    if seed is not None:
+        random.seed(seed)
+    logger.info("Reading taxonomy")
+    taxonomy_digest = hashlib.sha256()
+    taxonomy = read_tree(read_chunks(taxonomy, digest=taxonomy_digest))
+    tn = taxonomy.taxon_namespace
+    tn.is_mutable = True
+    if outgroups:
+        outgroups = [x.replace("_", " ") for x in outgroups.split(",")]
+        tn.new_taxa(outgroups)
+    tn.is_mutable = False
+
+    # Check for equal depth of all nodes
+    msg = ensure_tree_node_depths(taxonomy)
+    if msg:
+        logger.warning(msg)
+
+    logger.info("Reading backbone")
+
+    backbone_digest = hashlib.sha256()
+    try:
+        tree = read_tree(read_chunks(backbone, digest=backbone_digest), tn)
+    except dendropy.utility.error.ImmutableTaxonNamespaceError as e:
+        logger.error(f"DendroPy error: {e}")
+        print(
+            """
+This usually indicates your backbone has species that are not present in your
+taxonomy. Outgroups not in the taxonomy can be excluded with the argument:
+
+    tact_add_taxa --outgroups outgroup_speciesA,outgroup_speciesB
+
+For more details, run:
+
+    tact_add_taxa --help
+"""
+        )
+        sys.exit(1)
+
+    if not is_binary(tree):
+        logger.error("Backbone tree is not binary!")
+        sys.exit(1)
+
+    tree.encode_bipartitions()
+    tree.calc_node_ages()
+
+    tree_tips = get_tip_labels(tree)
+    all_possible_tips = get_tip_labels(taxonomy)
+
+    logger.info(f"Backbone needs to add {len(tree_tips.symmetric_difference(all_possible_tips))} tips")
+
+    fastmrca.initialize(tree)
+    global age_index
+    age_index = AgeIndex(tree)
+
+    # Start from a clean slate in case we are run more than once in a process
+    global mrca_rates
+    mrca_rates = {}
+    if rate_engine == "lazy":
+        if rates_cache:
+            logger.info("Ignoring --rates-cache with the lazy rate engine")
+        mrca_rates = lazy_precalcs(taxonomy, tree, min_ccp, yule=yule, fallback=fallback, warm_start=warm_start)
+    else:
+        rates = None
+        if rates_cache:
+            digest = rates_digest(
+                taxonomy_digest.hexdigest(),
+                backbone_digest.hexdigest(),
+                min_ccp,
+                yule,
+                fallback,
+                warm_start,
+                rate_engine,
+                get_backend(),
+            )
+            rates = read_rates_cache(rates_cache, digest, taxonomy)
+        if rates is None:
+            rates = run_precalcs(
+                taxonomy,
+                tree,
+                min_ccp,
+                yule=yule,
+                fallback=fallback,
+                warm_start=warm_start,
+                engine=rate_engine,
+                cores=cores,
+            )
+            if rates_cache:
+                write_rates_cache(rates_cache, digest, rates)
+        else:
+            mrca_rates.update(rates)
+        write_rates(output + ".rates.csv", rates)
+
+    seeds = replicate_seeds(seed, replicates)
+    if replicates == 1:
+        random.seed(seeds[0])
+        add_taxa_in_units(taxonomy, tree, min_ccp, cores)
+        tree.ladderize()
+        tree.write(path=output + ".newick.tre", schema="newick", suppress_rooting=True)
+        tree.write(path=output + ".nexus.tre", schema="nexus")
+    else:
+        # Graft onto a fresh copy of the backbone each time, so the original
+        # stays intact for the next replicate (and for lazily estimated rates)
+        taxa_block = dendropy.TreeList(taxon_namespace=tn).as_string(schema="nexus")
+        with open(output + ".newick.tre", "w") as newick_file, open(output + ".nexus.tre", "w") as nexus_file:
+            nexus_file.write(taxa_block[: taxa_block.index("BEGIN TREES;")] + "BEGIN TREES;\n")
+            for replicate, (newick, rates) in enumerate(generate_replicates(taxonomy, tree, min_ccp, seeds, cores), 1):
+                newick_file.write(newick)
+                nexus_file.write(f"    TREE {replicate} = [&R] {newick}")
+                if rates is not None:
+                    # Rates estimated lazily in a worker process
+                    mrca_rates.update(rates)
+            nexus_file.write("END;\n")
+    if rate_engine == "lazy":
+        logger.info(f"Estimated rates for {len(mrca_rates)} of {len(mrca_rates.nodes)} taxa")
+        logger.debug(f"Rate cache: {mrca_rates.cache}")
+        write_rates(output + ".rates.csv", mrca_rates)
     print()
 
 
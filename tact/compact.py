@@ -0,0 +1,807 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, array-backed trees for grafting taxa.
+
+A `CompactTree` keeps its topology in parent, first-child and next-sibling
+arrays of node numbers, alongside arrays of node ages, edge lengths and taxon
+ids and a bitmap of locked edges, instead of a web of DendroPy `Node`, `Edge`
+and `Bipartition` objects. Trees are converted from and to DendroPy with
+`CompactTree.from_dendropy` and `CompactTree.to_dendropy` when they are read
+and written.
+
+Nodes are plain integers. The edge subtending a node is identified with the
+node. `CompactNode` wraps a node in a small object with a DendroPy-like
+interface, for convenience.
+"""
+from __future__ import division
+
+import bisect
+import heapq
+import itertools
+import random
+from array import array
+from math import isnan
+
+import dendropy
+
+from .lib import count_bits
+from .lib import is_locked
+from .lib import map_taxa
+from .lib import require_taxa
+
+# Stands for a missing parent, child, sibling or taxon
+NO_NODE = -1
+
+# How nodes were created, as recorded in the "creation_method" annotation
+CREATION_METHODS = (None, "fill_new_taxa", "create_clade")
+FILL_NEW_TAXA = 1
+CREATE_CLADE = 2
+
+
+class CompactTree(object):
+    """
+    A tree stored in arrays indexed by node number. Besides the topology,
+    ages, edge lengths and taxa, each node keeps the number of leaves below
+    it, the number of locked and unlocked edges below it and the youngest
+    age of a node under an unlocked edge, which are kept up to date as nodes
+    are grafted and clades locked. `mask` is a bitmask of the taxon ids in
+    the tree, and `tips` the number of them. The sorted internal node ages
+    of the clades `get_ages` has been asked about are kept in `age_lists`,
+    and also kept up to date as nodes are grafted.
+
+    Taxon ids are positions in the taxon namespace, so a taxon's bit in
+    `mask` is the same as in the namespace's own bitmasks. `taxa_by_label`
+    is the namespace's `map_taxa`, built once for looking up taxa by label.
+    """
+
+    __slots__ = (
+        "namespace",
+        "taxa",
+        "taxon_ids",
+        "taxa_by_label",
+        "is_rooted",
+        "root",
+        "parent",
+        "first_child",
+        "next_sibling",
+        "age",
+        "length",
+        "taxon",
+        "created",
+        "leaves",
+        "locked_edges",
+        "unlocked_edges",
+        "youngest_unlocked",
+        "lock_bits",
+        "leaf_of",
+        "labels",
+        "edge_labels",
+        "mask",
+        "tips",
+        "age_lists",
+    )
+
+    def __init__(self, namespace, is_rooted=True):
+        self.namespace = namespace
+        self.taxa = list(namespace)
+        self.taxon_ids = {x: i for i, x in enumerate(self.taxa)}
+        self.taxa_by_label = map_taxa(namespace)
+        self.is_rooted = is_rooted
+        self.root = NO_NODE
+        self.parent = array("i")
+        self.first_child = array("i")
+        self.next_sibling = array("i")
+        self.age = array("d")
+        self.length = array("d")
+        self.taxon = array("i")
+        self.created = array("b")
+        self.leaves = array("i")
+        self.locked_edges = array("i")
+        self.unlocked_edges = array("i")
+        self.youngest_unlocked = array("d")
+        self.lock_bits = bytearray()
+        self.leaf_of = array("i", [NO_NODE] * len(self.taxa))
+        # Labels are rare, so they are kept by node
+        self.labels = {}
+        self.edge_labels = {}
+        self.mask = 0
+        self.tips = 0
+        self.age_lists = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def from_dendropy(cls, tree):
+        """
+        Converts a DendroPy tree, which must have its node ages calculated.
+        Locked edges (see `tact.lib.is_locked`), labels and "creation_method"
+        annotations are kept.
+        """
+        compact = cls(tree.taxon_namespace, tree.is_rooted)
+        index = {}
+        for node in tree.preorder_node_iter():
+            created = CREATION_METHODS.index(node.annotations.get_value("creation_method"))
+            i = compact.new_node(node.age, compact.taxon_id(node.taxon), node.edge.length, created)
+            index[node] = i
+            if node.label is not None:
+                compact.labels[i] = node.label
+            if node.edge.label is not None:
+                compact.edge_labels[i] = node.edge.label
+            if is_locked(node.edge):
+                compact.lock_bits[i >> 3] |= 1 << (i & 7)
+            if node.parent_node is not None:
+                compact.append_child(index[node.parent_node], i)
+        compact.root = index[tree.seed_node]
+        compact.recount_below(compact.root)
+        compact.mask = compact.taxa_below(compact.root)
+        compact.tips = count_bits(compact.mask)
+        return compact
+
+    def to_dendropy(self, tree=None):
+        """
+        Converts to a DendroPy tree on the same taxon namespace. If `tree` is
+        given, its nodes are replaced in place. Bipartitions are not encoded.
+        """
+        if tree is None:
+            tree = dendropy.Tree(taxon_namespace=self.namespace, is_rooted=self.is_rooted)
+        else:
+            tree.seed_node.clear_child_nodes()
+        seed = tree.seed_node
+        seed.taxon = None
+        seed.annotations.clear()
+        nodes = {self.root: seed}
+        for i in self.preorder(self.root):
+            if i == self.root:
+                node = seed
+            else:
+                node = nodes[self.parent[i]].new_child()
+                nodes[i] = node
+            if self.taxon[i] != NO_NODE:
+                node.taxon = self.taxa[self.taxon[i]]
+            node.label = self.labels.get(i)
+            node.age = self.age[i]
+            node.edge.length = None if isnan(self.length[i]) else self.length[i]
+            node.edge.label = self.edge_labels.get(i)
+            if self.is_locked(i):
+                node.edge.locked = True
+            if self.created[i]:
+                node.annotations.add_new("creation_method", CREATION_METHODS[self.created[i]])
+        return tree
+
+    def node(self, i):
+        """Wraps node `i` in a `CompactNode`."""
+        return CompactNode(self, i)
+
+    # Taxa
+
+    def taxon_id(self, taxon):
+        """Returns the id of a DendroPy `taxon` (NO_NODE for None)."""
+        if taxon is None:
+            return NO_NODE
+        if taxon not in self.taxon_ids:
+            self.add_namespace_taxa()
+        return self.taxon_ids[taxon]
+
+    def add_namespace_taxa(self):
+        """Gives ids to the taxa added to the namespace since we last looked."""
+        key = str if self.namespace.is_case_sensitive else str.lower
+        # Ids are namespace positions, so new taxa are at the end
+        for x in self.namespace[len(self.taxa) :]:
+            self.taxon_ids[x] = len(self.taxa)
+            self.taxa.append(x)
+            self.leaf_of.append(NO_NODE)
+            if x.label is not None:
+                self.taxa_by_label.setdefault(key(x.label), x)
+
+    def require_taxa(self, labels):
+        """Returns the ids of the taxa with the given `labels`, creating any that are missing."""
+        if len(self.namespace) != len(self.taxa):
+            self.add_namespace_taxa()
+        return [self.taxon_id(x) for x in require_taxa(self.namespace, labels, self.taxa_by_label)]
+
+    def labels_of(self, mask):
+        """Returns the labels of the taxa in the bitmask `mask`, in id order."""
+        labels = []
+        while mask:
+            bit = mask & -mask
+            labels.append(self.taxa[bit.bit_length() - 1].label)
+            mask ^= bit
+        return labels
+
+    def taxa_below(self, i):
+        """Returns the bitmask of the taxa at or below node `i`."""
+        # Setting bits one at a time in an int copies it each time, which is
+        # quadratic in big trees, so they are set in a bytearray instead
+        ids = [self.taxon[x] for x in self.preorder(i) if self.taxon[x] != NO_NODE]
+        if not ids:
+            return 0
+        bits = bytearray((max(ids) >> 3) + 1)
+        for x in ids:
+            bits[x >> 3] |= 1 << (x & 7)
+        return int.from_bytes(bits, "little")
+
+    # Structure
+
+    def new_node(self, age=0.0, taxon=NO_NODE, length=None, created=0):
+        """Adds a node with no parent or children and returns its number."""
+        i = len(self.parent)
+        self.parent.append(NO_NODE)
+        self.first_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        self.age.append(age)
+        self.length.append(float("nan") if length is None else length)
+        self.taxon.append(taxon)
+        self.created.append(created)
+        self.leaves.append(1)
+        self.locked_edges.append(0)
+        self.unlocked_edges.append(0)
+        self.youngest_unlocked.append(float("inf"))
+        if not i & 7:
+            self.lock_bits.append(0)
+        if taxon != NO_NODE:
+            self.leaf_of[taxon] = i
+        return i
+
+    def children(self, i):
+        """Returns the children of node `i`, in order."""
+        children = []
+        child = self.first_child[i]
+        while child != NO_NODE:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    def append_child(self, i, child):
+        """Makes `child` the last child of node `i`. Counts are not updated."""
+        self.parent[child] = i
+        self.next_sibling[child] = NO_NODE
+        last = self.first_child[i]
+        if last == NO_NODE:
+            self.first_child[i] = child
+            return
+        while self.next_sibling[last] != NO_NODE:
+            last = self.next_sibling[last]
+        self.next_sibling[last] = child
+
+    def set_children(self, i, children):
+        """Replaces the children of node `i`. Counts are not updated."""
+        previous = NO_NODE
+        for child in children:
+            self.parent[child] = i
+            if previous == NO_NODE:
+                self.first_child[i] = child
+            else:
+                self.next_sibling[previous] = child
+            previous = child
+        if previous == NO_NODE:
+            self.first_child[i] = NO_NODE
+        else:
+            self.next_sibling[previous] = NO_NODE
+
+    def preorder(self, i):
+        """Iterates over node `i` and its descendants in preorder."""
+        # Follow the links rather than keep a stack, which would need a
+        # list of children for every node
+        first_child = self.first_child
+        next_sibling = self.next_sibling
+        parent = self.parent
+        x = i
+        while True:
+            yield x
+            if first_child[x] != NO_NODE:
+                x = first_child[x]
+                continue
+            while x != i and next_sibling[x] == NO_NODE:
+                x = parent[x]
+            if x == i:
+                return
+            x = next_sibling[x]
+
+    def edges(self, i):
+        """
+        Iterates over the edges below node `i`, in the same order as
+        `tact.lib.edge_iter`.
+        """
+        stack = self.children(i)
+        while stack:
+            x = stack.pop()
+            yield x
+            stack.extend(self.children(x))
+
+    def get_ages(self, i, include_root=False):
+        """Returns the ages of the internal nodes at and below node `i`, oldest first."""
+        ages = self.age_lists.get(i)
+        if ages is None:
+            ages = sorted(self.age[x] for x in self.preorder(i) if self.first_child[x] != NO_NODE)
+            self.age_lists[i] = ages
+        ages = ages[::-1]
+        if include_root:
+            ages.append(self.age[i])
+        return ages
+
+    def add_ages(self, graft, focal):
+        """
+        Inserts the internal node ages of the subtree of `graft`, which has
+        just been spliced above `focal`, into the age lists of its ancestors,
+        and starts one for `graft` if `focal` has one.
+        """
+        if not self.age_lists:
+            return
+        added = [self.age[graft]]
+        for child in self.children(graft):
+            if child != focal:
+                added.extend(self.age[x] for x in self.preorder(child) if self.first_child[x] != NO_NODE)
+        if focal in self.age_lists:
+            ages = list(self.age_lists[focal])
+            for age in added:
+                bisect.insort(ages, age)
+            self.age_lists[graft] = ages
+        x = self.parent[graft]
+        while x != NO_NODE:
+            ages = self.age_lists.get(x)
+            if ages is not None:
+                for age in added:
+                    bisect.insort(ages, age)
+            x = self.parent[x]
+
+    def is_binary(self, i):
+        """Is the subtree under node `i` fully bifurcating?"""
+        for x in self.preorder(i):
+            if self.first_child[x] != NO_NODE and len(self.children(x)) != 2:
+                return False
+        return True
+
+    def count_short_branches(self, i, threshold=0.001):
+        """Number of edges below node `i` no longer than `threshold`."""
+        return sum(1 for x in self.edges(i) if self.length[x] <= threshold)
+
+    def get_monophyletic(self, mask):
+        """
+        Returns the most recent common ancestor of the taxa in the non-empty
+        bitmask `mask`, all of which must be in the tree, if no other taxa
+        descend from it. Otherwise returns None.
+        """
+        n = count_bits(mask)
+        node = self.leaf_of[(mask & -mask).bit_length() - 1]
+        while self.leaves[node] < n and self.parent[node] != NO_NODE:
+            node = self.parent[node]
+        if self.leaves[node] != n:
+            return None
+        for x in self.preorder(node):
+            if self.first_child[x] == NO_NODE and not (self.taxon[x] != NO_NODE and mask >> self.taxon[x] & 1):
+                return None
+        return node
+
+    # Grafting
+
+    def splice(self, focal, graft):
+        """
+        Grafts the detached node `graft` onto the edge subtending `focal`,
+        which becomes the last child of `graft`, with `graft` taking the
+        place of `focal` as the last child of its parent. `graft` must be
+        older than `focal` and younger than its parent.
+        """
+        seed = self.parent[focal]
+        graft_length = self.age[seed] - self.age[graft]
+        focal_length = self.age[graft] - self.age[focal]
+        if graft_length < 0 or focal_length < 0:
+            raise Exception("negative branch length")
+        added = self.taxa_below(graft)
+        self.set_children(seed, [x for x in self.children(seed) if x != focal] + [graft])
+        self.length[graft] = graft_length
+        self.append_child(graft, focal)
+        self.length[focal] = focal_length
+        self.recount_up(graft)
+        self.add_ages(graft, focal)
+        self.mask |= added
+        self.tips += count_bits(added)
+
+    def replace(self, i, new):
+        """
+        Puts the detached node `new` in place of node `i`, which is detached
+        along with its subtree. The taxa below `new` are added to `mask`.
+        """
+        parent = self.parent[i]
+        self.set_children(parent, [new if x == i else x for x in self.children(parent)])
+        self.age_lists.clear()
+        self.parent[i] = NO_NODE
+        self.next_sibling[i] = NO_NODE
+        self.mask &= ~self.taxa_below(i)
+        self.mask |= self.taxa_below(new)
+        self.tips = count_bits(self.mask)
+        for x in self.preorder(new):
+            if self.taxon[x] != NO_NODE:
+                self.leaf_of[self.taxon[x]] = x
+        self.recount_below(new)
+        self.recount_up(parent)
+
+    def clade(self, i):
+        """
+        Copies the clade descending from node `i` into a new tree on the same
+        namespace, whose root stands in for the parent of `i`, with its age,
+        so the clade keeps its stem.
+        """
+        clade = CompactTree(self.namespace, self.is_rooted)
+        clade.root = clade.new_node(self.age[self.parent[i]])
+        clade.unpack(self.pack(self.parent[i], [i]), clade.root)
+        clade.recount_below(clade.root)
+        clade.mask = clade.taxa_below(clade.root)
+        clade.tips = count_bits(clade.mask)
+        return clade
+
+    def pack(self, i, children=None):
+        """
+        Flattens the nodes below node `i` (or only the subtrees of
+        `children`, if given) into a preorder tuple of arrays and labels,
+        which are cheap to send between processes, for `unpack`.
+        """
+        nodes = []
+        for child in self.children(i) if children is None else children:
+            nodes.extend(self.preorder(child))
+        position = {x: n for n, x in enumerate(nodes)}
+        parents = array("i", [position.get(self.parent[x], NO_NODE) for x in nodes])
+        ages = array("d", [self.age[x] for x in nodes])
+        lengths = array("d", [self.length[x] for x in nodes])
+        taxa = [self.taxa[self.taxon[x]].label if self.taxon[x] != NO_NODE else None for x in nodes]
+        created = array("b", [self.created[x] for x in nodes])
+        locked = [n for n, x in enumerate(nodes) if self.is_locked(x)]
+        labels = {position[x]: label for x, label in self.labels.items() if x in position}
+        edge_labels = {position[x]: label for x, label in self.edge_labels.items() if x in position}
+        return (parents, ages, lengths, taxa, created, locked, labels, edge_labels)
+
+    def unpack(self, packed, i=NO_NODE):
+        """
+        Rebuilds the nodes flattened by `pack`, as children of node `i` if it
+        is given. Returns the nodes that were directly below the packed node.
+        Counts are not updated.
+        """
+        parents, ages, lengths, taxa, created, locked, labels, edge_labels = packed
+        if i != NO_NODE:
+            self.age_lists.clear()
+        ids = iter(self.require_taxa([x for x in taxa if x is not None]))
+        first = len(self)
+        top = []
+        for parent, age, length, taxon, method in zip(parents, ages, lengths, taxa, created):
+            x = self.new_node(age, NO_NODE if taxon is None else next(ids), length, method)
+            if parent == NO_NODE:
+                top.append(x)
+                if i != NO_NODE:
+                    self.append_child(i, x)
+            else:
+                self.append_child(first + parent, x)
+        for n in locked:
+            self.lock_bits[(first + n) >> 3] |= 1 << ((first + n) & 7)
+        self.labels.update((first + n, label) for n, label in labels.items())
+        self.edge_labels.update((first + n, label) for n, label in edge_labels.items())
+        return top
+
+    # Counts and locks
+
+    def is_locked(self, i):
+        """Whether the edge subtending node `i` is locked."""
+        return bool(self.lock_bits[i >> 3] & (1 << (i & 7)))
+
+    def recount(self, i):
+        """Recomputes the counts of node `i` from those of its children."""
+        child = self.first_child[i]
+        if child == NO_NODE:
+            self.leaves[i] = 1
+            self.locked_edges[i] = 0
+            self.unlocked_edges[i] = 0
+            self.youngest_unlocked[i] = float("inf")
+            return
+        leaves = 0
+        locked = 0
+        unlocked = 0
+        youngest = float("inf")
+        while child != NO_NODE:
+            leaves += self.leaves[child]
+            locked += self.locked_edges[child]
+            unlocked += self.unlocked_edges[child]
+            youngest = min(youngest, self.youngest_unlocked[child])
+            if self.is_locked(child):
+                locked += 1
+            else:
+                unlocked += 1
+                youngest = min(youngest, self.age[child])
+            child = self.next_sibling[child]
+        self.leaves[i] = leaves
+        self.locked_edges[i] = locked
+        self.unlocked_edges[i] = unlocked
+        self.youngest_unlocked[i] = youngest
+
+    def recount_up(self, i):
+        """Recomputes the counts of node `i` and its ancestors."""
+        while i != NO_NODE:
+            self.recount(i)
+            i = self.parent[i]
+
+    def recount_below(self, i):
+        """Recomputes the counts of node `i` and its descendants."""
+        for x in reversed(list(self.preorder(i))):
+            self.recount(x)
+
+    def lock_clade(self, i):
+        """
+        Locks every edge below node `i`, so that nothing else can be grafted
+        inside the clade. Subtrees that are already fully locked are skipped.
+        """
+        stack = [i]
+        while stack:
+            x = stack.pop()
+            if not self.unlocked_edges[x]:
+                continue
+            for child in self.children(x):
+                self.lock_bits[child >> 3] |= 1 << (child & 7)
+                stack.append(child)
+            self.locked_edges[x] += self.unlocked_edges[x]
+            self.unlocked_edges[x] = 0
+            self.youngest_unlocked[x] = float("inf")
+        self.recount_up(self.parent[i])
+
+    def is_fully_locked(self, i):
+        """Whether every edge below node `i` is locked."""
+        return self.unlocked_edges[i] == 0
+
+    def get_min_age(self, i):
+        """The age of the youngest node below an unlocked edge under node `i`, or 0 if there is none."""
+        if not self.unlocked_edges[i]:
+            return 0.0
+        return self.youngest_unlocked[i]
+
+
+class CompactNode(object):
+    """A node of a `CompactTree`, with a DendroPy-like interface."""
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return f"<CompactNode {self.index}: {self.label!r} ({self.taxon!r})>"
+
+    @property
+    def age(self):
+        return self.tree.age[self.index]
+
+    @property
+    def edge_length(self):
+        length = self.tree.length[self.index]
+        return None if isnan(length) else length
+
+    @property
+    def taxon(self):
+        taxon = self.tree.taxon[self.index]
+        return None if taxon == NO_NODE else self.tree.taxa[taxon]
+
+    @property
+    def label(self):
+        return self.tree.labels.get(self.index)
+
+    @property
+    def parent_node(self):
+        parent = self.tree.parent[self.index]
+        return None if parent == NO_NODE else CompactNode(self.tree, parent)
+
+    @property
+    def locked(self):
+        return self.tree.is_locked(self.index)
+
+    def child_nodes(self):
+        return [CompactNode(self.tree, x) for x in self.tree.children(self.index)]
+
+    def is_leaf(self):
+        return self.tree.first_child[self.index] == NO_NODE
+
+    def leaf_nodes(self):
+        return [CompactNode(self.tree, x) for x in self.tree.preorder(self.index) if self.tree.first_child[x] == NO_NODE]
+
+    def preorder_iter(self):
+        return (CompactNode(self.tree, x) for x in self.tree.preorder(self.index))
+
+
+def get_ages(tree, node, include_root=False):
+    """
+    Returns the ages of the internal nodes of the subtree descending from
+    `node`, oldest first, like `tact.lib.get_ages`.
+    """
+    return tree.get_ages(node, include_root)
+
+
+def graft_node(tree, graft_recipient, graft, stem=False):
+    """
+    Grafts the detached node `graft` randomly in the subtree below node
+    `graft_recipient`. The age of `graft` must be set, as must the ages and
+    edge lengths of any nodes below it. Returns the (potentially new) crown
+    of the clade. This is `graft_nodes` with a single graft, so only the
+    part of the clade older than `graft` is searched, and fully locked
+    subtrees are skipped.
+    """
+    return graft_nodes(tree, graft_recipient, [graft], stem)
+
+
+def graft_nodes(tree, graft_recipient, grafts, stem=False):
+    """
+    Grafts each of the detached nodes `grafts` randomly in the subtree below
+    node `graft_recipient`, oldest first, as for `graft_node`. Instead of
+    searching the clade for every graft, one sweep from the oldest graft age
+    to the youngest keeps track of the unlocked edges spanning the current
+    age, including those created by earlier grafts. Returns the (potentially
+    new) crown of the clade.
+    """
+    # We graft things "below" a node by picking one of the children
+    # of that node and forcing it to be sister to the grafted node
+    # and adjusting the edge lengths accordingly. Therefore, the node
+    # *above* which the graft lives (i.e., the one that will be the child
+    # of the new graft) must fulfill the following requirements:
+    #
+    # 1. Must not be the crown node (cannot graft things above crown node)
+    # 2. Must be younger than the graft node (no negative branches)
+    # 3. Seed node must be older than graft node (no negative branches)
+    # 4. Must not be locked (intruding on monophyly)
+    #
+    # With `stem`, the crown node's subtending edge is also eligible.
+    crown = graft_recipient
+    # Nodes whose unlocked edges span the current age, with their positions
+    # so they can be swapped out in constant time
+    eligible_nodes = []
+    position = {}
+
+    def enter(x):
+        if not tree.is_locked(x) and x not in position:
+            position[x] = len(eligible_nodes)
+            eligible_nodes.append(x)
+
+    def leave(x):
+        pos = position.pop(x, None)
+        if pos is not None:
+            last = eligible_nodes.pop()
+            if last != x:
+                eligible_nodes[pos] = last
+                position[last] = pos
+
+    # Nodes whose child edges start spanning the sweep once it reaches their
+    # age, oldest first. An entry without a node stands for the top of the
+    # clade, whose edges start at the crown (or at its parent, with `stem`)
+    counter = itertools.count()
+    if stem and tree.parent[crown] != NO_NODE:
+        pending = [(-tree.age[tree.parent[crown]], next(counter), NO_NODE, [crown])]
+    else:
+        pending = [(-tree.age[crown], next(counter), NO_NODE, tree.children(crown))]
+    # Nodes reached at exactly the current age, whose own edges still span it
+    tied = []
+
+    def expand(node, heads, age):
+        if node != NO_NODE:
+            if tree.age[node] > age:
+                leave(node)
+            else:
+                tied.append(node)
+        for head in heads:
+            enter(head)
+            unlocked = tree.unlocked_edges[head]
+            if tree.first_child[head] != NO_NODE and (unlocked or not tree.is_locked(head)):
+                # Nothing below a fully locked node is eligible, but its own
+                # edge still stops spanning the sweep at its age
+                below = tree.children(head) if unlocked else []
+                heapq.heappush(pending, (-tree.age[head], next(counter), head, below))
+
+    for graft in sorted(grafts, key=lambda x: tree.age[x], reverse=True):
+        age = tree.age[graft]
+        for node in tied:
+            if tree.age[node] > age:
+                leave(node)
+        tied = [x for x in tied if tree.age[x] <= age]
+        while pending and -pending[0][0] >= age:
+            _, _, node, heads = heapq.heappop(pending)
+            expand(node, heads, age)
+
+        if not eligible_nodes:
+            raise Exception(f"could not place node {graft} in clade {crown}")
+        focal_node = random.choice(eligible_nodes)
+        tree.splice(focal_node, graft)
+        if focal_node == crown:
+            crown = graft
+        # The focal node's edge now ends at the graft, and still spans this age
+        expand(graft, [x for x in tree.children(graft) if x != focal_node], age)
+        enter(graft)
+    return crown
+
+
+def fill_new_taxa(tree, node, new_taxa, times, stem=False):
+    """
+    Grafts a new species for each label in `new_taxa` in the clade below
+    node `node`, branching off at the corresponding age in `times`. Returns
+    the (potentially new) crown of the clade.
+    """
+    grafts = []
+    for new_taxon, new_age in zip(tree.require_taxa(new_taxa), times):
+        new_node = tree.new_node(new_age, created=FILL_NEW_TAXA)
+        new_leaf = tree.new_node(0.0, new_taxon, new_age, FILL_NEW_TAXA)
+        tree.append_child(new_node, new_leaf)
+        tree.recount(new_node)
+        grafts.append(new_node)
+    return graft_nodes(tree, node, grafts, stem)
+
+
+def create_clade(tree, species, ages):
+    """
+    Creates a detached clade of `species` in `tree` with a random ranked
+    topology whose nodes have the given `ages`, and returns its stem node,
+    which has the oldest age. The clade below the stem is locked.
+    """
+    # Sort so that seeded runs do not depend on set iteration order
+    species = sorted(species)
+    ages.sort(reverse=True)
+    # need to generate the "stem node"
+    seed = tree.new_node(ages.pop(0), created=CREATE_CLADE)
+    # clade of size 1?
+    if not ages:
+        taxon = tree.require_taxa(species[:1])[0]
+        tree.append_child(seed, tree.new_node(0.0, taxon, tree.age[seed], CREATE_CLADE))
+        tree.recount(seed)
+        return seed
+    node = tree.new_node(ages.pop(0), created=CREATE_CLADE)
+    tree.append_child(seed, node)
+
+    # From the oldest age to the youngest, attach each new node to one chosen
+    # uniformly from the strictly older nodes that have fewer than two
+    # children, kept in a list with their positions
+    internal_nodes = [node]
+    n_children = {node: 0}
+    open_nodes = []
+    position = {}
+    # Nodes as old as the one being attached, which cannot be its parent yet
+    waiting = [node]
+    for age in ages:
+        still_waiting = []
+        for x in waiting:
+            if tree.age[x] > age:
+                position[x] = len(open_nodes)
+                open_nodes.append(x)
+            else:
+                still_waiting.append(x)
+        waiting = still_waiting
+        assert len(open_nodes) > 0
+        node = random.choice(open_nodes)
+        child = tree.new_node(age, created=CREATE_CLADE)
+        tree.append_child(node, child)
+        n_children[node] += 1
+        n_children[child] = 0
+        if n_children[node] == 2:
+            last = open_nodes.pop()
+            if last != node:
+                open_nodes[position[node]] = last
+                position[last] = position[node]
+            del position[node]
+        waiting.append(child)
+        internal_nodes.append(child)
+
+    # Fill the free slots with species in random order
+    n_species = len(species)
+    random.shuffle(species)
+    taxa = tree.require_taxa(species)
+    for node in internal_nodes:
+        while n_children[node] < 2 and taxa:
+            tree.append_child(node, tree.new_node(0.0, taxa.pop(), created=CREATE_CLADE))
+            n_children[node] += 1
+    for x in tree.edges(seed):
+        tree.length[x] = tree.age[tree.parent[x]] - tree.age[x]
+        if tree.length[x] < 0:
+            raise ValueError(f"Negative edge length: {tree.length[x]}")
+    tree.recount_below(seed)
+    assert n_species == tree.leaves[seed]
+    assert len(tree.children(seed)) == 1
+    assert tree.is_binary(tree.first_child[seed])
+    # Lock the child of the seed node so that things can still attach to the stem of this new clade
+    tree.lock_clade(tree.first_child[seed])
+    return seed
@@ -1,7 +1,6 @@
 # fastMRCA functions
 from __future__ import division
 
-from .lib import get_tip_labels
 
 global tree
 
@@ -25,12 +24,20 @@ def bitmask(labels):
 
 def get(labels):
     """Pulls a MRCA node out for the taxa in `labels`."""
+    return get_bitmask(bitmask(set(labels)))
+
+
+def get_bitmask(leafset_bitmask):
+    """
+    Pulls a MRCA node out for the taxa in the bitmask `leafset_bitmask`, if
+    they are monophyletic.
+    """
     global tree
-    labels = set(labels)
-    mrca = tree.mrca(leafset_bitmask=bitmask(labels))
+    mrca = tree.mrca(leafset_bitmask=leafset_bitmask)
     if not mrca:
         return None
-    if mrca and labels.issuperset(get_tip_labels(mrca)):
+    # Monophyletic if the MRCA has no other leaves
+    if mrca.edge.bipartition.leafset_bitmask & ~leafset_bitmask == 0:
         return mrca
 
 
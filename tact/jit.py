@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Numba-compiled versions of the numerical kernels in `tact.lib`.
+
+This module is only importable when the optional numba dependency is installed
+(`pip install tact[jit]`); `tact.lib` uses it automatically when it is.
+"""
+from __future__ import division
+
+import math
+import sys
+
+import numpy as np
+from numba import njit, vectorize
+
+FLOAT_MAX = sys.float_info.max
+SIGNATURES = ["float64(float64, float64, float64, float64)"]
+
+
+@njit(cache=True)
+def decay_terms(t, l, m):
+    """Scalar version of `tact.lib.decay_terms`."""
+    r = l - m
+    x = abs(r) * t
+    g = math.exp(-x)
+    # t * exprel(-x), written out since numba does not support scipy.special
+    h = t if x == 0 else t * (math.expm1(-x) / -x)
+    return r, g, h
+
+
+@njit(cache=True)
+def p0_scalar(t, l, m, rho):
+    r, g, h = decay_terms(t, l, m)
+    if r >= 0:
+        return 1 - rho / (rho * l * h + g)
+    return 1 - rho * g / (rho * l * h + 1)
+
+
+@njit(cache=True)
+def p1_scalar(t, l, m, rho):
+    r, g, h = decay_terms(t, l, m)
+    denom = rho * l * h + (g if r >= 0 else 1)
+    if abs(r) * t > 700:
+        # g is subnormal, so avoid multiplying by it
+        return math.exp(math.log(rho) - abs(r) * t - 2 * math.log(denom))
+    return rho * g / (denom * denom)
+
+
+@njit(cache=True)
+def intp1_scalar(t, l, m):
+    r, _, h = decay_terms(t, l, m)
+    return h / (1 + (m if r >= 0 else l) * h)
+
+
+@vectorize(SIGNATURES, cache=True)
+def p0_ufunc(t, l, m, rho):
+    return p0_scalar(t, l, m, rho)
+
+
+@vectorize(SIGNATURES, cache=True)
+def p1_ufunc(t, l, m, rho):
+    return p1_scalar(t, l, m, rho)
+
+
+@vectorize(["float64(float64, float64, float64)"], cache=True)
+def intp1_ufunc(t, l, m):
+    return intp1_scalar(t, l, m)
+
+
+# Compiled ufuncs report floating point errors to NumPy like any other, and
+# `tact.lib` raises on all of them, so let the exponentials underflow quietly
+
+
+def p0(t, l, m, rho):
+    """Compiled `tact.lib.p0`. Accepts NumPy arrays."""
+    with np.errstate(under="ignore"):
+        return p0_ufunc(t, l, m, rho)[()]
+
+
+def p1(t, l, m, rho):
+    """Compiled `tact.lib.p1`. Accepts NumPy arrays."""
+    with np.errstate(under="ignore"):
+        return p1_ufunc(t, l, m, rho)[()]
+
+
+def intp1(t, l, m):
+    """Compiled `tact.lib.intp1`. Accepts NumPy arrays."""
+    with np.errstate(under="ignore"):
+        return intp1_ufunc(t, l, m)[()]
+
+
+@njit(cache=True)
+def lik_constant(l, m, rho, t, root, survival):
+    """
+    Compiled loop of `tact.lib.lik_constant`. `t` must be a NumPy array of
+    waiting times sorted from oldest to youngest. Returns the negative
+    log-likelihood, or FLOAT_MAX where the likelihood is zero or undefined.
+    """
+    p = p1_scalar(t[0], l, m, rho)
+    if not p > 0:
+        return FLOAT_MAX
+    lik = (root + 1) * math.log(p)
+    for i in range(1, len(t)):
+        p = p1_scalar(t[i], l, m, rho)
+        if not p > 0 or not l > 0:
+            return FLOAT_MAX
+        lik += math.log(l) + math.log(p)
+    if survival == 1:
+        q = 1 - p0_scalar(t[0], l, m, rho)
+        if not q > 0:
+            return FLOAT_MAX
+        lik -= (root + 1) * math.log(q)
+    return -lik
+
+
+@njit(cache=True, error_model="numpy")
+def lik_constant_ra_loop(r, a, rho, t, root, survival):
+    """Returns the log-likelihood and its gradient for `lik_constant_ra`."""
+    n = len(t) - 1
+    c = 1 - rho - a
+    log_rho = math.log(rho)
+    log_1ma = math.log(1 - a)
+    ert = math.exp(-r * t[0])
+    denom = rho + c * ert
+    q = ert / denom
+    lik = (root + 1) * (log_rho - r * t[0] + 2 * log_1ma - 2 * math.log(denom))
+    lik += n * (math.log(r) + log_1ma + log_rho)
+    dr = (root + 1) * t[0] * (2 * c * q - 1) + n / r
+    da = 2 * (root + 1) * (q - 1 / (1 - a)) - n / (1 - a)
+    if survival == 1:
+        lik -= (root + 1) * (log_rho + log_1ma - math.log(denom))
+        dr -= (root + 1) * c * t[0] * q
+        da -= (root + 1) * (q - 1 / (1 - a))
+    for i in range(1, len(t)):
+        ert = math.exp(-r * t[i])
+        denom = rho + c * ert
+        q = ert / denom
+        lik -= r * t[i] + 2 * math.log(denom)
+        dr += t[i] * (2 * c * q - 1)
+        da += 2 * q
+    return lik, dr, da
+
+
+def lik_constant_ra(x, rho, t, root=1, survival=1):
+    """Compiled `tact.lib.lik_constant_ra`."""
+    with np.errstate(under="ignore"):
+        lik, dr, da = lik_constant_ra_loop(
+            float(x[0]), float(x[1]), float(rho), np.ascontiguousarray(t, dtype=np.float64), int(root), int(survival)
+        )
+    if not (math.isfinite(lik) and math.isfinite(dr) and math.isfinite(da)):
+        return FLOAT_MAX, np.zeros(2)
+    return -lik, np.array([-dr, -da])
+
+
+@njit(cache=True, error_model="numpy")
+def lik_constant_ra_batch_loop(x, rho, t, clade, first, n, active, root, survival):
+    k = len(n)
+    # Per clade sums of the terms in t, log(D(t)) and their derivatives
+    sums = np.zeros((k, 7))
+    for i in range(len(t)):
+        j = clade[i]
+        if not active[j]:
+            continue
+        # Every term of the likelihood is a multiple of either log(D(t)) or t
+        if first[i]:
+            weight = (2 - survival) * (root + 1)
+            sums[j, 0] += (root + 1) * t[i]
+        else:
+            weight = 2
+            sums[j, 0] += t[i]
+        ert = math.exp(-x[j, 0] * t[i])
+        denom = rho[j] + (1 - rho[j] - x[j, 1]) * ert
+        q = ert / denom
+        wq = weight * q
+        wqd = wq * rho[j] * t[i] / denom
+        sums[j, 1] += weight * math.log(denom)
+        sums[j, 2] += wq * t[i]
+        sums[j, 3] += wq
+        sums[j, 4] += wqd * t[i]
+        sums[j, 5] += wqd
+        sums[j, 6] += wq * q
+
+    lik = np.zeros(k)
+    grad = np.zeros((k, 2))
+    hess = np.zeros((k, 2, 2))
+    for j in range(k):
+        if not active[j]:
+            continue
+        r, a = x[j, 0], x[j, 1]
+        c = 1 - rho[j] - a
+        n_rho = (root + 1) * (1 - survival) + n[j]
+        n_1ma = (2 - survival) * (root + 1) + n[j]
+        lik[j] = n_rho * math.log(rho[j]) + n_1ma * math.log(1 - a) + n[j] * math.log(r) - r * sums[j, 0] - sums[j, 1]
+        grad[j, 0] = n[j] / r - sums[j, 0] + c * sums[j, 2]
+        grad[j, 1] = sums[j, 3] - n_1ma / (1 - a)
+        hess[j, 0, 0] = -n[j] / r ** 2 - c * sums[j, 4]
+        hess[j, 0, 1] = hess[j, 1, 0] = -sums[j, 5]
+        hess[j, 1, 1] = sums[j, 6] - n_1ma / (1 - a) ** 2
+    return -lik, -grad, -hess
+
+
+def lik_constant_ra_batch(x, rho, packed, active=None, root=1, survival=1):
+    """Compiled `tact.lib.lik_constant_ra_batch`."""
+    t, clade, first, n = packed
+    if active is None:
+        active = np.ones(len(n), dtype=np.bool_)
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    rho = np.ascontiguousarray(rho, dtype=np.float64)
+    with np.errstate(under="ignore"):
+        return lik_constant_ra_batch_loop(x, rho, t, clade, first, n, active, int(root), int(survival))
@@ -2,19 +2,30 @@
 from __future__ import division
 
 import collections
+import os
+import platform
 import random
 import sys
-from decimal import Decimal as D
-from math import exp
-from math import log
+import warnings
+from math import exp, expm1, isfinite, log
 
 import dendropy
 import numpy as np
-from scipy.optimize import minimize, dual_annealing
+from scipy.optimize import brentq, minimize, dual_annealing
+from scipy.special import exprel
+
+try:
+    from . import jit
+except ImportError:
+    # numba is an optional extra
+    jit = None
 
 # Raise on overflow
 np.seterr(all="raise")
 
+# Running totals of optimizer work, for reporting
+optim_stats = collections.Counter()
+
 
 def get_bd(r, a):
     """Converts turnover and relative extinction to birth and death rates."""
@@ -36,21 +47,85 @@ def wrapped_lik_constant_yule(x, sampling, ages):
     return lik_constant(get_bd(x[0], 0), sampling, ages)
 
 
-def two_step_optim(func, x0, bounds, args):
-    """Tries to optimize function using the fast L-BFGS-B method, and if that fails, use simulated annealing."""
-    result = minimize(func, x0=x0, bounds=bounds, args=args, method="L-BFGS-B")
+def two_step_optim(func, x0, bounds, args, jac=None, fallback="grid", batch_func=None):
+    """
+    Tries to optimize function using the fast L-BFGS-B method, and if that fails, use either a grid search
+    or simulated annealing, depending on `fallback`.
+
+    If `jac` is True, `func` is assumed to return both the objective and its gradient. The grid search
+    requires `batch_func`, a version of `func` that evaluates an array of points at once.
+    """
+    if fallback not in ("grid", "annealing"):
+        raise ValueError(f"Unknown optimization fallback: {fallback}")
+    result = minimize(func, x0=x0, bounds=bounds, args=args, method="L-BFGS-B", jac=jac)
+    optim_stats["fits"] += 1
+    optim_stats["iterations"] += result["nit"]
     if result["success"]:
         return result["x"].tolist()
 
-    result = dual_annealing(func, x0=x0, bounds=bounds, args=args)
+    optim_stats[f"{fallback} fallbacks"] += 1
+    if fallback == "grid" and batch_func is not None:
+        return grid_optim(func, batch_func, bounds, args, jac=jac)
+
+    def value_only(x, *args):
+        return func(x, *args)[0]
+
+    objective = value_only if jac is True else func
+    result = dual_annealing(objective, x0=x0, bounds=bounds, args=args)
     if result["success"]:
         return result["x"].tolist()
 
     raise Exception(f"Optimization failed: {result['message']} (code {result['status']})")
 
 
-def optim_bd(ages, sampling, min_bound=1e-9):
-    """Optimizes birth death using Scipy"""
+def grid_optim(func, batch_func, bounds, args, jac=None, points=16, levels=4):
+    """
+    Minimizes a function by evaluating `batch_func` over a grid of `points` per
+    dimension spanning `bounds`, zooming in on the best grid point `levels`
+    times, and finally polishing that point with L-BFGS-B using `func`.
+    Dimensions with a positive lower bound are searched on a log scale.
+
+    Each level is a single call to `batch_func`, so the cost is fixed no matter
+    how badly behaved the objective is.
+    """
+    lower = np.array([x[0] for x in bounds], dtype=np.float64)
+    upper = np.array([x[1] for x in bounds], dtype=np.float64)
+    log_scale = lower > 0
+    with np.errstate(divide="ignore"):
+        lo = np.where(log_scale, np.log(lower), lower)
+        hi = np.where(log_scale, np.log(upper), upper)
+    scaled_lower, scaled_upper = lo, hi
+    for _ in range(levels):
+        axes = [np.linspace(x, y, points) for x, y in zip(lo, hi)]
+        grid = np.stack([x.ravel() for x in np.meshgrid(*axes, indexing="ij")], axis=1)
+        candidates = np.clip(np.where(log_scale, np.exp(grid), grid), lower, upper)
+        values = batch_func(candidates, *args)
+        best = np.argmin(values)
+        step = (hi - lo) / (points - 1)
+        lo = np.maximum(scaled_lower, grid[best] - step)
+        hi = np.minimum(scaled_upper, grid[best] + step)
+
+    x, value = candidates[best], values[best]
+    result = minimize(func, x0=x, bounds=bounds, args=args, method="L-BFGS-B", jac=jac)
+    if result["success"] and result["fun"] <= value:
+        return result["x"].tolist()
+    return x.tolist()
+
+
+def prepare_ages(ages):
+    """Converts a vector of waiting times to a NumPy array sorted from oldest to youngest."""
+    return np.sort(np.asarray(ages, dtype=np.float64))[::-1]
+
+
+def optim_bd(ages, sampling, min_bound=1e-9, fallback="grid", starts=None):
+    """
+    Optimizes birth death using Scipy
+
+    By default the optimizer starts from the Magallon-Sanderson crown estimate
+    of the net diversification rate with no extinction. Additional candidate
+    starting points can be given in `starts` as (birth, death) pairs, in which
+    case the optimizer starts from whichever candidate has the highest likelihood.
+    """
     if max(ages) < 0.000001:
         init_r = 1e-3
     else:
@@ -58,101 +133,573 @@ def optim_bd(ages, sampling, min_bound=1e-9):
         init_r = (log((len(ages) + 1) / sampling) - log(2)) / max(ages)
         init_r = max(1e-3, init_r)
     bounds = ((min_bound, 100), (0, 1 - min_bound))
-    result = two_step_optim(wrapped_lik_constant, x0=(init_r, min_bound), bounds=bounds, args=(sampling, ages))
+    t = prepare_ages(ages)
+    x0 = (init_r, min_bound)
+    if starts:
+        candidates = [x0]
+        for birth, death in starts:
+            if birth > death >= 0:
+                candidates.append(get_ra(birth, death))
+        candidates = np.clip(candidates, [x[0] for x in bounds], [x[1] for x in bounds])
+        x0 = tuple(candidates[np.argmin(lik_constant_ra_grid(candidates, sampling, t))])
+    result = two_step_optim(
+        lik_constant_ra,
+        x0=x0,
+        bounds=bounds,
+        args=(sampling, t),
+        jac=True,
+        fallback=fallback,
+        batch_func=lik_constant_ra_grid,
+    )
     return get_bd(*result)
 
 
 def optim_yule(ages, sampling, min_bound=1e-9):
-    """Optimizes a Yule model using Scipy"""
-    if max(ages) < 0.000001:
-        init_r = 1e-3
+    """
+    Optimizes a Yule model by finding the root of its score function, which
+    is strictly decreasing in the birth rate so the maximum likelihood estimate
+    is either bracketed by the bounds or is the closest bound.
+    """
+    t = prepare_ages(ages)
+    lower, upper = min_bound, 100
+    if yule_score(lower, sampling, t) <= 0:
+        birth = lower
+    elif yule_score(upper, sampling, t) >= 0:
+        birth = upper
     else:
-        # Magallon-Sanderson crown estimator
-        init_r = (log((len(ages) + 1) / sampling) - log(2)) / max(ages)
-        init_r = max(1e-3, init_r)
-    bounds = ((min_bound, 100), (0, 1 - min_bound))
-    result = two_step_optim(wrapped_lik_constant_yule, x0=(init_r, 0.0), bounds=bounds, args=(sampling, ages))
-    return get_bd(*result)
+        birth = brentq(yule_score, lower, upper, args=(sampling, t))
+    return get_bd(birth, 0.0)
 
 
-def get_lik(vec, rho, x):
-    l = vec[0]
-    m = vec[1]
-    root = 1
-    lik1 = (root + 1) * np.log(p1(x[0], l, m, rho))
-    lik2 = np.sum(np.log(l * p1(x[1:], l, m, rho)))
-    lik3 = -(root + 1) * np.log(1 - p0(x[0], l, m, rho))
-    return lik1 + lik2 + lik3
+def yule_score(r, rho, t, root=1, survival=1):
+    """
+    Derivative of the Yule log-likelihood with respect to the birth rate `r`,
+    conditioned on sampling fraction `rho` and waiting times `t` (sorted from
+    oldest to youngest).
+    """
+    n = len(t) - 1
+    c = 1 - rho
+    with np.errstate(over="ignore", under="ignore"):
+        ert = np.exp(-r * t)
+        q = ert / (rho + c * ert)
+        dr = (root + 1) * (2 * c * q[0] - 1) * t[0] + n / r + np.sum((2 * c * q[1:] - 1) * t[1:])
+        if survival == 1:
+            dr -= (root + 1) * c * (q[0] * t[0])
+    return dr
 
 
-def p0_exact(t, l, m, rho):
-    t = D(t)
-    l = D(l)
-    m = D(m)
-    rho = D(rho)
-    return D(1) - rho * (l - m) / (rho * l + (l * (D(1) - rho) - m) * (-(l - m) * t).exp())
+def lik_constant_ra_numpy(x, rho, t, root=1, survival=1):
+    """
+    Vectorized version of `lik_constant` parameterized by turnover and relative
+    extinction that also returns the gradient of the negative log-likelihood.
+    The active backend's version is available as `lik_constant_ra`.
+
+    With l = r / (1 - a) and m = a * r / (1 - a), every term of the likelihood
+    is a function of D(t) = rho + (1 - rho - a) * exp(-r * t). D(t) always lies
+    between rho and 1 - a, so no term can overflow for r > 0 and 0 <= a < 1.
+
+    Positional arguments:
+    x -- a two element vector of turnover and relative extinction
+    rho -- sampling fraction
+    t -- NumPy array of waiting times, sorted from oldest to youngest
 
+    Keyword arguments:
+    root -- include the root or not? (default: 1)
+    survival -- assume survival of the process (default: 1)
 
-def p0(t, l, m, rho):
+    Returns a negative log-likelihood and its gradient. Or FLOAT_MAX and a zero gradient.
+    """
+    r, a = x
+    n = len(t) - 1
+    c = 1 - rho - a
+    with np.errstate(over="ignore", under="ignore", invalid="ignore", divide="ignore"):
+        ert = np.exp(-r * t)
+        denom = rho + c * ert
+        log_denom = np.log(denom)
+        q = ert / denom
+        log_rho = log(rho)
+        log_1ma = log(1 - a)
+
+        lik = (root + 1) * (log_rho - r * t[0] + 2 * log_1ma - 2 * log_denom[0])
+        lik += n * (log(r) + log_1ma + log_rho) - np.sum(r * t[1:] + 2 * log_denom[1:])
+        dr = (root + 1) * t[0] * (2 * c * q[0] - 1) + n / r + np.sum(t[1:] * (2 * c * q[1:] - 1))
+        da = 2 * (root + 1) * (q[0] - 1 / (1 - a)) + 2 * np.sum(q[1:]) - n / (1 - a)
+        if survival == 1:
+            lik -= (root + 1) * (log_rho + log_1ma - log_denom[0])
+            dr -= (root + 1) * c * t[0] * q[0]
+            da -= (root + 1) * (q[0] - 1 / (1 - a))
+
+    grad = np.array([-dr, -da])
+    if not np.isfinite(lik) or not np.all(np.isfinite(grad)):
+        return sys.float_info.max, np.zeros(2)
+    return -lik, grad
+
+
+def lik_constant_ra_math(x, rho, t, root=1, survival=1):
+    """Scalar version of `lik_constant_ra_numpy`, which is much faster under PyPy."""
+    r, a = float(x[0]), float(x[1])
+    t = [float(tt) for tt in t]
+    n = len(t) - 1
+    c = 1 - rho - a
     try:
-        return 1 - rho * (l - m) / (rho * l + (l * (1 - rho) - m) * exp(-(l - m) * t))
-    except FloatingPointError:
-        return float(p0_exact(t, l, m, rho))
+        log_rho = log(rho)
+        log_1ma = log(1 - a)
+        ert = exp(-r * t[0])
+        denom = rho + c * ert
+        q = ert / denom
+        lik = (root + 1) * (log_rho - r * t[0] + 2 * log_1ma - 2 * log(denom))
+        lik += n * (log(r) + log_1ma + log_rho)
+        dr = (root + 1) * t[0] * (2 * c * q - 1) + n / r
+        da = 2 * (root + 1) * (q - 1 / (1 - a)) - n / (1 - a)
+        if survival == 1:
+            lik -= (root + 1) * (log_rho + log_1ma - log(denom))
+            dr -= (root + 1) * c * t[0] * q
+            da -= (root + 1) * (q - 1 / (1 - a))
+        for tt in t[1:]:
+            ert = exp(-r * tt)
+            denom = rho + c * ert
+            q = ert / denom
+            lik -= r * tt + 2 * log(denom)
+            dr += tt * (2 * c * q - 1)
+            da += 2 * q
+    except (ValueError, ZeroDivisionError, OverflowError):
+        return sys.float_info.max, np.zeros(2)
+    if not (isfinite(lik) and isfinite(dr) and isfinite(da)):
+        return sys.float_info.max, np.zeros(2)
+    return -lik, np.array([-dr, -da])
+
+
+def lik_constant_ra_grid_numpy(x, rho, t, root=1, survival=1):
+    """
+    Batched version of `lik_constant_ra` that returns only the negative
+    log-likelihood for every row of the two column array `x` of turnover and
+    relative extinction rates.
+    """
+    r = x[:, 0]
+    a = x[:, 1]
+    n = len(t) - 1
+    with np.errstate(over="ignore", under="ignore", invalid="ignore", divide="ignore"):
+        log_denom = np.log(rho + (1 - rho - a)[:, None] * np.exp(-r[:, None] * t))
+        log_rho = log(rho)
+        log_1ma = np.log(1 - a)
+
+        lik = (root + 1) * (log_rho - r * t[0] + 2 * log_1ma - 2 * log_denom[:, 0])
+        lik += n * (np.log(r) + log_1ma + log_rho) - r * np.sum(t[1:]) - 2 * np.sum(log_denom[:, 1:], axis=1)
+        if survival == 1:
+            lik -= (root + 1) * (log_rho + log_1ma - log_denom[:, 0])
+    return np.where(np.isfinite(lik), -lik, sys.float_info.max)
 
 
-def p1_exact(t, l, m, rho):
-    """Exact version of p1 using Decimal math."""
-    t = D(t)
-    l = D(l)
-    m = D(m)
-    rho = D(rho)
-    num = rho * (l - m) ** D(2) * (-(l - m) * t).exp()
-    denom = (rho * l + (l * (1 - rho) - m) * (-(l - m) * t).exp()) ** D(2)
-    return num / denom
+PackedAges = collections.namedtuple("PackedAges", ["t", "clade", "first", "n"])
 
 
-def p1_orig(t, l, m, rho):
-    """Original version of p1, here for testing and comparison purposes."""
-    try:
-        num = rho * (l - m) ** 2 * np.exp(-(l - m) * t)
-        denom = (rho * l + (l * (1 - rho) - m) * np.exp(-(l - m) * t)) ** 2
-        return num / denom
-    except (OverflowError, FloatingPointError):
-        return float(p1_exact(t, l, m, rho))
+def pack_ages(ages):
+    """
+    Concatenates a list of vectors of waiting times into one flat NumPy array
+    in which each clade's times are sorted from oldest to youngest.
+
+    Returns a `PackedAges` of the flat array, the index of the clade each entry
+    belongs to, whether each entry is the oldest time of its clade, and the
+    number of times after the oldest in each clade.
+    """
+    lengths = np.array([len(x) for x in ages], dtype=np.intp)
+    t = np.concatenate([prepare_ages(x) for x in ages])
+    clade = np.repeat(np.arange(len(ages)), lengths)
+    first = np.zeros(len(t), dtype=bool)
+    first[np.cumsum(lengths) - lengths] = True
+    return PackedAges(t, clade, first, lengths - 1.0)
+
+
+def lik_constant_ra_batch_numpy(x, rho, packed, active=None, root=1, survival=1):
+    """
+    Evaluates `lik_constant_ra` for many clades at once.
+
+    Positional arguments:
+    x -- array of turnover and relative extinction with one row per clade
+    rho -- array of sampling fractions, one per clade
+    packed -- waiting times of every clade, as returned by `pack_ages`
 
+    Keyword arguments:
+    active -- boolean array selecting the clades to evaluate (default: all)
+    root -- include the root or not? (default: 1)
+    survival -- assume survival of the process (default: 1)
 
-def p1(t, l, m, rho):
+    Returns arrays of the negative log-likelihoods, their gradients and their
+    Hessians. Entries for inactive clades are meaningless.
     """
-    Optimized version of p1 using common subexpression elimination and strength reduction from
-    exponentiation to multiplication.
+    t, clade, first, n = packed
+    k = len(n)
+    if active is not None:
+        selected = active[clade]
+        t, clade, first = t[selected], clade[selected], first[selected]
+
+    # Every term of the likelihood is a multiple of either log(D(t)) or t
+    weight = np.where(first, (2 - survival) * (root + 1), 2)
+    t_sum = np.bincount(clade, np.where(first, root + 1, 1) * t, minlength=k)
+    n_rho = (root + 1) * (1 - survival) + n
+    n_1ma = (2 - survival) * (root + 1) + n
+
+    r, a = x[:, 0], x[:, 1]
+    c = 1 - rho - a
+    with np.errstate(over="ignore", under="ignore", invalid="ignore", divide="ignore"):
+        ert = np.exp(-r[clade] * t)
+        denom = rho[clade] + c[clade] * ert
+        q = ert / denom
+        wq = weight * q
+        wqd = wq * rho[clade] * t / denom
+
+        lik = n_rho * np.log(rho) + n_1ma * np.log(1 - a) + n * np.log(r) - r * t_sum
+        lik -= np.bincount(clade, weight * np.log(denom), minlength=k)
+        dr = n / r - t_sum + c * np.bincount(clade, wq * t, minlength=k)
+        da = np.bincount(clade, wq, minlength=k) - n_1ma / (1 - a)
+        drr = -n / r ** 2 - c * np.bincount(clade, wqd * t, minlength=k)
+        dra = -np.bincount(clade, wqd, minlength=k)
+        daa = np.bincount(clade, wq * q, minlength=k) - n_1ma / (1 - a) ** 2
+
+    grad = -np.stack((dr, da), axis=1)
+    hess = -np.stack((np.stack((drr, dra), axis=1), np.stack((dra, daa), axis=1)), axis=1)
+    return -lik, grad, hess
+
+
+def optim_bd_batch(ages, sampling, min_bound=1e-9, fallback="grid", max_iter=100, min_batch=4):
     """
-    try:
-        ert = np.exp(-(l - m) * t, dtype=np.float64)
-        num = rho * (l - m) ** 2 * ert
-        denom = (rho * l + (l * (1 - rho) - m) * ert) ** 2
-        return num / denom
-    except (OverflowError, FloatingPointError):
-        return float(p1_exact(t, l, m, rho))
+    Optimizes birth death for many clades at once using a projected Newton
+    method with a backtracking line search, vectorized across clades. Each
+    clade stops iterating once it converges. Clades that stall, fail to
+    converge within `max_iter` iterations, or are among the last `min_batch`
+    still iterating are refit on their own with `optim_bd`, keeping whichever
+    fit is better.
+
+    Where the likelihood surface is flat, this can stop at different rates
+    than `optim_bd`, but its fits should never have a worse likelihood.
+
+    Positional arguments:
+    ages -- list of vectors of waiting times, one per clade
+    sampling -- list of sampling fractions, one per clade
+
+    Returns a list of (birth, death) pairs.
+    """
+    k = len(ages)
+    if k == 0:
+        return []
+    packed = pack_ages(ages)
+    rho = np.asarray(sampling, dtype=np.float64)
+    lower = np.array([min_bound, 0])
+    upper = np.array([100, 1 - min_bound])
+
+    oldest = packed.t[packed.first]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Magallon-Sanderson crown estimator, as in `optim_bd`
+        init_r = (np.log((packed.n + 2) / rho) - log(2)) / oldest
+    init_r = np.where(oldest < 0.000001, 1e-3, np.maximum(1e-3, np.nan_to_num(init_r, nan=1e-3)))
+    x = np.stack((np.minimum(init_r, upper[0]), np.full(k, min_bound)), axis=1)
+
+    active = np.ones(k, dtype=bool)
+    converged = np.zeros(k, dtype=bool)
+    for _ in range(max_iter):
+        lik, grad, hess = lik_constant_ra_batch(x, rho, packed, active)
+        failed = active & ~(np.isfinite(lik) & np.all(np.isfinite(grad), axis=1))
+        active &= ~failed
+
+        # Hold variables at or near their bounds when the gradient pushes against them
+        near = np.minimum(np.abs(x - np.clip(x - grad, lower, upper)), min_bound)
+        fixed = ((x <= lower + near) & (grad > 0)) | ((x >= upper - near) & (grad < 0))
+        x = np.where(fixed, np.where(grad > 0, lower, upper), x)
+        pgrad = np.where(fixed, 0.0, grad)
+        done = active & (np.max(np.abs(pgrad), axis=1) <= 1e-8 * (1 + np.abs(lik)))
+
+        # Newton direction over the free variables, or scaled steepest descent
+        # where the Hessian is not positive definite
+        h = np.where(fixed[:, :, None] | fixed[:, None, :], 0.0, np.nan_to_num(hess))
+        h[:, 0, 0] = np.where(fixed[:, 0], 1.0, h[:, 0, 0])
+        h[:, 1, 1] = np.where(fixed[:, 1], 1.0, h[:, 1, 1])
+        det = h[:, 0, 0] * h[:, 1, 1] - h[:, 0, 1] ** 2
+        posdef = (h[:, 0, 0] > 0) & (det > 0)
+        safe_det = np.where(posdef, det, 1.0)
+        newton = -np.stack(
+            (
+                (h[:, 1, 1] * pgrad[:, 0] - h[:, 0, 1] * pgrad[:, 1]) / safe_det,
+                (h[:, 0, 0] * pgrad[:, 1] - h[:, 0, 1] * pgrad[:, 0]) / safe_det,
+            ),
+            axis=1,
+        )
+        scale = np.maximum(np.abs(np.stack((h[:, 0, 0], h[:, 1, 1]), axis=1)), 1.0)
+        direction = np.where(posdef[:, None], newton, -pgrad / scale)
+        decrement = -np.sum(pgrad * newton, axis=1)
+        scaled = np.max(np.abs(pgrad * x), axis=1)
+        done |= active & posdef & (decrement <= 1e-10 * (1 + np.abs(lik))) & (scaled <= 1e-5 * (1 + np.abs(lik)))
+        converged |= done
+        active &= ~done
+        # Refitting a few stragglers one at a time is cheaper than iterating the whole batch
+        if np.count_nonzero(active) <= min_batch:
+            break
+
+        # Backtracking line search, projecting each trial point onto the bounds
+        step = np.ones(k)
+        searching = active.copy()
+        new_lik = lik.copy()
+        for _ in range(30):
+            trial = np.clip(x + step[:, None] * direction, lower, upper)
+            # Approach extinction fraction 1, where the likelihood is degenerate, gradually
+            trial[:, 1] = np.minimum(trial[:, 1], x[:, 1] + 0.9 * (upper[1] - x[:, 1]))
+            trial_lik = lik_constant_ra_batch(trial, rho, packed, searching)[0]
+            decrease = np.sum(grad * (trial - x), axis=1)
+            accept = searching & np.isfinite(trial_lik) & (trial_lik <= lik + 1e-4 * decrease)
+            x[accept] = trial[accept]
+            new_lik[accept] = trial_lik[accept]
+            searching &= ~accept
+            if not searching.any():
+                break
+            step[searching] /= 2
+
+        # Clades whose line search failed, or that stall before reaching a
+        # small Newton decrement, are left for `optim_bd`
+        change = (lik - new_lik) / np.maximum(np.maximum(np.abs(lik), np.abs(new_lik)), 1)
+        active &= ~searching & (change > 1e-15)
+
+    results = [get_bd(*x[i].tolist()) for i in range(k)]
+    for i in np.flatnonzero(~converged):
+        refit = optim_bd(ages[i], sampling[i], min_bound=min_bound, fallback=fallback)
+        t = packed.t[packed.clade == i]
+        if lik_constant_ra(get_ra(*refit), rho[i], t)[0] <= lik_constant_ra(x[i], rho[i], t)[0]:
+            results[i] = refit
+    return results
+
+
+def optim_yule_batch(ages, sampling, min_bound=1e-9, max_iter=100):
+    """
+    Optimizes a Yule model for many clades at once by finding the root of each
+    score function with Newton's method, vectorized across clades and safeguarded
+    with bisection. See `optim_yule`. The Yule likelihood has a single
+    optimum, so the rates match `optim_yule` up to the tolerance of the root finding.
 
+    Returns a list of (birth, death) pairs.
+    """
+    k = len(ages)
+    if k == 0:
+        return []
+    packed = pack_ages(ages)
+    rho = np.asarray(sampling, dtype=np.float64)
+
+    def score(r, active):
+        _, grad, hess = lik_constant_ra_batch(np.stack((r, np.zeros(k)), axis=1), rho, packed, active)
+        return -grad[:, 0], -hess[:, 0, 0]
+
+    lower = np.full(k, min_bound, dtype=np.float64)
+    upper = np.full(k, 100, dtype=np.float64)
+    at_lower = score(lower, None)[0] <= 0
+    at_upper = ~at_lower & (score(upper, None)[0] >= 0)
+    birth = np.where(at_lower, lower, np.where(at_upper, upper, np.sqrt(lower * upper)))
+    active = ~(at_lower | at_upper)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        value, slope = score(birth, active)
+        # The score is decreasing, so keep the root bracketed
+        lower = np.where(active & (value > 0), birth, lower)
+        upper = np.where(active & (value < 0), birth, upper)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            proposal = birth - value / slope
+        bisect = ~np.isfinite(proposal) | (proposal <= lower) | (proposal >= upper)
+        proposal = np.where(bisect, (lower + upper) / 2, proposal)
+        done = active & ((value == 0) | (np.abs(proposal - birth) <= 1e-12 * birth))
+        birth = np.where(active, proposal, birth)
+        active &= ~done
+
+    results = [get_bd(float(x), 0.0) for x in birth]
+    for i in np.flatnonzero(active):
+        results[i] = optim_yule(ages[i], sampling[i], min_bound=min_bound)
+    return results
+
+
+def decay_terms(t, l, m):
+    """
+    Common subexpressions of `p0`, `p1` and `intp1` for birth rate `l` and
+    death rate `m`, chosen so that none of them can overflow.
 
-def intp1_exact(t, l, m):
-    """Exact version of intp1 using Decimal math."""
-    l = D(l)
-    m = D(m)
-    t = D(t)
-    num = D(1) - (-(l - m) * t).exp()
-    denom = l - m * (-(l - m) * t).exp()
-    return num / denom
+    Returns the diversification rate r = l - m, g = exp(-|r| * t) and
+    h = (1 - g) / |r|, which is computed with `exprel` so that it
+    smoothly approaches `t` as r goes to zero.
+    """
+    with np.errstate(over="ignore", under="ignore"):
+        r = np.subtract(l, m, dtype=np.float64)
+        x = np.abs(r) * t
+        g = np.exp(-x)
+        h = t * exprel(-x)
+    return r, g, h
 
 
-def intp1(t, l, m):
-    try:
-        return (1 - exp(-(l - m) * t)) / (l - m * exp(-(l - m) * t))
-    except OverflowError:
-        return float(intp1_exact(t, l, m))
+def p0_numpy(t, l, m, rho):
+    """
+    Probability that a lineage alive at time `t` in the past leaves no sampled
+    descendants. Accepts NumPy arrays.
+    """
+    r, g, h = decay_terms(t, l, m)
+    growing = r >= 0
+    with np.errstate(under="ignore"):
+        return (1 - rho * np.where(growing, 1, g) / (rho * l * h + np.where(growing, g, 1)))[()]
 
 
-def lik_constant(vec, rho, t, root=1, survival=1, p1=p1):
+def p1_numpy(t, l, m, rho):
+    """
+    Probability that a lineage alive at time `t` in the past leaves exactly one
+    sampled descendant. Accepts NumPy arrays.
+
+    The numerator and denominator of the textbook formula are both rescaled by
+    powers of exp(-(l - m) * t) so that only exponentials of non-positive
+    numbers are ever taken. Once that exponential would be subnormal, the
+    result is computed from logarithms instead to keep full precision.
+    """
+    r, g, h = decay_terms(t, l, m)
+    with np.errstate(under="ignore", divide="ignore"):
+        x = np.abs(r) * t
+        denom = rho * l * h + np.where(r >= 0, g, 1)
+        return np.where(x > 700, np.exp(np.log(rho) - x - 2 * np.log(denom)), rho * g / denom ** 2)[()]
+
+
+def intp1_numpy(t, l, m):
+    """
+    Integral of `p1` used to draw new branching times. Accepts NumPy arrays.
+    """
+    r, _, h = decay_terms(t, l, m)
+    with np.errstate(under="ignore"):
+        return (h / (1 + np.where(r >= 0, m, l) * h))[()]
+
+
+def decay_terms_math(t, l, m):
+    """Scalar version of `decay_terms` using only the `math` module."""
+    r = l - m
+    x = abs(r) * t
+    g = exp(-x)
+    h = t if x == 0 else t * expm1(-x) / -x
+    return r, g, h
+
+
+def p0_math(t, l, m, rho):
+    """Scalar version of `p0_numpy`, which is much faster under PyPy."""
+    r, g, h = decay_terms_math(t, l, m)
+    if r >= 0:
+        return 1 - rho / (rho * l * h + g)
+    return 1 - rho * g / (rho * l * h + 1)
+
+
+def p1_math(t, l, m, rho):
+    """Scalar version of `p1_numpy`, which is much faster under PyPy."""
+    r, g, h = decay_terms_math(t, l, m)
+    denom = rho * l * h + (g if r >= 0 else 1)
+    if abs(r) * t > 700:
+        # g is subnormal, so avoid multiplying by it
+        return exp(log(rho) - abs(r) * t - 2 * log(denom))
+    return rho * g / (denom * denom)
+
+
+def intp1_math(t, l, m):
+    """Scalar version of `intp1_numpy`, which is much faster under PyPy."""
+    r, _, h = decay_terms_math(t, l, m)
+    return h / (1 + (m if r >= 0 else l) * h)
+
+
+def intp1_array_math(t, l, m):
+    """Applies `intp1_math` to each of the times in `t`, returning a NumPy array."""
+    l, m = float(l), float(m)
+    return np.array([intp1_math(x, l, m) for x in np.asarray(t, dtype=np.float64).tolist()], dtype=np.float64)
+
+
+# The kernels of a numerical backend. `intp1_array` is `intp1` over an array
+# of times, and the `lik_constant_ra` kernels fit rates (see optim_bd and
+# optim_bd_batch)
+Backend = collections.namedtuple(
+    "Backend", ["p0", "p1", "intp1", "intp1_array", "lik_constant_ra", "lik_constant_ra_grid", "lik_constant_ra_batch"]
+)
+
+# The scalar `math` kernels suit PyPy's JIT, while CPython is faster working
+# on whole NumPy arrays at once or with the compiled kernels from numba.
+# Fitting many clades at once only makes sense on arrays
+BACKENDS = {
+    "math": Backend(
+        p0_math,
+        p1_math,
+        intp1_math,
+        intp1_array_math,
+        lik_constant_ra_math,
+        lik_constant_ra_grid_numpy,
+        lik_constant_ra_batch_numpy,
+    ),
+    "numpy": Backend(
+        p0_numpy,
+        p1_numpy,
+        intp1_numpy,
+        intp1_numpy,
+        lik_constant_ra_numpy,
+        lik_constant_ra_grid_numpy,
+        lik_constant_ra_batch_numpy,
+    ),
+}
+if jit is not None:
+    BACKENDS["numba"] = Backend(
+        jit.p0,
+        jit.p1,
+        jit.intp1,
+        jit.intp1,
+        jit.lik_constant_ra,
+        lik_constant_ra_grid_numpy,
+        jit.lik_constant_ra_batch,
+    )
+
+backend = None
+
+
+def default_backend():
+    """Picks the fastest numerical backend available for this interpreter."""
+    if platform.python_implementation() == "PyPy":
+        return "math"
+    if "numba" in BACKENDS:
+        return "numba"
+    return "numpy"
+
+
+def set_backend(name=None):
+    """
+    Switches the numerical kernels used to fit rates (`lik_constant_ra` and
+    its variants, `lik_constant`) and to draw new times (`get_new_times`).
+
+    Keyword arguments:
+    name -- one of `BACKENDS`, or None for `default_backend()` (default: None)
+    """
+    global backend, p0, p1, intp1, intp1_array, lik_constant_ra, lik_constant_ra_grid, lik_constant_ra_batch
+    if name is None:
+        name = default_backend()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown or unavailable numerical backend {name!r} (choose from {', '.join(BACKENDS)})")
+    backend = name
+    p0, p1, intp1, intp1_array, lik_constant_ra, lik_constant_ra_grid, lik_constant_ra_batch = BACKENDS[name]
+
+
+def get_backend():
+    """Returns the name of the active numerical backend."""
+    return backend
+
+
+def environment_backend():
+    """
+    Returns the backend named by the TACT_BACKEND environment variable, or
+    None if it is unset. Asking for numba without it installed gives a
+    warning and None, so TACT still runs.
+    """
+    name = os.environ.get("TACT_BACKEND") or None
+    if name == "numba" and "numba" not in BACKENDS:
+        warnings.warn(
+            "TACT_BACKEND is numba, but numba is not installed (install tact[jit]); using the default backend",
+            RuntimeWarning,
+        )
+        return None
+    return name
+
+
+set_backend(environment_backend())
+
+
+def lik_constant(vec, rho, t, root=1, survival=1, p1=None):
     """
     Calculates the likelihood of a constant-rate birth-death process, conditioned
     on the waiting times of a phylogenetic tree and degree of incomplete sampling.
@@ -170,13 +717,18 @@ def lik_constant(vec, rho, t, root=1, survival=1, p1=p1):
     Keyword arguments:
     root -- include the root or not? (default: 1)
     survival -- assume survival of the process (default: 1)
+    p1 -- implementation of `p1` (default: the active backend's)
 
     Returns a likelihood. Or FLOAT_MAX.
     """
+    if p1 is None:
+        p1 = BACKENDS[backend].p1
     try:
         l = vec[0]
         m = vec[1]
         t.sort(reverse=True)
+        if jit is not None and p1 is jit.p1:
+            return jit.lik_constant(float(l), float(m), float(rho), np.ascontiguousarray(t, dtype=np.float64), int(root), int(survival))
         lik = (root + 1) * log(p1(t[0], l, m, rho))
         for tt in t[1:]:
             lik += log(l) + log(p1(tt, l, m, rho))
@@ -213,25 +765,210 @@ def get_monophyletic_node(tree, species):
         return mrca
 
 
-def get_birth_death_rates(node, sampfrac, yule=False, include_root=False):
+class RateCache(object):
+    """
+    Bounded memo of birth and death rate estimates that evicts the least
+    recently used entry once `maxsize` entries are stored. Keeps count of
+    cache hits and misses.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self)}/{self.maxsize} entries"
+
+    def get(self, key):
+        """Returns the rates stored under `key`, or None."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores `value` under `key`, evicting the oldest entry if full."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def rates_key(node, sampfrac, yule=False, include_root=False, fallback="grid"):
+    """Returns the `RateCache` key for a rate estimate on the subtree descending from `node`."""
+    return (node.edge.bipartition.leafset_bitmask, sampfrac, yule, include_root, fallback)
+
+
+def get_birth_death_rates(
+    node, sampfrac, yule=False, include_root=False, fallback="grid", cache=None, starts=None, index=None
+):
     """
     Estimates the birth and death rates for the subtree descending from
     `node` with sampling fraction `sampfrac`. Optionally restrict to a
-    Yule pure-birth model.
+    Yule pure-birth model. `fallback` selects the optimizer used when
+    L-BFGS-B fails to converge (either "grid" or "annealing"), and
+    `starts` are extra (birth, death) starting points to consider.
+
+    If a `RateCache` is given, estimates are memoized on the leafset
+    bitmask of `node`, so the tree must have its bipartitions encoded.
+    Node ages are looked up in `index`, an `AgeIndex`, if one is given.
     """
+    if cache is not None:
+        key = rates_key(node, sampfrac, yule, include_root, fallback)
+        rates = cache.get(key)
+        if rates is not None:
+            return rates
     if yule:
-        return optim_yule(get_ages(node, include_root), sampfrac)
+        rates = optim_yule(get_ages(node, include_root, index), sampfrac)
     else:
-        return optim_bd(get_ages(node, include_root), sampfrac)
+        rates = optim_bd(get_ages(node, include_root, index), sampfrac, fallback=fallback, starts=starts)
+    if cache is not None:
+        cache.put(key, rates)
+    return rates
+
+
+def get_birth_death_rates_batch(
+    nodes, sampfracs, yule=False, include_root=False, fallback="grid", cache=None, index=None
+):
+    """
+    Estimates the birth and death rates for many subtrees at once, fitting
+    them together with `optim_yule_batch` or `optim_bd_batch`. Arguments are
+    as for `get_birth_death_rates`, except that `nodes` and `sampfracs` are
+    lists. Subtrees that share a cache key are only fitted once.
+
+    Returns a list of (birth, death) pairs.
+    """
+    results = [None] * len(nodes)
+    pending = collections.OrderedDict()
+    for idx, (node, sampfrac) in enumerate(zip(nodes, sampfracs)):
+        if cache is None:
+            key = idx
+        else:
+            key = rates_key(node, sampfrac, yule, include_root, fallback)
+            if key not in pending:
+                results[idx] = cache.get(key)
+        if results[idx] is None:
+            pending.setdefault(key, []).append(idx)
+
+    if pending:
+        first = [indices[0] for indices in pending.values()]
+        ages = [get_ages(nodes[idx], include_root, index) for idx in first]
+        fracs = [sampfracs[idx] for idx in first]
+        optim_stats["batch fits"] += len(first)
+        if yule:
+            fitted = optim_yule_batch(ages, fracs)
+        else:
+            fitted = optim_bd_batch(ages, fracs, fallback=fallback)
+        for (key, indices), rates in zip(pending.items(), fitted):
+            if cache is not None:
+                cache.put(key, rates)
+            for idx in indices:
+                results[idx] = rates
+    return results
 
 
-def get_ages(node, include_root=False):
-    ages = [x.age for x in node.ageorder_iter(include_leaves=False, descending=True)]
+def get_ages(node, include_root=False, index=None):
+    """
+    Returns the ages of the internal nodes of the subtree descending from
+    `node`, oldest first, optionally looking them up in an `AgeIndex`.
+    """
+    if index is not None:
+        ages = index.get_ages(node).tolist()
+    else:
+        ages = [x.age for x in node.ageorder_iter(include_leaves=False, descending=True)]
     if include_root:
         ages += [node.age]
     return ages
 
 
+class AgeIndex(object):
+    """
+    Index of the internal node ages of a whole tree. Every subtree of the
+    tree as indexed is a contiguous slice of a preorder array of ages, so
+    the ages below any node are found by sorting a slice rather than by
+    traversing the subtree. Each subtree's slice is sorted once, the first
+    time it is looked up, rather than for every subtree up front, which
+    would take memory proportional to the number of nodes times the depth
+    of the tree. The tree must not change once it is indexed.
+    """
+
+    def __init__(self, tree):
+        self._nodes = [x for x in tree.preorder_node_iter() if x.is_internal()]
+        self._pos = {x: i for i, x in enumerate(self._nodes)}
+        self._ages = np.array([x.age for x in self._nodes], dtype=np.float64)
+        size = np.ones(len(self._nodes), dtype=np.intp)
+        for i in range(len(self._nodes) - 1, 0, -1):
+            size[self._pos[self._nodes[i].parent_node]] += size[i]
+        self._end = np.arange(len(self._nodes)) + size
+        self._sorted = {}
+
+    def get_ages(self, node):
+        """
+        Returns the ages of the internal nodes of the subtree descending from
+        `node`, oldest first, as a read-only array.
+        """
+        pos = self._pos.get(node)
+        if pos is None:
+            # A leaf
+            return np.array([], dtype=np.float64)
+        ages = self._sorted.get(pos)
+        if ages is None:
+            ages = np.sort(self._ages[pos : self._end[pos]])[::-1]
+            ages.flags.writeable = False
+            self._sorted[pos] = ages
+        return ages
+
+
+def count_bits(mask):
+    """Number of set bits in the integer `mask`, such as a taxon bitmask."""
+    return bin(mask).count("1")
+
+
+def map_taxa(namespace):
+    """
+    Returns a dict from the labels of the taxa in `namespace` to the taxa,
+    lowercased unless the namespace is case sensitive, for `require_taxa`.
+    """
+    key = str if namespace.is_case_sensitive else str.lower
+    existing = {}
+    for taxon in namespace:
+        if taxon.label is not None:
+            existing.setdefault(key(taxon.label), taxon)
+    return existing
+
+
+def require_taxa(namespace, labels, existing=None):
+    """
+    Returns the taxa in `namespace` with the given `labels`, creating any
+    that are missing, like calling `namespace.require_taxon` on each label.
+    Lookups go through `existing`, the namespace's `map_taxa`, which is built
+    here if it is not given and kept up to date with the new taxa.
+    """
+    key = str if namespace.is_case_sensitive else str.lower
+    if existing is None:
+        existing = map_taxa(namespace)
+    taxa = []
+    for label in labels:
+        taxon = existing.get(key(label))
+        if taxon is None:
+            taxon = namespace.new_taxon(label=label)
+            existing[key(label)] = taxon
+        taxa.append(taxon)
+    return taxa
+
+
 def get_tip_labels(tree_or_node):
     try:
         return set([x.taxon.label for x in tree_or_node.leaf_node_iter()])
@@ -252,18 +989,52 @@ def edge_iter(node, filter_fn=None):
         stack.extend(edge.head_node.child_edge_iter())
 
 
+def is_locked(edge):
+    """Whether `edge` is locked, i.e. nothing may be grafted onto it."""
+    return getattr(edge, "locked", False)
+
+
 def get_tree(path, namespace=None):
     """
     Gets a DendroPy tree from a path and precalculate its node ages and bipartition bitmask.
     """
-    tree = dendropy.Tree.get_from_path(
-        path, schema="newick", taxon_namespace=namespace, rooting="default-rooted"
-    )
+    from .newick import read_tree
+
+    tree = read_tree(path, namespace)
     tree.calc_node_ages()
     tree.encode_bipartitions()
     return tree
 
 
+def copy_tree(tree):
+    """
+    Copies the topology, branch lengths, labels, locks and node ages of a tree and
+    encodes its bipartitions. The copy shares the original's taxon namespace
+    and taxa, which makes it much cheaper than `Tree.clone`.
+    """
+    new_tree = dendropy.Tree(taxon_namespace=tree.taxon_namespace, is_rooted=tree.is_rooted)
+    new_tree.seed_node.label = tree.seed_node.label
+    new_tree.seed_node.age = tree.seed_node.age
+    new_tree.seed_node.edge.length = tree.seed_node.edge.length
+    copy_descendants(tree.seed_node, new_tree.seed_node)
+    new_tree.encode_bipartitions()
+    return new_tree
+
+
+def copy_descendants(source, target):
+    """Copies the nodes descending from `source` below the node `target`."""
+    copies = {source: target}
+    for node in source.preorder_iter():
+        parent = copies[node]
+        for child in node.child_node_iter():
+            new_child = parent.new_child(taxon=child.taxon, label=child.label, edge_length=child.edge.length)
+            new_child.edge.label = child.edge.label
+            if is_locked(child.edge):
+                new_child.edge.locked = True
+            new_child.age = child.age
+            copies[child] = new_child
+
+
 def is_binary(node):
     """Is the subtree under `node` a fully bifurcating tree?"""
     for x in node.preorder_internal_node_iter():
@@ -302,8 +1073,7 @@ def ensure_tree_node_depths(tree):
     return msg
 
 
-# TODO: This could probably be optimized
-def get_new_times(ages, birth, death, missing, told=None, tyoung=None):
+def get_new_times(ages, birth, death, missing, told=None, tyoung=None, rng=random):
     """
     Simulates new speciation events in an incomplete phylogeny assuming a
     constnat-rate birth-death process.
@@ -323,6 +1093,7 @@ def get_new_times(ages, birth, death, missing, told=None, tyoung=None):
     Keyword arguments:
     told -- maximum simulated age (default: `max(ages)`)
     tyoung -- minimum simulated age bound (default: `0`)
+    rng -- source of uniform random numbers, such as a `random.Random` (default: the `random` module)
 
     Returns a vector of simulated waiting times.
     """
@@ -333,45 +1104,35 @@ def get_new_times(ages, birth, death, missing, told=None, tyoung=None):
             raise Exception("Zero or negative branch lengths detected in backbone phylogeny")
     if tyoung is None:
         tyoung = 0
-
-    ages.sort(reverse=True)
-    times = [x for x in ages if x <= told and x >= tyoung]
-    times = [told] + times + [tyoung]
-    ranks = range(0, len(times))
-    only_new = list()
-    while missing > 0:
-        if len(ranks) > 2:
-            distrranks = list()
-            for i in range(1, len(ranks)):
-                temp = ranks[i] * (
-                    intp1(times[i - 1], birth, death) - intp1(times[i], birth, death)
-                )
-                distrranks.append(temp)
-            try:
-                dsum = sum(distrranks)
-                distrranks = [x / dsum for x in distrranks]
-                for i in range(1, len(distrranks)):
-                    distrranks[i] = distrranks[i] + distrranks[i - 1]
-                r = random.uniform(0, 1)
-                addrank = min([idx for idx, x in enumerate(distrranks) if x > r])
-            except ZeroDivisionError:
-                addrank = 0
-            except ValueError:
-                addrank = 0
-        else:
-            addrank = 0
-        r = random.uniform(0, 1)
-        const = intp1(times[addrank], birth, death) - intp1(times[addrank + 1], birth, death)
-        try:
-            temp = intp1(times[addrank + 1], birth, death) / const
-        except ZeroDivisionError:
-            temp = 0.0
-        xnew = (
-            1
-            / (death - birth)
-            * log((1 - (r + temp) * const * birth) / (1 - (r + temp) * const * death))
-        )
-        only_new.append(xnew)
-        missing -= 1
-    only_new.sort(reverse=True)
-    return only_new
+    missing = max(missing, 0)
+
+    # The backbone times do not change as new times are drawn, so the
+    # distribution of ranks only has to be computed once
+    ages = np.sort(np.asarray(ages, dtype=np.float64))[::-1]
+    times = np.concatenate(([told], ages[(ages <= told) & (ages >= tyoung)], [tyoung]))
+    p = intp1_array(times, birth, death)
+    cdf = None
+    if len(times) > 2:
+        weights = np.arange(1, len(times)) * (p[:-1] - p[1:])
+        dsum = np.cumsum(weights)[-1]
+        if dsum != 0:
+            cdf = np.cumsum(weights / dsum)
+
+    # Draw a rank (if there is more than one) and then a time within it for
+    # each new time, in the same order as TreeSim
+    if cdf is None:
+        addrank = np.zeros(missing, dtype=np.intp)
+        r = np.array([rng.random() for _ in range(missing)], dtype=np.float64)
+    else:
+        draws = np.array([rng.random() for _ in range(2 * missing)], dtype=np.float64).reshape(missing, 2)
+        addrank = np.searchsorted(cdf, draws[:, 0], side="right")
+        # Rounding can leave the last cumulative weight just below 1
+        addrank[addrank == len(cdf)] = 0
+        r = draws[:, 1]
+
+    const = p[addrank] - p[addrank + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        temp = np.where(const != 0, p[addrank + 1] / const, 0.0)
+    with np.errstate(under="ignore"):
+        xnew = 1 / (death - birth) * np.log((1 - (r + temp) * const * birth) / (1 - (r + temp) * const * death))
+    return np.sort(xnew)[::-1].tolist()
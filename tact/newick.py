@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming Newick reader.
+
+Reads the first tree of a Newick file in chunks, without holding the whole
+text or DendroPy's tokenizer state in memory, and builds it straight into a
+DendroPy `Tree`. Labels are read the way DendroPy reads them with its
+defaults:
+
+* unquoted underscores become spaces, and comments inside a label are dropped;
+* quoted labels are kept verbatim, with doubled quotes standing for one;
+* leaf labels name taxa and internal labels are node labels;
+* trees are rooted unless they start with a [&U] comment.
+"""
+from __future__ import division
+
+import re
+from array import array
+from math import isnan
+
+import dendropy
+from dendropy.utility.error import DataParseError
+
+from .compact import NO_NODE
+from .lib import require_taxa
+
+# Characters read at a time
+CHUNK_SIZE = 1 << 20
+
+# DendroPy lets comments nest, which a regular expression can only follow
+# so deep; more deeply nested comments are reported as errors. Patterns are
+# written so that each character can only be matched one way, which keeps
+# backtracking linear without possessive quantifiers (Python 3.11+)
+COMMENT_PATTERN = r"\[[^\[\]]*\]"
+for _ in range(3):
+    COMMENT_PATTERN = r"\[[^\[\]]*(?:%s[^\[\]]*)*\]" % COMMENT_PATTERN
+COMMENT = re.compile(COMMENT_PATTERN)
+
+TOKEN = re.compile(
+    r"""\s*(?:
+    (?P<quoted>'[^']*(?:''[^']*)*'(?!'))
+    |(?P<comment>%(comment)s)
+    |(?P<punctuation>[(),:;])
+    |(?P<word>[^\s()\[\]{},:;="'](?:[^\s()\[\]{},:;="]|%(comment)s)*)
+    |(?P<other>\S)
+    )"""
+    % {"comment": COMMENT_PATTERN},
+    re.VERBOSE,
+)
+# A whole element in one go: an optional label, edge length and comments,
+# then the punctuation that ends them. Anything else is left to TOKEN
+ELEMENT = re.compile(
+    r"""\s*(?:'([^']*(?:''[^']*)*)'(?!')|([^\s()\[\]{},:;="'](?:[^\s()\[\]{},:;="]|%(comment)s)*))?
+    (?:\s*%(comment)s)*
+    (?:\s*:(?:\s*%(comment)s)*\s*([^\s()\[\]{},:;="']+)(?:\s*%(comment)s)*)?
+    \s*([(),;])"""
+    % {"comment": COMMENT_PATTERN},
+    re.VERBOSE,
+)
+
+
+def read_chunks(stream, size=CHUNK_SIZE, digest=None):
+    """
+    Yields the text of `stream` in chunks of `size` characters, also feeding
+    them to the hashlib object `digest` if it is given.
+    """
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            return
+        if digest is not None:
+            digest.update(chunk.encode("utf-8"))
+        yield chunk
+
+
+class NewickParser(object):
+    """
+    Incremental parser for one Newick tree. Text is passed to `feed` as it
+    is read, then `close` checks the tree is complete. Nodes are numbered in
+    preorder, and the tree is kept in flat arrays: the parent of each node
+    (NO_NODE for the root), its label (None if it has none) and the length
+    of its edge (NaN if it has none).
+    """
+
+    __slots__ = ("parents", "labels", "lengths", "is_rooted", "done", "_stack", "_filled", "_current", "_length", "_buffer", "_offset")
+
+    def __init__(self):
+        self.parents = array("i")
+        self.labels = []
+        self.lengths = array("d")
+        self.is_rooted = True
+        self.done = False
+        self._stack = []
+        # Whether each clade on the stack has a child other than a blank one
+        self._filled = []
+        self._current = NO_NODE
+        self._length = False
+        self._buffer = ""
+        self._offset = 0
+
+    def feed(self, text):
+        """Parses `text`, keeping any token that may continue in the next chunk for later."""
+        if self.done:
+            return
+        buffer = self._buffer + text
+        # Tokens cannot span punctuation, so everything up to the last
+        # punctuation mark is complete, except maybe a quote or comment
+        cut = max(buffer.rfind(x) for x in "(),;") + 1
+        self._buffer = buffer
+        if cut:
+            self._buffer = buffer[self._parse(buffer, cut, False) :]
+
+    def close(self):
+        """Parses whatever is left and checks that a whole tree was read."""
+        if not self.done:
+            self._parse(self._buffer, len(self._buffer), True)
+            self._buffer = ""
+        if not self.done:
+            self._error("unexpected end of file (missing ';'?)")
+
+    def _error(self, message, position=None):
+        if position is not None:
+            message = f"{message} at character {self._offset + position + 1}"
+        raise DataParseError(message=message)
+
+    def _new_node(self, parent):
+        self.parents.append(parent)
+        self.labels.append(None)
+        self.lengths.append(float("nan"))
+        return len(self.parents) - 1
+
+    def _parse(self, buffer, end, final):
+        """Parses `buffer` up to `end`, returning where it stopped."""
+        pos = 0
+        while pos < end and not self.done:
+            if self.parents and not self._length:
+                pos = self._parse_elements(buffer, pos, end)
+                if pos >= end or self.done:
+                    break
+            # Something the fast path does not handle (including errors),
+            # so take it one token at a time
+            new_pos = self._parse_token(buffer, pos, end, final)
+            if new_pos is None:
+                break
+            pos = new_pos
+        self._offset += pos
+        return pos
+
+    def _parse_elements(self, buffer, pos, end):
+        """
+        Parses whole elements of `buffer` from `pos`, stopping before the
+        first one that is not a plain label and edge length followed by
+        punctuation in a valid place. Returns where it stopped.
+        """
+        parents = self.parents
+        labels = self.labels
+        lengths = self.lengths
+        stack = self._stack
+        filled = self._filled
+        current = self._current
+        nan = float("nan")
+        while True:
+            # Anchored at pos, as searching ahead for the next element that
+            # matches would rescan the rest of the buffer
+            match = ELEMENT.match(buffer, pos, end)
+            if match is None:
+                break
+            quoted, word, length, punctuation = match.groups()
+            if quoted is not None:
+                label = quoted.replace("''", "'")
+            elif word is not None:
+                label = (COMMENT.sub("", word) if "[" in word else word).replace("_", " ")
+            else:
+                label = None
+            if length is not None:
+                try:
+                    length = float(length)
+                except ValueError:
+                    break
+            if punctuation == "(":
+                if label is not None or length is not None or current != NO_NODE or not stack:
+                    break
+            elif (punctuation == ";") == bool(stack):
+                break
+            if label is not None or length is not None:
+                if current == NO_NODE:
+                    if not stack:
+                        break
+                    parents.append(stack[-1])
+                    labels.append(label)
+                    lengths.append(nan if length is None else length)
+                    filled[-1] = True
+                    current = len(parents) - 1
+                else:
+                    if label is not None:
+                        if labels[current] is not None:
+                            break
+                        labels[current] = label
+                    if length is not None:
+                        lengths[current] = length
+            pos = match.end()
+            if punctuation == ";":
+                self.done = True
+                break
+            if punctuation == "(":
+                parents.append(stack[-1])
+                labels.append(None)
+                lengths.append(nan)
+                filled[-1] = True
+                stack.append(len(parents) - 1)
+                filled.append(False)
+                continue
+            if current == NO_NODE and (punctuation == "," or not filled[-1]):
+                parents.append(stack[-1])
+                labels.append(None)
+                lengths.append(nan)
+            if punctuation == ")":
+                current = stack.pop()
+                filled.pop()
+            else:
+                current = NO_NODE
+        self._current = current
+        return pos
+
+    def _parse_token(self, buffer, pos, end, final):
+        """
+        Parses the next token of `buffer` from `pos`, returning where it
+        ended, or None if it may continue past `end`.
+        """
+        stack = self._stack
+        match = TOKEN.match(buffer, pos, end)
+        if match is None:
+            # Only whitespace is left
+            return end
+        kind = match.lastgroup
+        token = match.group(kind)
+        start = match.start(kind)
+        if kind == "other" and token in "'[" and not final:
+            # An unfinished quote or comment, so wait for the rest
+            return None
+        if kind == "word" and not final and buffer.startswith("[", match.end()):
+            # The word goes on into a comment that is not finished yet
+            return None
+        if kind == "comment":
+            if not self.parents and token[1:-1].strip().upper() in ("&R", "&U"):
+                self.is_rooted = token[1:-1].strip().upper() == "&R"
+            return match.end()
+        if self._length:
+            if kind != "word":
+                self._error(f"invalid edge length {token!r}", start)
+            try:
+                self.lengths[self._current] = float(COMMENT.sub("", token))
+            except ValueError:
+                self._error(f"invalid edge length {token!r}", start)
+            self._length = False
+            return match.end()
+        current = self._current
+        if kind == "punctuation":
+            if token == "(":
+                if current != NO_NODE or (self.parents and not stack):
+                    self._error("unexpected '('", start)
+                if stack:
+                    self._filled[-1] = True
+                stack.append(self._new_node(stack[-1] if stack else NO_NODE))
+                self._filled.append(False)
+                return match.end()
+            if token == ":":
+                if current == NO_NODE:
+                    current = self._leaf(start)
+                self._length = True
+            elif token == ";":
+                if stack:
+                    self._error("unbalanced parentheses", start)
+                if not self.parents:
+                    self._error("empty tree", start)
+                self.done = True
+            else:
+                # A comma or closing parenthesis ends the current node,
+                # which is a blank leaf if nothing was read. Like DendroPy,
+                # a blank leaf before ')' only counts if the clade has
+                # nothing else, so '(A,)' has one child and '(,)' two
+                if not stack:
+                    self._error(f"unexpected {token!r}", start)
+                if current == NO_NODE and (token == "," or not self._filled[-1]):
+                    self._new_node(stack[-1])
+                if token == ")":
+                    current = stack.pop()
+                    self._filled.pop()
+                else:
+                    current = NO_NODE
+            self._current = current
+        elif kind in ("word", "quoted"):
+            if not self.parents and kind == "word":
+                # DendroPy also takes rooting comments from inside a
+                # first label, as in 'A[&U];'
+                for comment in COMMENT.findall(token):
+                    if comment[1:-1].strip().upper() in ("&R", "&U"):
+                        self.is_rooted = comment[1:-1].strip().upper() == "&R"
+            if current == NO_NODE:
+                current = self._current = self._leaf(start)
+            elif self.labels[current] is not None:
+                self._error("expecting ':', ')', ',' or ';' after a label", start)
+            if kind == "quoted":
+                self.labels[current] = token[1:-1].replace("''", "'")
+            else:
+                self.labels[current] = COMMENT.sub("", token).replace("_", " ")
+        else:
+            self._error(f"unexpected {token!r}", start)
+        return match.end()
+
+    def _leaf(self, position):
+        """Starts a leaf in the clade being read."""
+        if not self._stack:
+            if self.parents:
+                self._error("expecting ';' after the tree", position)
+            return self._new_node(NO_NODE)
+        self._filled[-1] = True
+        return self._new_node(self._stack[-1])
+
+
+def parse_newick(source):
+    """
+    Parses the first tree in `source`, a path or a text stream, returning a
+    finished `NewickParser`.
+    """
+    parser = NewickParser()
+    if isinstance(source, str):
+        with open(source) as stream:
+            return parse_newick(stream)
+    chunks = source if not hasattr(source, "read") else read_chunks(source)
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.done:
+            break
+    parser.close()
+    return parser
+
+
+def resolve_taxa(parser, namespace, is_leaf):
+    """
+    Returns the taxa in `namespace` named by the leaf labels of a parsed
+    tree, in node order, creating any that are missing.
+    """
+    leaves = [i for i, label in enumerate(parser.labels) if is_leaf[i] and label is not None]
+    taxa = require_taxa(namespace, [parser.labels[i] for i in leaves])
+    if len(set(taxa)) != len(taxa):
+        seen = set()
+        for taxon in taxa:
+            if taxon in seen:
+                raise DataParseError(message=f"Multiple occurrences of the taxon '{taxon.label}' in the tree")
+            seen.add(taxon)
+    return zip(leaves, taxa)
+
+
+def leaf_flags(parser):
+    """Returns a bytearray flagging the nodes of a parsed tree that have no children."""
+    is_leaf = bytearray(b"\x01") * len(parser.parents)
+    for parent in parser.parents:
+        if parent != NO_NODE:
+            is_leaf[parent] = 0
+    return is_leaf
+
+
+# DendroPy 4 keeps a node's links in these attributes. Its Node.set_child_nodes
+# adds the children one at a time, checking each against those already there,
+# which is quadratic in the size of a polytomy
+DIRECT_LINKS = dendropy.__version__.split(".")[0] == "4" and hasattr(dendropy.Node(), "_child_nodes")
+
+
+def set_child_nodes(parent, children):
+    """
+    Makes the list `children` the child nodes of the childless `parent`, like
+    `parent.set_child_nodes(children)` but in linear time where the DendroPy
+    version allows.
+    """
+    if DIRECT_LINKS:
+        for child in children:
+            child._parent_node = parent
+        parent._child_nodes = children
+    else:
+        parent.set_child_nodes(children)
+
+
+def read_tree(source, namespace=None):
+    """
+    Reads the first tree in `source`, a path, a text stream or an iterable of
+    text chunks, into a DendroPy tree on the taxon namespace `namespace` (or
+    a new one), like `dendropy.Tree.get(schema="newick", rooting="default-rooted")`.
+    """
+    parser = source if isinstance(source, NewickParser) else parse_newick(source)
+    if namespace is None:
+        namespace = dendropy.TaxonNamespace()
+    is_leaf = leaf_flags(parser)
+    nodes = []
+    children = {}
+    for i, (parent, label, length) in enumerate(zip(parser.parents, parser.labels, parser.lengths)):
+        node = dendropy.Node(label=None if is_leaf[i] else label, edge_length=None if isnan(length) else length)
+        if parent != NO_NODE:
+            children.setdefault(parent, []).append(node)
+        nodes.append(node)
+    for parent, child_nodes in children.items():
+        set_child_nodes(nodes[parent], child_nodes)
+    for i, taxon in resolve_taxa(parser, namespace, is_leaf):
+        nodes[i].taxon = taxon
+    # Passing seed_node to the constructor would add every taxon to the
+    # namespace a second time
+    tree = dendropy.Tree(taxon_namespace=namespace, is_rooted=parser.is_rooted)
+    tree.seed_node = nodes[0]
+    return tree
+
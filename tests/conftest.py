@@ -1,14 +1,38 @@
 from __future__ import division
 
 import os
+
+import numpy as np
 import pytest
 
+from tact.lib import BACKENDS, copy_tree, get_tree, lik_constant, pack_ages, prepare_ages
+
+
+@pytest.fixture(scope="session", autouse=True)
+def compiled_kernels():
+    """
+    Compiles the numba kernels, which numba does on their first call, before
+    hypothesis starts timing the tests.
+    """
+    if "numba" in BACKENDS:
+        jit = BACKENDS["numba"]
+        ages = [[2.0, 1.0], [3.0]]
+        lik_constant((0.5, 0.1), 0.5, ages[0], p1=jit.p1)
+        jit.lik_constant_ra((0.5, 0.1), 0.5, prepare_ages(ages[0]))
+        jit.lik_constant_ra_batch(np.array([[0.5, 0.1]] * 2), np.array([0.5, 1.0]), pack_ages(ages))
+
 
 @pytest.fixture
 def datadir():
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
 
+@pytest.fixture
+def backbone(datadir):
+    """A copy of the weirdness backbone that tests are free to graft onto."""
+    return copy_tree(get_tree(os.path.join(datadir, "weirdness.backbone.tre")))
+
+
 @pytest.fixture
 def ages():
     return [20.934955, 17.506532, 16.64467, 15.380987, 14.547092000000001,
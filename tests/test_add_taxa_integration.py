@@ -1,8 +1,12 @@
+import csv
 import pytest
+import re
 import sys
 import os
 
-from dendropy import Tree
+from dendropy import Tree, TreeList
+
+from tact.lib import get_ages, get_tip_labels, lik_constant
 
 execution_number = range(2)
 
@@ -77,3 +81,147 @@ def test_stem_clade_attachment(script_runner, execution_number, datadir):
     node = tacted.mrca(taxon_labels=["c1", "c2", "c3", "c4", "c5"])
     ages = [x.age < 15.16 for x in node.postorder_internal_node_iter()]
     assert any(ages)
+
+
+def test_rates_cache(script_runner, datadir, tmpdir):
+    backbone = os.path.join(datadir, "stem2.backbone.tre")
+    taxonomy = os.path.join(datadir, "stem2.taxonomy.tre")
+    cache = str(tmpdir.join("cache"))
+    outputs = []
+    for run in range(2):
+        output = str(tmpdir.join(f"run{run}"))
+        result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "--rates-cache", cache, "-vv")
+        assert result.returncode == 0
+        outputs.append(output)
+    assert len(os.listdir(cache)) == 1
+    with open(outputs[1] + ".log.txt") as rfile:
+        assert "Using cached rates" in rfile.read()
+    with open(outputs[0] + ".rates.csv") as first, open(outputs[1] + ".rates.csv") as second:
+        assert first.read() == second.read()
+
+
+@pytest.mark.parametrize("stem", ["weirdness", "stem2"])
+def test_batch_rate_engine(script_runner, datadir, tmpdir, stem):
+    backbone = os.path.join(datadir, stem + ".backbone.tre")
+    taxonomy = os.path.join(datadir, stem + ".taxonomy.tre")
+    rates = {}
+    for engine in ["serial", "batch"]:
+        output = str(tmpdir.join(engine))
+        result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "--rate-engine", engine, "-vv")
+        assert result.returncode == 0
+        with open(output + ".rates.csv") as rfile:
+            rates[engine] = list(csv.reader(rfile))
+    assert len(rates["serial"]) == len(rates["batch"])
+
+    backbone = Tree.get(path=backbone, schema="newick", rooting="default-rooted")
+    backbone.calc_node_ages()
+    taxonomy = Tree.get(path=taxonomy, schema="newick", rooting="default-rooted")
+    sampled = get_tip_labels(backbone)
+    for serial, batch in zip(rates["serial"][1:], rates["batch"][1:]):
+        assert serial[0] == batch[0]
+        assert serial[3:] == batch[3:]
+        if batch[4] != "computed":
+            continue
+        # The batch engine may stop elsewhere on a flat likelihood surface, but never at a worse fit
+        species = get_tip_labels(taxonomy.find_node_with_label(batch[0]))
+        mrca = backbone.mrca(taxon_labels=species & sampled)
+        sf = len(mrca.leaf_nodes()) / len(species)
+        ages = get_ages(mrca)
+        expected = lik_constant((float(serial[1]), float(serial[2])), sf, ages)
+        assert lik_constant((float(batch[1]), float(batch[2])), sf, ages) <= expected + 1e-6 * (1 + abs(expected))
+
+
+@pytest.mark.parametrize("stem", ["weirdness", "stem2"])
+def test_lazy_rate_engine(script_runner, datadir, tmpdir, stem):
+    backbone = os.path.join(datadir, stem + ".backbone.tre")
+    taxonomy = os.path.join(datadir, stem + ".taxonomy.tre")
+    rates = {}
+    for engine in ["serial", "lazy"]:
+        output = str(tmpdir.join(engine))
+        result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "--rate-engine", engine, "-vv")
+        assert result.returncode == 0
+        with open(output + ".rates.csv") as rfile:
+            rates[engine] = list(csv.reader(rfile))
+    # Every rate the lazy engine needed is the same as in the full table
+    for row in rates["lazy"]:
+        assert row in rates["serial"]
+
+
+@pytest.mark.parametrize("warm_start", [[], ["--warm-start"]])
+def test_parallel_rates(script_runner, datadir, tmpdir, warm_start):
+    backbone = os.path.join(datadir, "weirdness.backbone.tre")
+    taxonomy = os.path.join(datadir, "weirdness.taxonomy.tre")
+    rates = []
+    for cores in ["1", "3"]:
+        output = str(tmpdir.join(f"cores{cores}"))
+        result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "--cores", cores, *warm_start)
+        assert result.returncode == 0
+        with open(output + ".rates.csv") as rfile:
+            rates.append(rfile.read())
+    assert rates[0] == rates[1]
+
+
+def test_replicates(script_runner, datadir, tmpdir):
+    backbone = os.path.join(datadir, "stem2.backbone.tre")
+    taxonomy = os.path.join(datadir, "stem2.taxonomy.tre")
+    taxed = Tree.get(path=taxonomy, schema="newick")
+    outputs = []
+    for run in range(2):
+        output = str(tmpdir.join(f"run{run}"))
+        result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "--replicates", "3", "--seed", "1")
+        assert result.returncode == 0
+        outputs.append(output)
+    with open(outputs[0] + ".newick.tre") as first, open(outputs[1] + ".newick.tre") as second:
+        assert first.read() == second.read()
+    expected = set(x.taxon.label for x in taxed.leaf_node_iter())
+    for schema in ["newick", "nexus"]:
+        trees = TreeList.get(path=outputs[0] + "." + schema + ".tre", schema=schema)
+        assert len(trees) == 3
+        for tree in trees:
+            assert set(x.taxon.label for x in tree.leaf_node_iter()) == expected
+
+
+def test_parallel_replicates(script_runner, datadir, tmpdir):
+    backbone = os.path.join(datadir, "weirdness.backbone.tre")
+    taxonomy = os.path.join(datadir, "weirdness.taxonomy.tre")
+    trees = []
+    for cores, replicates in [("1", "1"), ("1", "4"), ("3", "4")]:
+        output = str(tmpdir.join(f"cores{cores}-{replicates}"))
+        result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "--replicates", replicates, "--cores", cores, "--seed", "42")
+        assert result.returncode == 0
+        with open(output + ".newick.tre") as rfile:
+            trees.append(rfile.read().splitlines())
+    # Each replicate has its own random stream, whatever the number of cores
+    assert trees[1] == trees[2]
+    assert trees[0] == trees[1][:1]
+
+
+def test_logged_seed(script_runner, datadir, tmpdir):
+    backbone = os.path.join(datadir, "weirdness.backbone.tre")
+    taxonomy = os.path.join(datadir, "weirdness.taxonomy.tre")
+    output = str(tmpdir.join("unseeded"))
+    result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "-v")
+    assert result.returncode == 0
+    with open(output + ".log.txt") as lfile:
+        seed = re.search(r"Using random seed (\d+)", lfile.read()).group(1)
+    # The logged seed reproduces an unseeded single replicate
+    rerun = str(tmpdir.join("reseeded"))
+    result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", rerun, "--seed", seed)
+    assert result.returncode == 0
+    with open(output + ".newick.tre") as first, open(rerun + ".newick.tre") as second:
+        assert first.read() == second.read()
+
+
+@pytest.mark.parametrize("stem", ["intrusion", "short_branch"])
+def test_parallel_units(script_runner, datadir, tmpdir, stem):
+    backbone = os.path.join(datadir, stem + ".backbone.tre")
+    taxonomy = os.path.join(datadir, stem + ".taxonomy.tre")
+    trees = []
+    for cores in ["1", "3"]:
+        output = str(tmpdir.join(f"cores{cores}"))
+        result = script_runner.run("tact_add_taxa", "--taxonomy", taxonomy, "--backbone", backbone, "--output", output, "--cores", cores, "--seed", "5")
+        assert result.returncode == 0
+        with open(output + ".newick.tre") as rfile:
+            trees.append(rfile.read())
+    # Each independent taxon has its own random stream, whatever the number of cores
+    assert trees[0] == trees[1]
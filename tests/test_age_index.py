@@ -0,0 +1,19 @@
+from __future__ import division
+
+import os
+
+import pytest
+
+from tact.lib import AgeIndex, get_ages, get_tree
+
+
+@pytest.mark.parametrize("stem", ["weirdness", "stem2", "short_branch"])
+def test_age_index(datadir, stem):
+    tree = get_tree(os.path.join(datadir, stem + ".backbone.tre"))
+    index = AgeIndex(tree)
+    for node in tree.preorder_node_iter():
+        assert get_ages(node, index=index) == get_ages(node)
+        if node.is_internal():
+            # Each subtree is only sorted once
+            assert index.get_ages(node) is index.get_ages(node)
+    assert get_ages(tree.seed_node, include_root=True, index=index) == get_ages(tree.seed_node, include_root=True)
@@ -1,9 +1,11 @@
 from __future__ import division
 
+import numpy as np
+import pytest
 from hypothesis import given, settings
 import hypothesis.strategies as st
 
-from tact.lib import optim_bd
+from tact.lib import BACKENDS, get_ra, grid_optim, lik_constant_ra, lik_constant_ra_batch, lik_constant_ra_grid, optim_bd, optim_bd_batch, optim_stats, pack_ages, prepare_ages
 
 
 @settings(deadline=1500)
@@ -16,5 +18,81 @@ def test_birth_death_can_run(x1, x2):
     assert (d / b) <= 1
 
 
-def test_birth_death(ages, sampling):
-    optim_bd(ages, sampling)
+@pytest.mark.parametrize("fallback", ["grid", "annealing"])
+def test_birth_death(ages, sampling, fallback):
+    optim_bd(ages, sampling, fallback=fallback)
+
+
+def test_grid_optim(ages, sampling):
+    bounds = ((1e-9, 100), (0, 1 - 1e-9))
+    t = prepare_ages(ages)
+    x = grid_optim(lik_constant_ra, lik_constant_ra_grid, bounds, (sampling, t), jac=True)
+    expected = get_ra(*optim_bd(ages, sampling))
+    assert lik_constant_ra(x, sampling, t)[0] == pytest.approx(lik_constant_ra(expected, sampling, t)[0])
+
+
+@given(st.lists(st.floats(min_value=1e-3, max_value=100), min_size=1, max_size=50), st.floats(min_value=1e-3, max_value=1), st.floats(min_value=1e-3, max_value=10), st.floats(min_value=0, max_value=0.99))
+def test_lik_constant_ra_grid(ages, sampling, r, a):
+    t = prepare_ages(ages)
+    batched = lik_constant_ra_grid(np.array([[r, a]]), sampling, t)
+    assert batched[0] == pytest.approx(lik_constant_ra((r, a), sampling, t)[0])
+
+
+def test_birth_death_warm_start(ages, sampling):
+    t = prepare_ages(ages)
+    cold = optim_bd(ages, sampling)
+    before = optim_stats["iterations"]
+    warm = optim_bd(ages, sampling, starts=[cold, (1.0, 2.0)])
+    assert optim_stats["iterations"] - before <= 2
+    assert lik_constant_ra(get_ra(*warm), sampling, t)[0] == pytest.approx(lik_constant_ra(get_ra(*cold), sampling, t)[0])
+
+
+clade_ages = st.lists(st.floats(min_value=1e-3, max_value=100), min_size=1, max_size=30)
+
+
+@given(st.lists(st.tuples(clade_ages, st.floats(min_value=1e-3, max_value=1), st.floats(min_value=1e-3, max_value=10), st.floats(min_value=0, max_value=0.99)), min_size=1, max_size=10))
+def test_lik_constant_ra_batch(clades):
+    ages, sampling, r, a = zip(*clades)
+    x = np.stack((r, a), axis=1)
+    packed = pack_ages(ages)
+    lik, grad, hess = lik_constant_ra_batch(x, np.array(sampling), packed)
+    for i in range(len(clades)):
+        expected, expected_grad = lik_constant_ra(x[i], sampling[i], prepare_ages(ages[i]))
+        assert lik[i] == pytest.approx(expected)
+        with np.errstate(under="ignore"):
+            assert np.allclose(grad[i], expected_grad, rtol=1e-6, atol=1e-6)
+
+    # Central differences of the gradient, one parameter at a time
+    for j in range(2):
+        step = np.zeros_like(x)
+        step[:, j] = 1e-6 * np.maximum(1, x[:, j])
+        upper = lik_constant_ra_batch(x + step, np.array(sampling), packed)[1]
+        lower = lik_constant_ra_batch(x - step, np.array(sampling), packed)[1]
+        numeric = (upper - lower) / (2 * step[:, j, None])
+        scale = 1 + np.max(np.abs(hess), axis=(1, 2))
+        assert np.all(np.abs(hess[:, :, j] - numeric) <= 1e-4 * scale[:, None])
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@given(st.lists(st.tuples(clade_ages, st.floats(min_value=1e-3, max_value=1), st.floats(min_value=1e-3, max_value=10), st.floats(min_value=0, max_value=0.99)), min_size=1, max_size=10))
+def test_lik_constant_ra_batch_backends(backend, clades):
+    ages, sampling, r, a = zip(*clades)
+    x = np.stack((r, a), axis=1)
+    packed = pack_ages(ages)
+    t = prepare_ages(ages[0])
+    expected = BACKENDS["numpy"].lik_constant_ra_batch(x, np.array(sampling), packed)
+    actual = BACKENDS[backend].lik_constant_ra_batch(x, np.array(sampling), packed)
+    for e, a in zip(expected, actual):
+        assert a == pytest.approx(e, rel=1e-9, abs=1e-9)
+    expected = BACKENDS["numpy"].lik_constant_ra_grid(x, sampling[0], t)
+    assert BACKENDS[backend].lik_constant_ra_grid(x, sampling[0], t) == pytest.approx(expected, rel=1e-9)
+
+
+@settings(deadline=None)
+@given(st.lists(st.tuples(clade_ages, st.floats(min_value=1e-3, max_value=1)), min_size=1, max_size=10))
+def test_birth_death_batch(clades):
+    ages, sampling = zip(*clades)
+    for i, (b, d) in enumerate(optim_bd_batch(ages, sampling)):
+        t = prepare_ages(ages[i])
+        expected = lik_constant_ra(get_ra(*optim_bd(ages[i], sampling[i])), sampling[i], t)[0]
+        assert lik_constant_ra(get_ra(b, d), sampling[i], t)[0] <= expected + 1e-6 * (1 + abs(expected))
@@ -0,0 +1,124 @@
+from __future__ import division
+
+import random
+
+import pytest
+
+from tact import compact
+from tact.compact import NO_NODE, CompactTree
+from tact.lib import is_locked
+
+
+def newick(tree):
+    return tree.as_string(schema="newick", suppress_rooting=True)
+
+
+def check_counts(tree):
+    for node in tree.preorder(tree.root):
+        edges = list(tree.edges(node))
+        unlocked = [x for x in edges if not tree.is_locked(x)]
+        assert tree.leaves[node] == sum(1 for x in tree.preorder(node) if tree.first_child[x] == NO_NODE)
+        assert tree.locked_edges[node] == len(edges) - len(unlocked)
+        assert tree.unlocked_edges[node] == len(unlocked)
+        assert tree.get_min_age(node) == min((tree.age[x] for x in unlocked), default=0.0)
+    assert tree.mask == tree.taxa_below(tree.root)
+    assert tree.tips == len([x for x in tree.preorder(tree.root) if tree.taxon[x] != NO_NODE])
+    for node, ages in tree.age_lists.items():
+        assert ages == sorted(tree.age[x] for x in tree.preorder(node) if tree.first_child[x] != NO_NODE)
+
+
+def edit_randomly(tree, steps=10):
+    """
+    Makes `steps` random changes to a `CompactTree`, each filling in taxa
+    below, grafting a clade onto or locking one of the nodes first in the tree.
+    """
+    recipients = [x for x in tree.preorder(tree.root) if tree.first_child[x] != NO_NODE]
+    for i in range(steps):
+        recipient = recipients[random.randrange(len(recipients))]
+        if tree.is_fully_locked(recipient):
+            continue
+        age = tree.age[recipient]
+        stem = tree.parent[recipient] != NO_NODE
+        action = random.random()
+        names = [f"new {i} {j}" for j in range(4)]
+        if action < 0.4:
+            ages = sorted((random.uniform(tree.get_min_age(recipient), age) for _ in range(3)), reverse=True)
+            compact.fill_new_taxa(tree, recipient, names[:3], ages, stem)
+        elif action < 0.8:
+            ages = sorted(random.uniform(0, age) for _ in range(4))
+            compact.graft_node(tree, recipient, compact.create_clade(tree, names, ages), stem)
+        else:
+            tree.lock_clade(recipient)
+
+
+def test_round_trip(backbone):
+    ctree = CompactTree.from_dendropy(backbone)
+    check_counts(ctree)
+    assert newick(ctree.to_dendropy()) == newick(backbone)
+    ctree.lock_clade(ctree.first_child[ctree.first_child[ctree.root]])
+    tree = ctree.to_dendropy()
+    new_tree = CompactTree.from_dendropy(tree).to_dendropy()
+    assert newick(new_tree) == newick(tree)
+    for old, new in zip(tree.preorder_node_iter(), new_tree.preorder_node_iter()):
+        assert old.age == new.age
+        assert is_locked(old.edge) == is_locked(new.edge)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_edits(backbone, seed):
+    random.seed(seed)
+    tree = CompactTree.from_dendropy(backbone)
+    for x in tree.preorder(tree.root):
+        if tree.first_child[x] != NO_NODE:
+            tree.get_ages(x)
+    edit_randomly(tree)
+    check_counts(tree)
+    assert tree.is_binary(tree.root)
+    for x in tree.edges(tree.root):
+        assert tree.age[x] + tree.length[x] == pytest.approx(tree.age[tree.parent[x]])
+    tree.lock_clade(tree.root)
+    check_counts(tree)
+    assert tree.is_fully_locked(tree.root)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_clade_round_trip(backbone, seed):
+    random.seed(seed)
+    tree = CompactTree.from_dendropy(backbone)
+    expected = newick(tree.to_dendropy())
+    node = random.choice([x for x in tree.preorder(tree.root) if tree.parent[x] != NO_NODE])
+    clade = tree.clade(node)
+    check_counts(clade)
+    assert clade.age[clade.root] == tree.age[tree.parent[node]]
+    assert clade.mask == tree.taxa_below(node)
+    tree.replace(node, tree.unpack(clade.pack(clade.root))[0])
+    check_counts(tree)
+    assert tree.get_monophyletic(clade.mask) is not None
+    assert newick(tree.to_dendropy()) == expected
+
+
+def test_get_monophyletic(backbone):
+    tree = CompactTree.from_dendropy(backbone)
+    for node in tree.preorder(tree.root):
+        mask = tree.taxa_below(node)
+        assert tree.get_monophyletic(mask) == node
+        if tree.first_child[node] != NO_NODE:
+            # Drop one leaf, and what is left is not a clade unless it is one by itself
+            leaf = next(x for x in tree.preorder(node) if tree.first_child[x] == NO_NODE)
+            rest = mask & ~(1 << tree.taxon[leaf])
+            below = tree.get_monophyletic(rest)
+            assert below is None or tree.taxa_below(below) == rest
+
+
+def test_require_taxa(backbone):
+    tree = CompactTree.from_dendropy(backbone)
+    namespace = backbone.taxon_namespace
+    existing = tree.taxa[0]
+    ids = tree.require_taxa([existing.label, "brand new"])
+    assert ids[0] == 0
+    assert tree.taxa[ids[1]] is namespace[len(namespace) - 1]
+    assert tree.require_taxa(["brand new"]) == ids[1:]
+    # Taxa added behind the tree's back are found rather than duplicated
+    outside = namespace.require_taxon("from outside")
+    assert tree.taxa[tree.require_taxa(["from outside"])[0]] is outside
+    assert len(tree.taxa) == len(namespace)
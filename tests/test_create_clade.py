@@ -1,11 +1,16 @@
 from __future__ import division
 
+import collections
+import random
+
+import dendropy
+import pytest
 from hypothesis import given, assume
 import hypothesis.strategies as st
 
 from dendropy import TaxonNamespace
 
-from tact.cli_add_taxa import create_clade, edge_iter
+from tact.compact import CompactTree, create_clade
 
 
 @given(st.lists(
@@ -20,9 +25,55 @@ def test_create_clade(data):
     spp = data.keys()
     ages = list(data.values())
     assume(len(set(ages)) == len(ages))
-    tn = TaxonNamespace(spp, label="taxa")
-    clade = create_clade(tn, spp, ages)
-    xx = [x.label == "locked" for x in edge_iter(clade.seed_node)]
+    tree = CompactTree(TaxonNamespace(spp, label="taxa"))
+    seed = create_clade(tree, spp, ages)
+    xx = [tree.is_locked(x) for x in tree.edges(seed)]
     cnt = sum(xx)
-    tot = len(list(edge_iter(clade.seed_node)))
+    tot = len(list(tree.edges(seed)))
     assert(tot == cnt + 1)
+
+
+def create_clade_orig(namespace, species, ages):
+    """Original version of create_clade's topology, here for testing and comparison purposes."""
+    tree = dendropy.Tree(taxon_namespace=namespace)
+    species = sorted(species)
+    ages = sorted(ages, reverse=True)
+    tree.seed_node.age = ages.pop(0)
+    node = tree.seed_node.new_child()
+    node.age = ages.pop(0)
+    for age in ages:
+        valid_nodes = [x for x in tree.nodes() if len(x.child_nodes()) < 2 and age < x.age and x != tree.seed_node]
+        node = random.sample(valid_nodes, 1).pop()
+        child = node.new_child()
+        child.age = age
+    random.shuffle(species)
+    for node in tree.preorder_node_iter(filter_fn=lambda x: x.age > 0 and x != tree.seed_node):
+        while len(node.child_nodes()) < 2 and len(species) > 0:
+            new_leaf = node.new_child(taxon=namespace.require_taxon(species.pop()))
+            new_leaf.age = 0.0
+    return tree
+
+
+def ranked_topology(node):
+    # Species are shuffled independently of the shape, so only the shape is compared
+    if node.is_leaf():
+        return "*"
+    return f"{float(node.age)}(" + ",".join(sorted(ranked_topology(x) for x in node.child_nodes())) + ")"
+
+
+@pytest.mark.parametrize("ages", [[5, 4, 3, 2, 1], [5, 4, 3, 3, 1]])
+def test_create_clade_distribution(ages):
+    random.seed(1)
+    runs = 3000
+    tn = TaxonNamespace(label="taxa")
+    species = ["A", "B", "C", "D", "E"]
+    tree = CompactTree(tn)
+    counts = collections.Counter(
+        ranked_topology(tree.node(create_clade(tree, species, list(ages)))) for _ in range(runs)
+    )
+    expected = collections.Counter(
+        ranked_topology(create_clade_orig(tn, species, list(ages)).seed_node) for _ in range(runs)
+    )
+    assert set(counts) == set(expected)
+    for key, count in expected.items():
+        assert counts[key] == pytest.approx(count, abs=5 * count ** 0.5)
@@ -0,0 +1,91 @@
+from __future__ import division
+
+import collections
+import random
+
+import dendropy
+import pytest
+
+from tact.compact import NO_NODE, CompactTree, graft_node, graft_nodes
+
+
+def new_grafts(tree, ages):
+    grafts = []
+    for i, age in enumerate(ages):
+        node = tree.new_node(age)
+        tree.append_child(node, tree.new_node(0.0, tree.require_taxa([f"new{i}"])[0], age))
+        tree.recount(node)
+        grafts.append(node)
+    return grafts
+
+
+def graft_by_scan(tree, node, graft, stem):
+    """Places `graft` by checking every edge of the clade, as a reference for the sweep."""
+    age = tree.age[graft]
+
+    def eligible(x):
+        return tree.age[x] <= age and tree.age[tree.parent[x]] >= age and not tree.is_locked(x)
+
+    eligible_nodes = [x for x in tree.edges(node) if eligible(x)]
+    if stem and tree.parent[node] != NO_NODE and eligible(node):
+        eligible_nodes.append(node)
+    focal_node = random.choice(eligible_nodes)
+    tree.splice(focal_node, graft)
+    return graft if tree.parent[node] == graft else node
+
+
+def topology(node):
+    if node.is_leaf():
+        return node.taxon.label
+    return "(" + ",".join(sorted(topology(x) for x in node.child_nodes())) + ")"
+
+
+def spray(method, stem):
+    tree = dendropy.Tree.get(data="(((A:1,B:1):1,C:2):1,D:3);", schema="newick", rooting="force-rooted")
+    tree.calc_node_ages()
+    tree = CompactTree.from_dendropy(tree)
+    # ((A,B),C)
+    node = tree.first_child[tree.root]
+    grafts = new_grafts(tree, [2.5, 1.5, 0.5, 0.5] if stem else [1.5, 0.5, 0.5])
+    if method == "bulk":
+        graft_nodes(tree, node, grafts, stem)
+    else:
+        for graft in grafts:
+            node = (graft_node if method == "single" else graft_by_scan)(tree, node, graft, stem)
+    return topology(tree.node(tree.root))
+
+
+@pytest.mark.parametrize("stem", [False, True])
+@pytest.mark.parametrize("method", ["bulk", "single"])
+def test_graft_nodes_distribution(stem, method):
+    random.seed(1)
+    runs = 3000
+    expected = collections.Counter(spray("scan", stem) for _ in range(runs))
+    counts = collections.Counter(spray(method, stem) for _ in range(runs))
+    assert set(counts) == set(expected)
+    for key in expected:
+        assert counts[key] == pytest.approx(expected[key], abs=5 * (runs / len(expected)) ** 0.5)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_graft_nodes(backbone, seed):
+    random.seed(seed)
+    tree = CompactTree.from_dendropy(backbone)
+    node = random.choice([x for x in tree.preorder(tree.root) if tree.parent[x] != NO_NODE and tree.leaves[x] > 3])
+    stem = random.random() < 0.5
+    locked = random.choice(tree.children(node))
+    locked_tips = tree.taxa_below(locked)
+    tree.lock_clade(locked)
+    told = tree.age[tree.parent[node]] if stem else tree.age[node]
+    ages = sorted((random.uniform(0, told) for _ in range(30)), reverse=True)
+    grafts = new_grafts(tree, ages)
+    new_tips = 0
+    for graft in grafts:
+        new_tips |= tree.taxa_below(graft)
+    crown = graft_nodes(tree, node, grafts, stem)
+    assert tree.is_binary(tree.root)
+    assert tree.taxa_below(crown) & new_tips == new_tips
+    assert tree.taxa_below(locked) == locked_tips
+    for x in tree.edges(tree.root):
+        assert tree.length[x] >= 0
+        assert tree.age[x] + tree.length[x] == pytest.approx(tree.age[tree.parent[x]])
@@ -1,9 +1,57 @@
 from __future__ import division
+import os
+import subprocess
+import sys
+from decimal import Decimal as D
+from decimal import localcontext
+
+import numpy as np
 import pytest
 from hypothesis import given, assume
 import hypothesis.strategies as st
+from scipy.optimize import approx_fprime
+
+from tact.lib import BACKENDS, p0, p1, intp1, p1_math, p1_numpy, lik_constant, lik_constant_ra, prepare_ages, wrapped_lik_constant
+
+
+def p0_exact(t, l, m, rho):
+    """Exact version of p0 using Decimal math."""
+    t = D(t)
+    l = D(l)
+    m = D(m)
+    rho = D(rho)
+    return D(1) - rho * (l - m) / (rho * l + (l * (D(1) - rho) - m) * (-(l - m) * t).exp())
+
+
+def p1_exact(t, l, m, rho):
+    """Exact version of p1 using Decimal math."""
+    t = D(t)
+    l = D(l)
+    m = D(m)
+    rho = D(rho)
+    num = rho * (l - m) ** D(2) * (-(l - m) * t).exp()
+    denom = (rho * l + (l * (1 - rho) - m) * (-(l - m) * t).exp()) ** D(2)
+    return num / denom
 
-from tact.lib import p1, p1_orig, p1_exact, lik_constant
+
+def p1_orig(t, l, m, rho):
+    """Original version of p1, here for testing and comparison purposes."""
+    try:
+        num = rho * (l - m) ** 2 * np.exp(-(l - m) * t)
+        denom = (rho * l + (l * (1 - rho) - m) * np.exp(-(l - m) * t)) ** 2
+        return num / denom
+    except (OverflowError, FloatingPointError):
+        return float(p1_exact(t, l, m, rho))
+
+
+def intp1_exact(t, l, m):
+    """Exact version of intp1 using Decimal math."""
+    l = D(l)
+    m = D(m)
+    t = D(t)
+    num = D(1) - (-(l - m) * t).exp()
+    denom = l - m * (-(l - m) * t).exp()
+    return num / denom
 
 
 def test_lik_constant_exact(benchmark, birth, death, sampling, ages):
@@ -15,10 +63,128 @@ def test_lik_constant_orig(benchmark, birth, death, sampling, ages):
 
 
 def test_lik_constant_opt(benchmark, birth, death, sampling, ages):
-    benchmark(lik_constant, (birth, death), sampling, ages, p1=p1)
+    benchmark(lik_constant, (birth, death), sampling, ages, p1=p1_numpy)
+
+
+def test_lik_constant_math(benchmark, birth, death, sampling, ages):
+    benchmark(lik_constant, (birth, death), sampling, ages, p1=p1_math)
+
+
+def test_lik_constant_jit(benchmark, birth, death, sampling, ages):
+    jit = pytest.importorskip("tact.jit")
+    benchmark(lik_constant, (birth, death), sampling, ages, p1=jit.p1)
+
+
+def test_lik_constant_ra(benchmark, birth, death, sampling, ages):
+    benchmark(lik_constant_ra, (birth - death, death / birth), sampling, prepare_ages(ages))
 
 
 @given(birth=st.floats(min_value=1e-6, max_value=10), death=st.floats(min_value=0, max_value=10), sampling=st.floats(min_value=1e-9, max_value=1), ages=st.lists(st.floats(min_value=0, max_value=5000), min_size=1))
 def test_lik_constants(birth, death, sampling, ages):
     assume(birth > death)
     assert lik_constant((birth, death), sampling, ages, p1=p1) == pytest.approx(lik_constant((birth, death), sampling, ages, p1=p1_orig))
+
+
+def backend_in_subprocess(backend, code="import tact.lib"):
+    code += "; print(tact.lib.get_backend())"
+    env = dict(os.environ, TACT_BACKEND=backend)
+    return subprocess.run(
+        [sys.executable, "-c", code], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+
+
+@pytest.mark.parametrize("backend", ["math", "numpy"])
+def test_backend_override(backend):
+    assert backend_in_subprocess(backend).stdout.strip() == backend
+
+
+def test_backend_without_numba():
+    # Hide numba, if it is installed at all
+    out = backend_in_subprocess("numba", "import sys; sys.modules['numba'] = None; import tact.lib")
+    assert out.stdout.strip() == "numpy"
+    assert "numba is not installed" in out.stderr
+
+
+@given(birth=st.floats(min_value=1e-6, max_value=10), death=st.floats(min_value=0, max_value=10), sampling=st.floats(min_value=1e-9, max_value=1), ages=st.lists(st.floats(min_value=0, max_value=5000), min_size=1))
+def test_lik_constant_math_matches(birth, death, sampling, ages):
+    expected = lik_constant((birth, death), sampling, list(ages), p1=p1_numpy)
+    assert lik_constant((birth, death), sampling, list(ages), p1=p1_math) == pytest.approx(expected)
+
+
+@given(birth=st.floats(min_value=1e-6, max_value=10), death=st.floats(min_value=0, max_value=10), sampling=st.floats(min_value=1e-9, max_value=1), ages=st.lists(st.floats(min_value=0, max_value=5000), min_size=1))
+def test_lik_constant_jit_matches(birth, death, sampling, ages):
+    jit = pytest.importorskip("tact.jit")
+    expected = lik_constant((birth, death), sampling, list(ages), p1=p1_numpy)
+    assert lik_constant((birth, death), sampling, list(ages), p1=jit.p1) == pytest.approx(expected)
+
+
+rates = st.floats(min_value=1e-6, max_value=100)
+times = st.floats(min_value=0, max_value=5000)
+fractions = st.floats(min_value=1e-9, max_value=1)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@given(t=times, l=rates, m=rates, rho=fractions)
+def test_p0_stable(backend, t, l, m, rho):
+    assume(l != m)
+    with localcontext() as ctx:
+        ctx.prec = 80
+        expected = float(p0_exact(t, l, m, rho))
+    assert BACKENDS[backend][0](t, l, m, rho) == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@given(t=times, l=rates, m=rates, rho=fractions)
+def test_p1_stable(backend, t, l, m, rho):
+    assume(l != m)
+    with localcontext() as ctx:
+        ctx.prec = 80
+        expected = float(p1_exact(t, l, m, rho))
+    assume(expected == 0 or expected > 1e-300)
+    assert BACKENDS[backend][1](t, l, m, rho) == pytest.approx(expected, rel=1e-9)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@given(t=times, l=rates, m=rates)
+def test_intp1_stable(backend, t, l, m):
+    assume(l != m)
+    with localcontext() as ctx:
+        ctx.prec = 80
+        expected = float(intp1_exact(t, l, m))
+    assert BACKENDS[backend][2](t, l, m) == pytest.approx(expected, rel=1e-9)
+
+
+@given(ts=st.lists(times, min_size=1), l=rates, m=rates, rho=fractions)
+def test_decay_functions_accept_arrays(ts, l, m, rho):
+    t = np.array(ts)
+    assert p0(t, l, m, rho) == pytest.approx([p0(x, l, m, rho) for x in ts])
+    assert p1(t, l, m, rho) == pytest.approx([p1(x, l, m, rho) for x in ts])
+    assert intp1(t, l, m) == pytest.approx([intp1(x, l, m) for x in ts])
+
+
+@given(r=st.floats(min_value=1e-3, max_value=10), a=st.floats(min_value=0, max_value=0.99), sampling=st.floats(min_value=1e-3, max_value=1), ages=st.lists(st.floats(min_value=1e-3, max_value=50), min_size=1))
+def test_lik_constant_ra_matches(r, a, sampling, ages):
+    expected = wrapped_lik_constant((r, a), sampling, list(ages))
+    assume(expected < 1e300)
+    lik, _ = lik_constant_ra((r, a), sampling, prepare_ages(ages))
+    assert lik == pytest.approx(expected)
+
+
+@given(r=st.floats(min_value=1e-2, max_value=2), a=st.floats(min_value=0, max_value=0.9), sampling=st.floats(min_value=1e-2, max_value=1), ages=st.lists(st.floats(min_value=1e-2, max_value=50), min_size=1, max_size=50))
+def test_lik_constant_ra_gradient(r, a, sampling, ages):
+    t = prepare_ages(ages)
+    x = np.array([r, a])
+    _, grad = lik_constant_ra(x, sampling, t)
+    with np.errstate(all="ignore"):
+        numeric = approx_fprime(x, lambda y: lik_constant_ra(y, sampling, t)[0], 1e-7)
+    assert grad == pytest.approx(numeric, rel=1e-3, abs=1e-2)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@given(r=st.floats(min_value=1e-3, max_value=10), a=st.floats(min_value=0, max_value=0.99), sampling=st.floats(min_value=1e-3, max_value=1), ages=st.lists(st.floats(min_value=1e-3, max_value=50), min_size=1))
+def test_lik_constant_ra_backends(backend, r, a, sampling, ages):
+    t = prepare_ages(ages)
+    expected, expected_grad = BACKENDS["numpy"].lik_constant_ra((r, a), sampling, t)
+    lik, grad = BACKENDS[backend].lik_constant_ra((r, a), sampling, t)
+    assert lik == pytest.approx(expected, rel=1e-9)
+    assert grad == pytest.approx(expected_grad, rel=1e-9, abs=1e-9)
@@ -0,0 +1,109 @@
+from __future__ import division
+
+import random
+import sys
+from math import log
+
+import numpy as np
+import pytest
+from hypothesis import given
+import hypothesis.strategies as st
+
+from tact.lib import BACKENDS, get_backend, get_new_times, intp1, set_backend
+
+
+def get_new_times_orig(ages, birth, death, missing, told=None, tyoung=None):
+    """Original implementation of get_new_times, drawing one time at a time."""
+    if told is None:
+        told = max(ages)
+    if tyoung is None:
+        tyoung = 0
+
+    ages.sort(reverse=True)
+    times = [x for x in ages if x <= told and x >= tyoung]
+    times = [told] + times + [tyoung]
+    ranks = range(0, len(times))
+    only_new = list()
+    while missing > 0:
+        if len(ranks) > 2:
+            distrranks = list()
+            for i in range(1, len(ranks)):
+                temp = ranks[i] * (intp1(times[i - 1], birth, death) - intp1(times[i], birth, death))
+                distrranks.append(temp)
+            try:
+                dsum = sum(distrranks)
+                distrranks = [x / dsum for x in distrranks]
+                for i in range(1, len(distrranks)):
+                    distrranks[i] = distrranks[i] + distrranks[i - 1]
+                r = random.uniform(0, 1)
+                addrank = min([idx for idx, x in enumerate(distrranks) if x > r])
+            except ZeroDivisionError:
+                addrank = 0
+            except ValueError:
+                addrank = 0
+        else:
+            addrank = 0
+        r = random.uniform(0, 1)
+        const = intp1(times[addrank], birth, death) - intp1(times[addrank + 1], birth, death)
+        try:
+            temp = intp1(times[addrank + 1], birth, death) / const
+        except ZeroDivisionError:
+            temp = 0.0
+        xnew = 1 / (death - birth) * log((1 - (r + temp) * const * birth) / (1 - (r + temp) * const * death))
+        only_new.append(xnew)
+        missing -= 1
+    only_new.sort(reverse=True)
+    return only_new
+
+
+# Fractions from 0 to 0.9, leaving out subnormal numbers, which underflow
+fractions = st.one_of(st.just(0.0), st.floats(min_value=sys.float_info.min, max_value=0.9))
+
+
+@given(
+    st.lists(st.floats(min_value=1e-3, max_value=20), max_size=30),
+    st.floats(min_value=1e-3, max_value=1),
+    fractions,
+    st.integers(min_value=0, max_value=30),
+    fractions,
+    st.integers(),
+)
+def test_new_times_match_original(ages, birth, turnover, missing, young, seed):
+    told = max(ages + [1.0])
+    tyoung = young * told
+    random.seed(seed)
+    # The original can underflow harmlessly when the death rate is tiny
+    with np.errstate(under="ignore"):
+        expected = get_new_times_orig(list(ages), birth, birth * turnover, missing, told, tyoung)
+    random.seed(seed)
+    actual = get_new_times(list(ages), birth, birth * turnover, missing, told, tyoung)
+    assert actual == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+def test_new_times_rng(ages, birth, death):
+    first = get_new_times(ages, birth, death, 50, rng=random.Random(1))
+    second = get_new_times(ages, birth, death, 50, rng=random.Random(1))
+    assert first == second
+    assert all(max(ages) >= x >= 0 for x in first)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_new_times_backends(ages, birth, death, backend):
+    expected = get_new_times(ages, birth, death, 50, rng=random.Random(1))
+    active = get_backend()
+    set_backend(backend)
+    try:
+        actual = get_new_times(ages, birth, death, 50, rng=random.Random(1))
+    finally:
+        set_backend(active)
+    assert actual == pytest.approx(expected, rel=1e-9)
+
+
+def test_new_times_orig(benchmark, ages, birth, death):
+    random.seed(0)
+    benchmark(get_new_times_orig, list(ages), birth, death, 500)
+
+
+def test_new_times(benchmark, ages, birth, death):
+    random.seed(0)
+    benchmark(get_new_times, list(ages), birth, death, 500)
@@ -0,0 +1,109 @@
+from __future__ import division
+
+import io
+import os
+
+import dendropy
+import pytest
+from dendropy.utility.error import DataParseError
+
+from tact import newick
+from tact.newick import read_chunks, read_tree
+
+stems = ["intrusion", "short_branch", "stem", "stem2", "weirdness"]
+
+tricky = [
+    "(A,B);",
+    "[&U](A,B);",
+    "[&R] (A,B);",
+    "[&u](A_x,'B_y')'i n'[c]:1;",
+    "(A,(B,C)D[x]E);",
+    "(A:1e-3,B:.5);",
+    "A;",
+    "A[&U];",
+    "(,);",
+    "(,,A,);",
+    "(A,);",
+    "((A,B),);",
+    "(A,B)[&U];",
+    "(a'b',c);",
+    "(A:1[c],B:[c]2);",
+    "(A[x[y]z],B[c[d[e]]]);",
+    "(A,B)\n;",
+    "(A,B)'';",
+    "((A,B));",
+    "('A''_B',C);",
+    "(A:1:2,B);",
+    "(:1 B,C);",
+    "('a,b(c)':1,'x[y]':2)r:0.5;",
+    "(:1,:2):3;",
+    "( A : 1 , 'B' : 2 ) ;",
+    "(A,B);(C,D);",
+    "(x[y,w]z,b);",
+    "(a,b)x[1,2]y;",
+    "('it''s, x',b);",
+]
+
+
+def summary(tree):
+    return (
+        tree.is_rooted,
+        [(x.taxon.label if x.taxon else None, x.label, x.edge.length) for x in tree.preorder_node_iter()],
+        [x.label for x in tree.taxon_namespace],
+    )
+
+
+def chunked(text, size):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("stem", stems)
+@pytest.mark.parametrize("kind", ["backbone", "taxonomy"])
+def test_same_as_dendropy(datadir, stem, kind):
+    path = os.path.join(datadir, stem + "." + kind + ".tre")
+    expected = dendropy.Tree.get(path=path, schema="newick", rooting="default-rooted")
+    assert summary(read_tree(path)) == summary(expected)
+    with open(path) as rfile:
+        assert summary(read_tree(read_chunks(rfile, size=5))) == summary(expected)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_tricky(size):
+    for text in tricky:
+        expected = dendropy.Tree.get(data=text.split(";")[0] + ";", schema="newick", rooting="default-rooted")
+        assert summary(read_tree(chunked(text, size))) == summary(expected), text
+
+
+@pytest.mark.parametrize("text", ["(A,B)", "", "(A,B));", "((A,B)C(D));", "(A,B)x:abc;", "(a,A);", "(A,B)C D;", "(A[x,B);", "('a'b,c);"])
+def test_errors(text):
+    with pytest.raises(DataParseError):
+        dendropy.Tree.get(data=text, schema="newick", rooting="default-rooted")
+    for size in [1, 1000]:
+        with pytest.raises(DataParseError):
+            read_tree(chunked(text, size))
+
+
+def test_namespace():
+    namespace = dendropy.TaxonNamespace(["C", "A"])
+    tree = read_tree(io.StringIO("(A,(B,C));"), namespace)
+    assert tree.taxon_namespace is namespace
+    assert [x.label for x in namespace] == ["C", "A", "B"]
+    assert tree.find_node_with_taxon_label("A").taxon is namespace[1]
+    namespace.is_mutable = False
+    with pytest.raises(dendropy.utility.error.ImmutableTaxonNamespaceError):
+        read_tree(io.StringIO("(A,D);"), namespace)
+
+
+
+@pytest.mark.parametrize("direct", [False, True])
+def test_child_links(datadir, monkeypatch, direct):
+    if direct and not newick.DIRECT_LINKS:
+        pytest.skip("this DendroPy version is linked through its public API")
+    monkeypatch.setattr(newick, "DIRECT_LINKS", direct)
+    path = os.path.join(datadir, "weirdness.taxonomy.tre")
+    tree = read_tree(path)
+    assert summary(tree) == summary(dendropy.Tree.get(path=path, schema="newick", rooting="default-rooted"))
+    for node in tree.preorder_node_iter():
+        for child in node.child_node_iter():
+            assert child.parent_node is node
+            assert child.edge.tail_node is node
@@ -0,0 +1,36 @@
+from __future__ import division
+
+import os
+
+from tact.cli_add_taxa import rates_digest
+from tact.lib import BACKENDS, RateCache, get_birth_death_rates, get_tree
+
+
+def test_rate_cache_evicts_least_recently_used():
+    cache = RateCache(maxsize=2)
+    cache.put("a", (1.0, 0.0))
+    cache.put("b", (2.0, 0.0))
+    assert cache.get("a") == (1.0, 0.0)
+    cache.put("c", (3.0, 0.0))
+    assert cache.get("b") is None
+    assert cache.get("c") == (3.0, 0.0)
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_birth_death_rates_are_memoized(datadir):
+    tree = get_tree(os.path.join(datadir, "weirdness.backbone.tre"))
+    cache = RateCache()
+    node = tree.seed_node
+    first = get_birth_death_rates(node, 0.5, cache=cache)
+    assert get_birth_death_rates(node, 0.5, cache=cache) == first
+    assert (cache.hits, cache.misses) == (1, 1)
+    get_birth_death_rates(node, 0.5, yule=True, cache=cache)
+    get_birth_death_rates(node, 0.25, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_rates_digest_covers_backend():
+    digests = {rates_digest("taxonomy", "backbone", 0.8, False, "grid", False, "serial", x) for x in BACKENDS}
+    assert len(digests) == len(BACKENDS)
+    assert rates_digest("taxonomy", "backbone", 0.8, False, "grid", False) in digests
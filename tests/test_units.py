@@ -0,0 +1,37 @@
+from __future__ import division
+
+import os
+
+import dendropy
+import pytest
+
+from tact.cli_add_taxa import plan_units
+from tact.compact import CompactTree
+from tact.lib import get_tip_labels
+
+
+@pytest.mark.parametrize("stem", ["intrusion", "short_branch", "stem", "weirdness"])
+def test_plan_units(datadir, stem):
+    taxonomy = dendropy.Tree.get(path=os.path.join(datadir, stem + ".taxonomy.tre"), schema="newick")
+    tree = dendropy.Tree.get(
+        path=os.path.join(datadir, stem + ".backbone.tre"),
+        schema="newick",
+        rooting="default-rooted",
+        taxon_namespace=taxonomy.taxon_namespace,
+    )
+    tree.encode_bipartitions()
+    tree.calc_node_ages()
+    tree = CompactTree.from_dendropy(tree)
+    units = plan_units(taxonomy, tree)
+    assert units
+    seen = set()
+    for taxon_node, backbone_node in units:
+        species = get_tip_labels(taxon_node)
+        backbone_node = tree.node(backbone_node)
+        extant = set(x.taxon.label for x in backbone_node.leaf_nodes())
+        # Each unit is a clade of the backbone with species left to add
+        assert extant < species
+        assert backbone_node.parent_node is not None
+        # And the units are disjoint
+        assert not seen & species
+        seen |= species
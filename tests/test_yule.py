@@ -1,9 +1,10 @@
 from __future__ import division
 
+import pytest
 from hypothesis import given
 import hypothesis.strategies as st
 
-from tact.lib import optim_yule
+from tact.lib import lik_constant_ra, optim_yule, optim_yule_batch, prepare_ages
 
 
 @given(st.lists(st.floats(min_value=0, allow_infinity=False, allow_nan=False, exclude_min=True), min_size=1), st.floats(min_value=1e-9, max_value=1))
@@ -11,3 +12,22 @@ def test_yule_has_no_extinction(ages, sampling):
     (b, d) = optim_yule(ages, sampling)
     assert d == 0
     assert b > 0
+
+
+@given(st.lists(st.floats(min_value=1e-3, max_value=200), min_size=2, max_size=100), st.floats(min_value=1e-3, max_value=1))
+def test_yule_maximizes_likelihood(ages, sampling):
+    (b, d) = optim_yule(ages, sampling)
+    t = prepare_ages(ages)
+    best = lik_constant_ra((b, 0), sampling, t)[0]
+    for other in (b * 0.99, b * 1.01):
+        if 1e-9 <= other <= 100:
+            assert best <= lik_constant_ra((other, 0), sampling, t)[0] + 1e-9
+
+
+@given(st.lists(st.tuples(st.lists(st.floats(min_value=1e-3, max_value=200), min_size=1, max_size=50), st.floats(min_value=1e-3, max_value=1)), min_size=1, max_size=10))
+def test_yule_batch(clades):
+    ages, sampling = zip(*clades)
+    for i, (b, d) in enumerate(optim_yule_batch(ages, sampling)):
+        expected = optim_yule(ages[i], sampling[i])
+        assert d == 0
+        assert b == pytest.approx(expected[0], rel=1e-6)